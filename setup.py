@@ -35,5 +35,6 @@ setup(
     author_email='aron@scampersand.com',
     url="https://github.com/appsembler/django-souvenirs",
     packages=find_packages(),
-    install_requires=['tabulate'],
+    package_data={'souvenirs': ['templates/admin/souvenirs/souvenir/*.html']},
+    install_requires=['python-dateutil', 'tabulate'],
 )
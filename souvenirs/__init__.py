@@ -1 +1,3 @@
 __version__ = '1.0.2'  # pragma: no cover
+
+default_app_config = 'souvenirs.apps.SouvenirsConfig'  # pragma: no cover
@@ -0,0 +1,342 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import date
+import itertools
+import json
+import re
+import dateutil.parser
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
+from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldError, ValidationError
+from django.core.urlresolvers import NoReverseMatch
+from django.db import connections
+from django.utils import timezone
+from . import archive, partitions
+from .control import _after, iter_keyset
+from .models import Souvenir
+from .utils import local_date, local_day_start
+
+
+# query string parameter holding the (when, id) of the last souvenir shown,
+# and its partition's table or archive file if it isn't in Souvenir's
+CURSOR_VAR = 'before'
+
+# below this many rows an estimate isn't worth it, so count exactly
+ESTIMATE_THRESHOLD = 100000
+
+
+def estimated_count(qs):
+    """
+    Return the number of rows in qs, estimated by the database's planner
+    (PostgreSQL) or table statistics (MySQL, unfiltered only) when that's
+    large, otherwise counted exactly.
+    """
+    estimate = _estimate_rows(qs.order_by())
+    if estimate is None or estimate < ESTIMATE_THRESHOLD:
+        return qs.count()
+    return estimate
+
+
+def _estimate_rows(qs):
+    connection = connections[qs.db]
+    if connection.vendor == 'postgresql':
+        sql, params = qs.values('pk').query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    if connection.vendor == 'mysql' and not qs.query.where:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT TABLE_ROWS FROM information_schema.TABLES '
+                           'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+                           [qs.model._meta.db_table])
+            row = cursor.fetchone()
+        return row and row[0]
+    return None
+
+
+class MonthListFilter(admin.SimpleListFilter):
+    """
+    Filter on calendar months, like the top of a date hierarchy. The choices
+    are the last twelve months rather than the months with souvenirs, which
+    would take a scan of the table to find.
+    """
+    title = 'month'
+    parameter_name = 'month'
+
+    def lookups(self, request, model_admin):
+        today = local_date(timezone.now())
+        year, month = today.year, today.month
+        for _ in range(12):
+            yield ('{:04d}-{:02d}'.format(year, month),
+                   date(year, month, 1).strftime('%B %Y'))
+            year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+
+    def queryset(self, request, queryset):
+        start, end = self.range()
+        if start is None:
+            return queryset
+        return queryset.filter(when__gte=start, when__lt=end)
+
+    def range(self):
+        """
+        Return the (start, end) datetimes of the chosen month, or (None, None).
+        """
+        if not self.value():
+            return None, None
+        try:
+            year, month = [int(v) for v in self.value().split('-')]
+            start = date(year, month, 1)
+        except ValueError:
+            raise IncorrectLookupParameters
+        end = date(year + month // 12, month % 12 + 1, 1)
+        return local_day_start(start), local_day_start(end)
+
+
+class SouvenirChangeList(ChangeList):
+    """
+    Change list paged by (when, id) instead of OFFSET, newest first, so that
+    every page is an index range scan no matter how deep. There are links to
+    the next (older) page and back to the newest, and the total is an
+    estimate.
+
+    With SOUVENIRS_STORAGE = 'partitioned', the partitions are filtered like
+    the table and merged in, a page from each, and so are the archive files
+    with SOUVENIRS_ARCHIVE_DIR. Their rows can't be changed. Archived
+    souvenirs have no id, tenant or bucket, so lookups on those leave them
+    out.
+    """
+
+    def get_filters(self, request):
+        filters = super(SouvenirChangeList, self).get_filters(request)
+        # the lookups besides the list filters, for the partitions too
+        self.remaining_lookup_params = filters[2]
+        return filters
+
+    def get_results(self, request):
+        table = self.model._meta.db_table
+        position = None
+        cursor = getattr(request, '_souvenirs_cursor', None)
+        if cursor:
+            try:
+                when, pk, source = (cursor.split('_', 2) + [table])[:3]
+                position = dateutil.parser.parse(when), source, int(pk)
+            except (TypeError, ValueError, OverflowError):
+                raise IncorrectLookupParameters
+
+        querysets = [self.queryset] + self.partition_querysets(request)
+        archived = self.archived()
+        if len(querysets) == 1 and archived is None:
+            qs = self.queryset.order_by('-when', '-id')
+            if position:
+                qs = _after(qs, table, position, reverse=True)
+            rows = list(qs[:self.list_per_page + 1])
+            for souvenir in rows:
+                souvenir.position = souvenir.when, table, souvenir.pk
+        else:
+            rows = self.merge_results(querysets, position, archived)
+
+        self.result_count = (sum(estimated_count(q) for q in querysets) +
+                             _archived_count(archived))
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = rows[:self.list_per_page]
+        self.can_show_all = False
+        self.multi_page = bool(cursor) or len(rows) > self.list_per_page
+        self.paginator = None
+
+        self.newest_url = self.next_url = None
+        if cursor:
+            self.newest_url = self.get_query_string()
+        if len(rows) > self.list_per_page:
+            when, source, pk = self.result_list[-1].position
+            cursor = '{}_{}'.format(when.isoformat(), pk)
+            if source != table:
+                cursor += '_' + source
+            self.next_url = self.get_query_string({CURSOR_VAR: cursor})
+
+    def partition_querysets(self, request):
+        """
+        Return the querysets of the partitions, filtered like self.queryset.
+        """
+        if not partitions.enabled():
+            return []
+        start, end = self.when_range()
+        lookups = dict((_partition_lookup(k), v)
+                       for k, v in self.remaining_lookup_params.items())
+        querysets = []
+        for qs in partitions.partition_querysets(start, end,
+                                                 using=self.queryset.db):
+            for spec in self.filter_specs:
+                new_qs = spec.queryset(request, qs)
+                if new_qs is not None:
+                    qs = new_qs
+            try:
+                querysets.append(qs.filter(**lookups))
+            except FieldError:
+                raise IncorrectLookupParameters
+        return querysets
+
+    def archived(self):
+        """
+        Return (start, end, user id) of the archived souvenirs the filters
+        select, where user id is None for all users, or None for none.
+        """
+        if not archive.archived_months():
+            return None
+        user_id = None
+        for lookup, value in self.remaining_lookup_params.items():
+            lookup = _partition_lookup(lookup)
+            if lookup in ('user_id', 'user_id__exact'):
+                try:
+                    user_id = int(value)
+                except ValueError:
+                    raise IncorrectLookupParameters
+            elif not (lookup == 'tenant__isnull' and value):
+                return None
+        start, end = self.when_range()
+        return start, end, user_id
+
+    def when_range(self):
+        """
+        Return the (start, end) datetimes the list filters select, either of
+        them None if unbounded.
+        """
+        start = end = None
+        for spec in self.filter_specs:
+            if isinstance(spec, MonthListFilter):
+                lo, hi = spec.range()
+            elif getattr(spec, 'field_path', None) == 'when':
+                lo, hi = [_datetime(spec.used_parameters.get(lookup))
+                          for lookup in (spec.lookup_kwarg_since,
+                                         spec.lookup_kwarg_until)]
+            else:
+                continue
+            if lo is not None and (start is None or lo > start):
+                start = lo
+            if hi is not None and (end is None or hi < end):
+                end = hi
+        return start, end
+
+    def merge_results(self, querysets, position, archived):
+        """
+        Return a page and one more of souvenirs after position from the merged
+        querysets and archive files, those from the partitions and the archive
+        as unsaved Souvenirs.
+        """
+        table = self.model._meta.db_table
+        rows = iter_keyset(querysets, self.list_per_page + 1, position,
+                           reverse=True, archived=archived and archived[:2])
+        if archived and archived[2] is not None:
+            tables = set(q.model._meta.db_table for q in querysets)
+            rows = (row for row in rows
+                    if row[1] in tables or row[3] == archived[2])
+        rows = list(itertools.islice(rows, self.list_per_page + 1))
+        souvenirs = self.queryset.in_bulk(
+            [pk for _, source, pk, _ in rows if source == table])
+        users = get_user_model()._default_manager.in_bulk(
+            set(user_id for _, source, _, user_id in rows if source != table))
+        results = []
+        for when, source, pk, user_id in rows:
+            if source == table:
+                souvenir = souvenirs.get(pk)
+                if souvenir is None:  # deleted since
+                    continue
+            else:
+                souvenir = self.model(when=when, user_id=user_id)
+                if user_id in users:
+                    souvenir.user = users[user_id]
+            souvenir.position = when, source, pk
+            results.append(souvenir)
+        return results
+
+    def url_for_result(self, result):
+        if result.pk is None:
+            # from a partition or the archive, so shown without a link
+            raise NoReverseMatch
+        return super(SouvenirChangeList, self).url_for_result(result)
+
+
+def _archived_count(archived):
+    """
+    Return the number of souvenirs in the archive files selected by
+    archived, as returned by SouvenirChangeList.archived.
+    """
+    if archived is None:
+        return 0
+    start, end, user_id = archived
+    count = 0
+    for month, first, last in archive.archives_between(start, end):
+        if user_id is None:
+            count += last - first
+        else:
+            count += month.user_ids(first, last).count(user_id)
+    return count
+
+
+def _datetime(value):
+    """
+    Return the datetime of a when lookup's value, or None. Naive ones are in
+    the default timezone, as in the query.
+    """
+    if not value:
+        return None
+    try:
+        when = Souvenir._meta.get_field('when').to_python(value)
+    except ValidationError:
+        raise IncorrectLookupParameters
+    if settings.USE_TZ and timezone.is_naive(when):
+        when = timezone.make_aware(when, timezone.get_default_timezone())
+    return when
+
+
+def _partition_lookup(lookup):
+    """
+    Return lookup for the partitions, which have a plain user_id column
+    rather than the foreign key.
+    """
+    return re.sub(r'^user(__(id|pk))?(?=__|$)', 'user_id', lookup)
+
+
+class SouvenirAdmin(admin.ModelAdmin):
+    list_display = ('when', 'user')
+    list_filter = ('when', MonthListFilter)
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    ordering = ('-when', '-id')
+    show_full_result_count = False
+    change_list_template = 'admin/souvenirs/souvenir/change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return SouvenirChangeList
+
+    def action_checkbox(self, obj):
+        # rows from the partitions and the archive can't be selected
+        if obj.pk is None:
+            return ''
+        return super(SouvenirAdmin, self).action_checkbox(obj)
+    action_checkbox.short_description = (
+        admin.ModelAdmin.action_checkbox.short_description)
+    action_checkbox.allow_tags = getattr(admin.ModelAdmin.action_checkbox,
+                                         'allow_tags', False)
+
+    def changelist_view(self, request, extra_context=None):
+        # The cursor isn't a filter, and the order is fixed by the paging, so
+        # keep both away from the stock ChangeList.
+        request.GET = request.GET.copy()
+        request._souvenirs_cursor = request.GET.pop(CURSOR_VAR, [None])[-1]
+        request.GET.pop(ORDER_VAR, None)
+        return super(SouvenirAdmin, self).changelist_view(request, extra_context)
+
+
+# Projects that register Souvenir themselves can turn this off, or register
+# it before souvenirs in INSTALLED_APPS. SouvenirAdmin is theirs to reuse.
+if (getattr(settings, 'SOUVENIRS_ADMIN', True) and
+        not admin.site.is_registered(Souvenir)):
+    admin.site.register(Souvenir, SouvenirAdmin)
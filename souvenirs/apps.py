@@ -0,0 +1,22 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.apps import AppConfig
+from django.db.models import signals
+
+
+class SouvenirsConfig(AppConfig):
+    name = 'souvenirs'
+
+    def ready(self):
+        from django.contrib.auth import get_user_model
+        from . import signals as handlers
+        User = get_user_model()
+        signals.pre_save.connect(handlers.user_pre_save, sender=User,
+                                 dispatch_uid='souvenirs.user_pre_save')
+        signals.post_save.connect(handlers.user_post_save, sender=User,
+                                  dispatch_uid='souvenirs.user_post_save')
+        signals.post_delete.connect(handlers.user_post_delete, sender=User,
+                                    dispatch_uid='souvenirs.user_post_delete')
+        signals.post_delete.connect(handlers.user_post_delete_souvenirs,
+                                    sender=User,
+                                    dispatch_uid='souvenirs.user_post_delete_souvenirs')
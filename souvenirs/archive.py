@@ -0,0 +1,265 @@
+from __future__ import absolute_import, unicode_literals
+
+from array import array
+import bisect
+import calendar
+from collections import Counter
+from datetime import date
+import heapq
+import itertools
+import mmap
+import os
+import re
+import struct
+import sys
+from django.conf import settings
+from django.db import router, transaction
+from . import partitions
+from .models import Souvenir
+from .utils import local_day_start, next_month
+
+
+# array typecode of unsigned 32-bit ints
+_UINT32 = str('I') if array(str('I')).itemsize == 4 else str('L')
+
+_FILENAME = re.compile(r'^souvenirs-(\d{4})(\d{2})\.col$')
+
+
+def enabled():
+    return bool(getattr(settings, 'SOUVENIRS_ARCHIVE_DIR', None))
+
+
+def archive_path(month):
+    return os.path.join(settings.SOUVENIRS_ARCHIVE_DIR,
+                        'souvenirs-{:%Y%m}.col'.format(month))
+
+
+def archived_months():
+    """
+    Return the months with archive files, in ascending order.
+    """
+    months = []
+    if enabled() and os.path.isdir(settings.SOUVENIRS_ARCHIVE_DIR):
+        for name in os.listdir(settings.SOUVENIRS_ARCHIVE_DIR):
+            match = _FILENAME.match(name)
+            if match:
+                months.append(date(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+
+def month_range(month):
+    """
+    Return the (start, end) datetimes of month in the default timezone.
+    """
+    return local_day_start(month), local_day_start(next_month(month))
+
+
+def epoch(when):
+    return calendar.timegm(when.utctimetuple())
+
+
+class MonthArchive(object):
+    """
+    Memory-mapped archive file of a month of souvenirs, in columns: the
+    souvenir times as seconds after the start of the month, ascending, then
+    the user ids in the same order, both unsigned 32-bit ints. The header
+    has the first row of each day (of 86400 seconds from the start), so that
+    finding a time range reads a day's worth of times at most.
+
+    The times are offsets from one base rather than deltas from the previous
+    row, which in fixed-width columns would save no space, and would need
+    decoding from the start of the day to binary search.
+    """
+    MAGIC = b'SOUVAR01'
+    HEADER = struct.Struct(str('<8sqI'))
+    DAYS = struct.Struct(str('<33I'))
+    UINT32 = struct.Struct(str('<I'))
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.base, self.count = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            self.close()
+            raise ValueError("not a souvenirs archive: {}".format(path))
+        self.days = self.DAYS.unpack_from(self.map, self.HEADER.size)
+        self.times = self.HEADER.size + self.DAYS.size
+        self.users = self.times + 4 * self.count
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def write(cls, path, base, times, users):
+        """
+        Write an archive from arrays of times (seconds after base, ascending)
+        and user ids. The file is replaced atomically.
+        """
+        days = [bisect.bisect_left(times, d * 86400) for d in range(33)]
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, base, len(times)))
+            f.write(cls.DAYS.pack(*days))
+            for column in (times, users):
+                if sys.byteorder == 'big':
+                    column = array(_UINT32, column)
+                    column.byteswap()
+                f.write(_tobytes(column))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+
+    def span(self, start=None, end=None):
+        """
+        Return the (first, last) rows, exclusive, of souvenirs between start
+        and end epoch seconds.
+        """
+        return (self._row(start) if start is not None else 0,
+                self._row(end) if end is not None else self.count)
+
+    def columns(self, first, last):
+        """
+        Return a list of the times (epoch seconds) and an array of the user
+        ids of rows first to last.
+        """
+        times = self._column(self.times, first, last)
+        users = self._column(self.users, first, last)
+        return [self.base + t for t in times], users
+
+    def user_ids(self, first, last):
+        return self._column(self.users, first, last)
+
+    def _row(self, when):
+        offset = when - self.base
+        if offset <= 0:
+            return 0
+        day = offset // 86400
+        if day >= 32:
+            return self.count
+        lo, hi = self.days[day], self.days[day + 1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.UINT32.unpack_from(self.map, self.times + 4 * mid)[0] < offset:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _column(self, offset, first, last):
+        column = array(_UINT32)
+        _frombytes(column, self.map[offset + 4 * first:offset + 4 * last])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        return column
+
+
+def _tobytes(a):
+    return a.tobytes() if hasattr(a, 'tobytes') else a.tostring()
+
+
+def _frombytes(a, data):
+    if hasattr(a, 'frombytes'):
+        a.frombytes(data)
+    else:
+        a.fromstring(data)
+
+
+def archives_between(start=None, end=None):
+    """
+    Generate (MonthArchive, first row, last row) for the archived months
+    with souvenirs between start and end datetimes (either may be None for
+    unbounded). Each archive is closed when the next one is generated.
+    """
+    start = None if start is None else epoch(start)
+    end = None if end is None else epoch(end)
+    for month in archived_months():
+        month_start, month_end = map(epoch, month_range(month))
+        if ((start is not None and month_end <= start) or
+                (end is not None and end <= month_start)):
+            continue
+        with MonthArchive(archive_path(month)) as archive:
+            first, last = archive.span(start, end)
+            if first < last:
+                yield archive, first, last
+
+
+def archive_month(month, using=None, batch_size=1000):
+    """
+    Move the souvenirs of month from the Souvenir table, and its partition
+    with SOUVENIRS_STORAGE = 'partitioned', to its archive file, merging with
+    the file if there is one already. Returns the number of souvenirs moved.
+    User ids must be integers below 2 ** 32.
+
+    The archive has no tenant column, so souvenirs with a tenant stay in the
+    table, where the counts by tenant find them.
+
+    The rows are only deleted once the file is written, batch_size per
+    transaction, so a failure leaves some in both places until this is run
+    again, which skips those already in the file. Meanwhile counts of
+    distinct users don't change, but counts of souvenirs do.
+    """
+    using = using or router.db_for_write(Souvenir)
+    start, end = month_range(month)
+    base = epoch(start)
+    querysets = []
+    tables = [Souvenir.objects.using(using)]
+    if partitions.enabled():
+        tables += partitions.partition_querysets(start, end, using)
+    for qs in tables:
+        qs = qs.filter(when__gte=start, when__lt=end, tenant__isnull=True)
+        last_pk = qs.order_by('-pk').values_list('pk', flat=True).first()
+        if last_pk is not None:
+            # souvenirs backfilled while this runs stay in the table
+            querysets.append(qs.filter(pk__lte=last_pk))
+    if not querysets:
+        return 0
+    # (time, user, whether from the table)
+    sources = [((epoch(when) - base, user_id, True) for when, user_id in
+                qs.order_by('when', 'user_id')
+                .values_list('when', 'user_id').iterator())
+               for qs in querysets]
+
+    path = archive_path(month)
+    archived = 0
+    if os.path.exists(path):
+        with MonthArchive(path) as archive:
+            times, users = archive.columns(0, archive.count)
+            archived = archive.count
+        sources.append(((t - base, u, False) for t, u in zip(times, users)))
+
+    times, users = array(_UINT32), array(_UINT32)
+    for t, rows in itertools.groupby(heapq.merge(*sources), lambda r: r[0]):
+        rows = sorted(rows)
+        # rows left in the table by a run that failed to delete them
+        in_file = Counter(u for _, u, from_table in rows if not from_table)
+        for _, u, from_table in rows:
+            if from_table and in_file[u]:
+                in_file[u] -= 1
+                continue
+            times.append(t)
+            users.append(u)
+    if not os.path.isdir(settings.SOUVENIRS_ARCHIVE_DIR):
+        os.makedirs(settings.SOUVENIRS_ARCHIVE_DIR)
+    MonthArchive.write(path, base, times, users)
+    for qs in querysets:
+        _delete_in_batches(qs, batch_size, using)
+    return len(times) - archived
+
+
+def _delete_in_batches(qs, batch_size, using):
+    """
+    Delete the rows of qs batch_size at a time, like purge_user_souvenirs.
+    """
+    while True:
+        pks = list(qs.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        # a range rather than pk__in, which has a parameter per row
+        with transaction.atomic(using=using):
+            qs.filter(pk__gte=pks[0], pk__lte=pks[-1]).delete()
@@ -1,20 +1,71 @@
 from __future__ import absolute_import, unicode_literals
 
-from datetime import timedelta
+import bisect
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import reduce
+import heapq
+import itertools
 import logging
+import math
+import operator
+import os
+import time
 from django.conf import settings
-from django.core.cache import caches
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import Count, F, Q
 from django.utils import timezone
-from .models import Souvenir
+from . import archive, live, partitions
+from .models import RegistrationDay, Souvenir, UserActivity
+from .ratelimit import get_ratelimiter
+from .utils import local_date, local_day_start
 
 
 logger = logging.getLogger(__name__)
 
+# how many disjoint ranges count_active_users_many puts in one query
+_RANGES_PER_QUERY = 100
 
-def souvenez(user, when=None, ratelimit=True, check_duplicate=False):
+# how many users bulk_souvenez rebuilds the activity summary for at a time
+_USERS_PER_QUERY = 500
+
+
+def souvenez(user, when=None, ratelimit=True, check_duplicate=False,
+             using=None, tenant=None):
     """
     Save a Souvenir to the DB, rate-limited by default to once per hour.
     Returns a string: "added", "rate-limited" or "duplicated".
+
+    The souvenir is written to the database alias using, or wherever the
+    routers send Souvenir writes (see SouvenirsRouter).
+
+    With SOUVENIRS_STORAGE = 'bucketed', when is truncated to the
+    SOUVENIRS_RATELIMIT_SECONDS window and the DB's unique (user, bucket)
+    constraint does the rate limiting instead of the cache, so a souvenir
+    landing in an existing bucket is "rate-limited". Buckets are always that
+    wide, whatever ratelimit is, even False, so that there's never more than
+    one souvenir per user per bucket.
+
+    tenant optionally records the site or organization the user was active
+    on, for count_active_users_by_tenant. Rate limiting is per user and
+    tenant, except that bucketed storage keeps one souvenir per user per
+    bucket, whichever tenant it's for.
+
+    With SOUVENIRS_LIVE_COUNTERS, the counters read by live_active_users and
+    concurrent_users are updated too (see souvenirs.live).
+    """
+    return _souvenez_window(user, when, ratelimit, check_duplicate, using,
+                            tenant)[0]
+
+
+def _souvenez_window(user, when=None, ratelimit=True, check_duplicate=False,
+                     using=None, tenant=None):
+    """
+    souvenez, returning a tuple (result, since) where since is when the
+    rate-limit window of the souvenir started: when itself (or its bucket's
+    start) if it was added, the earlier souvenir's time if it was
+    rate-limited, or None if it was a duplicate.
     """
     # user can be a User object or PK (for backfill script)
     user_id = getattr(user, 'id', user)
@@ -23,39 +74,834 @@ def souvenez(user, when=None, ratelimit=True, check_duplicate=False):
     if when is None:
         when = timezone.now()
 
+    if using is None:
+        using = router.db_for_write(Souvenir)
+
+    result, since = _souvenez(user_id, username, when, ratelimit,
+                              check_duplicate, using, tenant)
+    if result != 'duplicated':
+        live.record(user_id, when, added=result == 'added')
+    return result, since
+
+
+def _souvenez(user_id, username, when, ratelimit, check_duplicate, using,
+              tenant):
+    if getattr(settings, 'SOUVENIRS_STORAGE', 'rows') == 'bucketed':
+        # a bucket per user per window, so the windows must all be as wide
+        seconds = getattr(settings, 'SOUVENIRS_RATELIMIT_SECONDS', 3600)
+        if seconds:
+            return _souvenez_bucketed(user_id, username, when, seconds, using,
+                                      tenant)
+        ratelimit = False
+
     if ratelimit is True:
         ratelimit = getattr(settings, 'SOUVENIRS_RATELIMIT_SECONDS', 3600)
 
     if ratelimit:
-        name = getattr(settings, 'SOUVENIRS_CACHE_NAME', 'default')
-        prefix = getattr(settings, 'SOUVENIRS_CACHE_PREFIX', 'souvenir.')
-        key = '{}.{}'.format(prefix, user_id)
-        cache = caches[name]
-        value = cache.get(key)
-        if value and when < value + timedelta(seconds=ratelimit):
-            logger.debug("rate-limited %s (last seen %s)", username, value)
-            return 'rate-limited'
-        cache.set(key, when)
+        key = user_id if tenant is None else '{}.{}'.format(user_id, tenant)
+        last_seen = get_ratelimiter().hit(key, when, ratelimit)
+        if last_seen is not None:
+            logger.debug("rate-limited %s (last seen %s)", username, last_seen)
+            return 'rate-limited', last_seen
+
+    # Souvenir, or with SOUVENIRS_STORAGE = 'partitioned', the month's table
+    model = partitions.souvenir_model(when, using)
 
     if check_duplicate:
-        if Souvenir.objects.filter(user_id=user_id, when=when).exists():
+        if (model.objects.using(using)
+                .filter(user_id=user_id, when=when, tenant=tenant).exists()):
             logger.debug("ignoring duplicate souvenir for %s (%s)", username, when)
-            return 'duplicated'
+            return 'duplicated', None
 
-    Souvenir(user_id=user_id, when=when).save()
+    with transaction.atomic(using=using):
+        model(user_id=user_id, when=when, tenant=tenant).save(using=using)
+        _update_user_activity(user_id, when, using=using)
+    logger.debug("saved souvenir for %s (%s)", username, when)
+    return 'added', when
+
+
+def _souvenez_bucketed(user_id, username, when, seconds, using, tenant):
+    """
+    Insert a souvenir for the bucket containing when, or nothing if the user
+    already has one. The unique constraint makes this a single INSERT rather
+    than a lookup followed by an INSERT, and only when that fails is the
+    bucket looked up, to tell it from other integrity errors.
+    """
+    when, bucket = _bucket(when, seconds)
+    try:
+        with transaction.atomic(using=using):
+            Souvenir(user_id=user_id, when=when, bucket=bucket,
+                     tenant=tenant).save(using=using)
+            _update_user_activity(user_id, when, using=using)
+    except IntegrityError:
+        if not (Souvenir.objects.using(using)
+                .filter(user_id=user_id, bucket=bucket).exists()):
+            raise
+        logger.debug("rate-limited %s (bucket %s)", username, when)
+        return 'rate-limited', when
     logger.debug("saved souvenir for %s (%s)", username, when)
-    return 'added'
+    return 'added', when
+
+
+def _bucket(when, seconds):
+    """
+    Return the start of the seconds-long bucket containing when, and the
+    bucket's number (its start in epoch seconds).
+    """
+    epoch = datetime(1970, 1, 1)
+    if timezone.is_aware(when):
+        epoch = epoch.replace(tzinfo=timezone.utc)
+    offset = int((when - epoch).total_seconds())
+    bucket = offset - offset % seconds
+    return epoch + timedelta(seconds=bucket), bucket
+
+
+def bulk_souvenez(records, ratelimit=False, chunk_size=10000, batch_size=1000,
+                  using=None):
+    """
+    Save many souvenirs at once, for backfilling. records is an iterable of
+    (user PK, when) tuples. Returns a Counter of the same outcomes as
+    souvenez: "added", "rate-limited" and "duplicated".
+
+    The records are handled chunk_size at a time: each chunk is checked for
+    duplicates against one query for the souvenirs in its time range, and
+    written with bulk_create in batches of batch_size. Records should be
+    roughly in time order, so that the range is narrow.
+
+    With ratelimit (True for SOUVENIRS_RATELIMIT_SECONDS, or a number of
+    seconds) a user's record is dropped if it's less than that long after
+    the last one kept, like souvenez. This is done in memory and doesn't
+    consult the rate limiter, or souvenirs already in the database. With
+    SOUVENIRS_STORAGE = 'bucketed' records are always collapsed into their
+    SOUVENIRS_RATELIMIT_SECONDS buckets. With SOUVENIRS_STORAGE = 'partitioned' the duplicate check
+    includes the partitions, and records are written to their months'.
+
+    The UserActivity summary is rebuilt afterward for the users imported.
+    """
+    if using is None:
+        using = router.db_for_write(Souvenir)
+    seconds = getattr(settings, 'SOUVENIRS_RATELIMIT_SECONDS', 3600)
+    bucketed = (getattr(settings, 'SOUVENIRS_STORAGE', 'rows') == 'bucketed'
+                and bool(seconds))
+    if ratelimit is True:
+        ratelimit = seconds
+    window = timedelta(seconds=ratelimit or 0)
+
+    results = Counter()
+    last_kept = {}
+    touched = set()
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+        chunk.sort()
+
+        first = min(when for _, when in chunk)
+        if bucketed:
+            first = _bucket(first, seconds)[0]
+        last = max(when for _, when in chunk)
+        existing = set()
+        for q in _souvenir_querysets(None, using, first,
+                                     last + timedelta(seconds=1)):
+            existing.update(q.filter(when__gte=first, when__lte=last)
+                            .values_list('user_id', 'when').iterator())
+        new = []
+        for user_id, when in chunk:
+            bucket = None
+            if bucketed:
+                when, bucket = _bucket(when, seconds)
+            if (user_id, when) in existing:
+                results['rate-limited' if bucketed else 'duplicated'] += 1
+                continue
+            kept = last_kept.get(user_id)
+            if window and kept is not None and kept <= when < kept + window:
+                results['rate-limited'] += 1
+                continue
+            existing.add((user_id, when))
+            last_kept[user_id] = when
+            model = partitions.souvenir_model(when, using)
+            if model is Souvenir:
+                new.append(Souvenir(user_id=user_id, when=when, bucket=bucket))
+            else:
+                new.append(model(user_id=user_id, when=when))
+
+        if new:
+            with transaction.atomic(using=using):
+                # one bulk_create per model, for the partitions
+                new.sort(key=lambda s: s._meta.db_table)
+                for _, batch in itertools.groupby(new, lambda s: type(s)):
+                    batch = list(batch)
+                    for i in range(0, len(batch), batch_size):
+                        type(batch[0]).objects.using(using).bulk_create(
+                            batch[i:i + batch_size])
+            results['added'] += len(new)
+            touched.update(s.user_id for s in new)
+
+    touched = sorted(touched)
+    for i in range(0, len(touched), _USERS_PER_QUERY):
+        rebuild_user_activity(users=touched[i:i + _USERS_PER_QUERY],
+                              batch_size=batch_size, using=using)
+    return results
+
+
+def backfill_souvenirs(fields=('date_joined', 'last_login'), users=None,
+                       sql=None, params=(), chunk_size=100000, using=None):
+    """
+    Seed souvenirs from timestamps the database already has, for new
+    installs. Returns the number of souvenirs added.
 
+    fields are DateTimeFields of the user model, each a souvenir when set.
+    users is an optional queryset to limit them to. sql is an optional
+    SELECT of more souvenirs with params, with the columns user_id and seen,
+    for example "SELECT customer_id AS user_id, created AS seen FROM
+    shop_order".
 
-def count_active_users(start=None, end=None, qs=None):
+    Each source is copied chunk_size users at a time, by user id, with one
+    INSERT ... SELECT DISTINCT executed in the database, skipping the (user,
+    when) pairs that are already souvenirs. User ids must be integers. The
+    souvenirs are written to Souvenir without tenant, and the UserActivity
+    summary isn't updated: use rebuild_user_activity after.
+
+    Only the default SOUVENIRS_STORAGE = 'rows' is supported. Bucketed rows
+    need their bucket, and partitions their month's table, so for those use
+    bulk_souvenez. The same goes for fields when the users are in another
+    database than the souvenirs, since they're read by the same statement.
+    """
+    storage = getattr(settings, 'SOUVENIRS_STORAGE', 'rows')
+    if storage != 'rows':
+        raise ValueError("can't backfill with SOUVENIRS_STORAGE = {!r}".format(
+            storage))
+    if using is None:
+        using = router.db_for_write(Souvenir)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    User = get_user_model()
+    if fields and router.db_for_read(User) != using:
+        raise ValueError("can't backfill from the users' fields in {!r} to "
+                         "souvenirs in {!r}".format(router.db_for_read(User),
+                                                    using))
+
+    sources = []
+    for name in fields:
+        field = User._meta.get_field(name)
+        source = 'SELECT {} AS user_id, {} AS seen FROM {}'.format(
+            qn(User._meta.pk.column), qn(field.column), qn(User._meta.db_table))
+        source_params = ()
+        if users is not None:
+            users_sql, source_params = (users.using(using).order_by()
+                                        .values('pk').query.sql_with_params())
+            source += ' WHERE {} IN ({})'.format(qn(User._meta.pk.column),
+                                                 users_sql)
+        sources.append((source, tuple(source_params)))
+    if sql:
+        sources.append((sql, tuple(params)))
+
+    table = qn(Souvenir._meta.db_table)
+    user_id = qn(Souvenir._meta.get_field('user').column)
+    when = qn(Souvenir._meta.get_field('when').column)
+    insert = (
+        'INSERT INTO {table} ({user_id}, {when}) '
+        'SELECT DISTINCT b.user_id, b.seen FROM ({{}}) b '
+        'WHERE b.user_id >= %s AND b.user_id < %s AND b.seen IS NOT NULL '
+        'AND NOT EXISTS (SELECT 1 FROM {table} s '
+        'WHERE s.{user_id} = b.user_id AND s.{when} = b.seen)'
+    ).format(table=table, user_id=user_id, when=when)
+
+    added = 0
+    with connection.cursor() as cursor:
+        for source, source_params in sources:
+            cursor.execute(
+                'SELECT MIN(b.user_id), MAX(b.user_id) FROM ({}) b'.format(source),
+                source_params)
+            first, last = cursor.fetchone()
+            if first is None:
+                continue
+            for lo in range(first, last + 1, chunk_size):
+                with transaction.atomic(using=using):
+                    cursor.execute(insert.format(source),
+                                   source_params + (lo, lo + chunk_size))
+                    added += max(cursor.rowcount, 0)
+    return added
+
+
+def count_active_users(start=None, end=None, qs=None, using=None,
+                       sample=None):
     """
     Return the number of active users between start and end datetimes,
     inclusive and exclusive respectively.
+
+    With sample, a fraction such as 0.05, only that part of the users is
+    counted, chosen by user id (see SAMPLE_PARTS), and the result is an
+    Estimate scaled up from it. The same users are sampled in every period.
+
+    With SOUVENIRS_STORAGE = 'partitioned' (and no qs), the partitions
+    between start and end are counted together with Souvenir in one query.
+    With SOUVENIRS_ARCHIVE_DIR (and no qs), the users in the archive files
+    between start and end are merged in.
+    """
+    parts = None if sample is None else _sample_parts(sample)
+    users = _archived_users(start, end, parts) if qs is None else None
+    querysets = []
+    for q in _souvenir_querysets(qs, using, start, end):
+        if start:
+            q = q.filter(when__gte=start)  # inclusive
+        if end:
+            q = q.filter(when__lt=end)     # exclusive
+        if parts:
+            q = _sample(q, parts)
+        querysets.append(q)
+    if users:
+        for q in querysets:
+            users.update(q.values_list('user_id', flat=True).distinct().iterator())
+        count = len(users)
+    else:
+        count = _count_users(querysets)
+    if not parts:
+        return count
+    return Estimate.scale(count, float(parts) / SAMPLE_PARTS)
+
+
+def _souvenir_querysets(qs, using, start=None, end=None):
+    """
+    Return a list of the querysets to read souvenirs between start and end
+    from: qs, or Souvenir's and those of the partitions in range.
+    """
+    if qs is not None:
+        querysets = [qs]
+    else:
+        querysets = [Souvenir.objects.all()]
+        if partitions.enabled():
+            querysets += partitions.partition_querysets(start, end, using)
+    if using is not None:
+        querysets = [qs.using(using) for qs in querysets]
+    return querysets
+
+
+def _user_ids(users, using):
+    """
+    Return users (User objects, PKs or a queryset) as something user_id__in
+    accepts on the database using, including on the partitions, which have
+    no foreign key. A queryset of users in another database is evaluated.
+    """
+    if hasattr(users, 'values'):
+        if users.db == using:
+            return users.values('pk')
+        return list(users.values_list('pk', flat=True))
+    return [getattr(u, 'pk', u) for u in users]
+
+
+def _archived_rows(start=None, end=None):
+    """
+    Generate tuples (epoch seconds, user id) of the souvenirs in the archive
+    files between start and end, in time order.
+    """
+    if archive.enabled():
+        for month, first, last in archive.archives_between(start, end):
+            for row in zip(*month.columns(first, last)):
+                yield row
+
+
+def _archived_users(start, end, parts=None):
+    """
+    Return the set of user ids in the archive files between start and end,
+    only those in the sample of parts if given.
+    """
+    users = set()
+    if archive.enabled():
+        for month, first, last in archive.archives_between(start, end):
+            users.update(month.user_ids(first, last))
+    if parts:
+        users = set(u for u in users if u % SAMPLE_PARTS < parts)
+    return users
+
+
+def _count_users(querysets):
+    """
+    Return the number of distinct users in the union of querysets, which
+    must be on the same database.
+    """
+    if len(querysets) == 1:
+        return querysets[0].values('user_id').distinct().count()
+    parts = [qs.order_by().values('user_id').query.sql_with_params()
+             for qs in querysets]
+    sql = 'SELECT COUNT(*) FROM ({}) souvenirs_users'.format(
+        ' UNION '.join(sql for sql, _ in parts))
+    with connections[querysets[0].db].cursor() as cursor:
+        cursor.execute(sql, [p for _, params in parts for p in params])
+        return cursor.fetchone()[0]
+
+
+# users are sampled by user id modulo this, so samples are a whole number of
+# parts in this many, and a sample includes the users of any smaller one
+SAMPLE_PARTS = 1000
+
+
+def _sample_parts(sample):
+    """
+    Return the number of SAMPLE_PARTS in sample, a fraction.
+    """
+    parts = int(round(sample * SAMPLE_PARTS))
+    if not 1 <= parts <= SAMPLE_PARTS:
+        raise ValueError("sample must be between {} and 1".format(
+            1.0 / SAMPLE_PARTS))
+    return parts
+
+
+def _sample(qs, parts):
+    """
+    Return qs restricted to the users in the first parts of SAMPLE_PARTS.
+    User ids must be integers.
     """
-    if qs is None:
-        qs = Souvenir.objects.all()
-    if start:
-        qs = qs.filter(when__gte=start)  # inclusive
-    if end:
-        qs = qs.filter(when__lt=end)     # exclusive
-    return qs.values('user').distinct().count()
+    return (qs.annotate(sample_part=F('user_id') % SAMPLE_PARTS)
+            .filter(sample_part__lt=parts))
+
+
+class Estimate(int):
+    """
+    Number of users estimated from a sample, with the bounds of its 95%
+    confidence interval as low and high. It's an int, so it can stand in
+    for an exact count.
+    """
+
+    def __new__(cls, value, low, high, sample):
+        self = super(Estimate, cls).__new__(cls, value)
+        self.low, self.high, self.sample = low, high, sample
+        return self
+
+    @classmethod
+    def scale(cls, count, sample):
+        """
+        Return the Estimate from count users in a sample of users, as a
+        fraction. Each user is in the sample or not independently of their
+        activity, so the count is binomial.
+        """
+        value = count / sample
+        if count:
+            margin = 1.96 * math.sqrt(count * (1 - sample)) / sample
+            low, high = max(count, value - margin), value + margin
+        else:
+            # the rule of three
+            low, high = 0, 3 / sample
+        return cls(int(round(value)), int(round(low)), int(round(high)),
+                   sample)
+
+    def __repr__(self):
+        return 'Estimate({}, low={}, high={}, sample={})'.format(
+            int(self), self.low, self.high, self.sample)
+
+
+def count_active_users_by_tenant(start=None, end=None, qs=None, using=None):
+    """
+    Return a dictionary of the number of active users between start and end
+    for each tenant, like count_active_users for each, from one query grouping
+    by tenant (per partition with SOUVENIRS_STORAGE = 'partitioned'; see
+    _count_users_by). Souvenirs without a tenant are counted under None, with
+    the users in the archive files (and no qs).
+    """
+    archived = _archived_users(start, end) if qs is None else None
+    querysets = []
+    for q in _souvenir_querysets(qs, using, start, end):
+        if start:
+            q = q.filter(when__gte=start)  # inclusive
+        if end:
+            q = q.filter(when__lt=end)     # exclusive
+        querysets.append(q)
+    counts = _count_users_by(querysets, ('tenant',),
+                             {(None,): archived} if archived else None)
+    return {key[0]: n for key, n in counts.items()}
+
+
+def _count_users_by(querysets, fields, extra=None):
+    """
+    Return a dictionary of the number of distinct users in the union of
+    querysets by the values of fields (field or annotation names), keyed by
+    tuples of those values. The database counts them for one queryset, but
+    a user can be in more than one, so otherwise the distinct rows of values
+    and user id are merged here. extra is a dictionary of sets of user ids by
+    key to merge in, such as from the archive files.
+    """
+    if len(querysets) == 1 and not extra:
+        return {row[:-1]: row[-1] for row in
+                querysets[0].order_by()
+                .values_list(*fields)
+                .annotate(Count('user_id', distinct=True))}
+    users = dict((key, set(ids)) for key, ids in (extra or {}).items())
+    for qs in querysets:
+        for row in (qs.order_by().values_list(*fields + ('user_id',))
+                    .distinct().iterator()):
+            users.setdefault(row[:-1], set()).add(row[-1])
+    return {key: len(ids) for key, ids in users.items()}
+
+
+def iter_keyset(querysets, chunk_size, position=None, reverse=False,
+                archived=None):
+    """
+    Generate tuples (when, source, id, user_id) of the souvenirs in querysets
+    in (when, source, id) order, or the reverse, where source is the table,
+    starting after position, a (when, source, id) tuple. Each queryset is
+    read chunk_size rows per query seeking past the previous chunk on the
+    when index, and they're merged as they're read, so neither the database
+    nor this process holds more than a chunk of each.
+
+    Pass _souvenir_querysets to read the partitions along with Souvenir.
+    With archived, a (start, end) tuple, the archive files between start
+    and end are merged in too, with the file name as source and the row
+    number as id.
+    """
+    sources = [_keyset_rows(qs, chunk_size, position, reverse)
+               for qs in querysets]
+    if archived is not None and archive.enabled():
+        sources.append(_archived_keyset_rows(archived[0], archived[1],
+                                             chunk_size, position, reverse))
+    if not reverse:
+        return heapq.merge(*sources)
+    return (tuple(row) for row in heapq.merge(
+        *[(_Descending(row) for row in rows) for rows in sources]))
+
+
+def _keyset_rows(qs, chunk_size, position, reverse):
+    source = qs.model._meta.db_table
+    order = ('-when', '-id') if reverse else ('when', 'id')
+    qs = qs.order_by(*order).values_list('when', 'id', 'user_id')
+    while True:
+        page = qs if position is None else _after(qs, source, position,
+                                                  reverse)
+        chunk = list(page[:chunk_size].iterator())
+        for when, pk, user_id in chunk:
+            yield when, source, pk, user_id
+        if len(chunk) < chunk_size:
+            return
+        position = chunk[-1][0], source, chunk[-1][1]
+
+
+def _archived_keyset_rows(start, end, chunk_size, position, reverse):
+    months = archive.archived_months()
+    if reverse:
+        months.reverse()
+    start = None if start is None else archive.epoch(start)
+    end = None if end is None else archive.epoch(end)
+    for month in months:
+        path = archive.archive_path(month)
+        source = os.path.basename(path)
+        with archive.MonthArchive(path) as month_archive:
+            first, last = month_archive.span(start, end)
+            if position is not None:
+                # the rows in the position's second and after (or before),
+                # to compare with it below since it may have a fraction
+                second = archive.epoch(position[0])
+                if reverse:
+                    last = min(last, month_archive.span(None, second + 1)[1])
+                else:
+                    first = max(first, month_archive.span(second)[0])
+            steps = range(first, last, chunk_size)
+            for lo in reversed(steps) if reverse else steps:
+                hi = min(lo + chunk_size, last)
+                times, users = month_archive.columns(lo, hi)
+                rows = [(_from_epoch(t), source, lo + i, u)
+                        for i, (t, u) in enumerate(zip(times, users))]
+                for row in reversed(rows) if reverse else rows:
+                    if position is None or (row[:3] < position if reverse
+                                            else row[:3] > position):
+                        yield row
+
+
+def _after(qs, source, position, reverse):
+    """
+    Return qs filtered to the rows of source after position in iter_keyset's
+    order.
+    """
+    when, after_source, pk = position
+    gt, gte = ('lt', 'lte') if reverse else ('gt', 'gte')
+    if source == after_source:
+        return qs.filter(Q(**{'when__' + gt: when}) |
+                         Q(when=when, **{'id__' + gt: pk}))
+    if (source < after_source) != reverse:
+        return qs.filter(**{'when__' + gt: when})
+    return qs.filter(**{'when__' + gte: when})
+
+
+class _Descending(tuple):
+    """
+    Tuple that sorts in reverse, for heapq.merge.
+    """
+
+    def __lt__(self, other):
+        return tuple.__gt__(self, other)
+
+
+def count_active_users_many(periods, qs=None, using=None, sample=None):
+    """
+    Return a list of the number of active users for each of periods, which
+    are (start, end) tuples like the arguments to count_active_users. The
+    periods can be in any order and may overlap. With sample, the counts are
+    Estimates as for count_active_users.
+
+    Rather than a query per period, the souvenirs covering all the periods
+    are read once (one query per hundred disjoint ranges) and split on every
+    period boundary, so overlapping periods share the work.
+    """
+    periods = list(periods)
+    if not periods:
+        return []
+    parts = None if sample is None else _sample_parts(sample)
+
+    bounds = sorted(set(t for p in periods for t in p if t is not None))
+    spans = [(0 if start is None else bisect.bisect_right(bounds, start),
+              len(bounds) if end is None else bisect.bisect_left(bounds, end))
+             for start, end in periods]
+
+    # users active in each segment between consecutive bounds
+    segments = [set() for _ in range(len(bounds) + 1)]
+    ranges = _merge_ranges(p for p in periods if p[0] is None or
+                           p[1] is None or p[0] < p[1])
+    if not ranges:
+        querysets = []
+    else:
+        querysets = _souvenir_querysets(qs, using, ranges[0][0], ranges[-1][1])
+    for souvenirs in querysets:
+        if parts:
+            souvenirs = _sample(souvenirs, parts)
+        for i in range(0, len(ranges), _RANGES_PER_QUERY):
+            q = reduce(operator.or_, (_range_q(*r) for r in
+                                      ranges[i:i + _RANGES_PER_QUERY]))
+            rows = (souvenirs.filter(q).order_by()
+                    .values_list('when', 'user_id').iterator())
+            for when, user_id in rows:
+                segments[bisect.bisect_right(bounds, when)].add(user_id)
+
+    if qs is None and ranges and archive.enabled():
+        # archived times are epoch seconds, so the bounds are too
+        epochs = [archive.epoch(b) for b in bounds]
+        for month, first, last in archive.archives_between(ranges[0][0],
+                                                           ranges[-1][1]):
+            for when, user_id in zip(*month.columns(first, last)):
+                if not parts or user_id % SAMPLE_PARTS < parts:
+                    segments[bisect.bisect_right(epochs, when)].add(user_id)
+
+    counts = [len(set().union(*segments[lo:hi + 1])) if lo <= hi else 0
+              for lo, hi in spans]
+    if parts:
+        counts = [Estimate.scale(c, float(parts) / SAMPLE_PARTS) for c in counts]
+    return counts
+
+
+def _merge_ranges(periods):
+    """
+    Return the union of periods as a sorted list of disjoint (start, end)
+    tuples, where None is unbounded as in count_active_users.
+    """
+    merged = []
+    for start, end in sorted(periods, key=lambda p: (p[0] is not None, p[0])):
+        if merged and (merged[-1][1] is None or start is None or
+                       start <= merged[-1][1]):
+            if merged[-1][1] is not None and (end is None or end > merged[-1][1]):
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _range_q(start, end):
+    q = Q()
+    if start is not None:
+        q &= Q(when__gte=start)
+    if end is not None:
+        q &= Q(when__lt=end)
+    return q
+
+
+def rebuild_user_activity(users=None, batch_size=1000, using=None):
+    """
+    Recompute the UserActivity summary from souvenirs, for all users or only
+    the given users (User objects, PKs or a queryset). Returns the number of
+    users with activity. With SOUVENIRS_STORAGE = 'partitioned' the
+    partitions are read too, and with SOUVENIRS_ARCHIVE_DIR the archive files,
+    whose users are summarized in memory.
+    """
+    if using is None:
+        using = router.db_for_write(UserActivity)
+    activities = UserActivity.objects.using(using)
+    querysets = _souvenir_querysets(None, using)
+    archived = {}
+    if users is not None:
+        user_ids = _user_ids(users, using)
+        activities = activities.filter(user_id__in=user_ids)
+        querysets = [q.filter(user_id__in=user_ids) for q in querysets]
+        if archive.enabled():
+            archived = _archived_activity(set(
+                u['pk'] if isinstance(u, dict) else u for u in user_ids))
+    elif archive.enabled():
+        archived = _archived_activity()
+
+    rows = heapq.merge(*[q.order_by('user_id', 'when')
+                         .values_list('user_id', 'when').iterator()
+                         for q in querysets])
+    count = 0
+    with transaction.atomic(using=using):
+        activities.delete()
+        batch = []
+        for activity in _user_activities(rows, archived):
+            batch.append(activity)
+            if len(batch) >= batch_size:
+                activities.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        activities.bulk_create(batch)
+        count += len(batch)
+    return count
+
+
+def _user_activities(rows, archived):
+    """
+    Generate UserActivity objects from rows of (user_id, when), ordered by
+    user, merged with the summaries from _archived_activity.
+    """
+    for user_id, whens in itertools.groupby(rows, lambda r: r[0]):
+        activity = UserActivity(user_id=user_id)
+        days = set()
+        for _, when in whens:
+            if activity.first_seen is None:
+                activity.first_seen = when
+            activity.last_seen = when
+            activity.souvenir_count += 1
+            days.add(local_date(when))
+        old = archived.pop(user_id, None)
+        if old is not None:
+            activity.first_seen = min(activity.first_seen, _from_epoch(old[0]))
+            activity.last_seen = max(activity.last_seen, _from_epoch(old[1]))
+            activity.souvenir_count += old[2]
+            days.update(old[3])
+        activity.active_days = len(days)
+        yield activity
+    for user_id, (first, last, count, days) in sorted(archived.items()):
+        yield UserActivity(user_id=user_id, first_seen=_from_epoch(first),
+                           last_seen=_from_epoch(last), souvenir_count=count,
+                           active_days=len(days))
+
+
+def _archived_activity(user_ids=None):
+    """
+    Return a dictionary of [first seen, last seen, souvenirs, set of local
+    dates] by user from the archive files, for all users or those in the set
+    user_ids. The times are epoch seconds.
+    """
+    activity = {}
+    # local dates of 15-minute steps, since UTC offsets are whole steps
+    dates = {}
+    for month, first, last in archive.archives_between():
+        times, users = month.columns(first, last)
+        for t, user_id in zip(times, users):
+            if user_ids is not None and user_id not in user_ids:
+                continue
+            step = t - t % 900
+            day = dates.get(step)
+            if day is None:
+                day = dates[step] = local_date(_from_epoch(step))
+            seen = activity.get(user_id)
+            if seen is None:
+                activity[user_id] = [t, t, 1, {day}]
+            else:
+                seen[1] = t
+                seen[2] += 1
+                seen[3].add(day)
+    return activity
+
+
+def _from_epoch(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+def purge_user_souvenirs(user, batch_size=1000, pause=0, using=None):
+    """
+    Delete a user's souvenirs and UserActivity, batch_size souvenirs per
+    transaction, sleeping pause seconds between batches. Returns the number
+    of souvenirs deleted.
+
+    Deleting a user cascades to all of their souvenirs in the one
+    transaction, which for a long history holds locks for a long time. Call
+    this first, outside of any transaction, to delete them in small steps.
+    With SOUVENIRS_STORAGE = 'partitioned' the partitions are purged too.
+    """
+    user_id = getattr(user, 'pk', user)
+    if using is None:
+        using = router.db_for_write(Souvenir)
+    deleted = 0
+    for souvenirs in _souvenir_querysets(None, using):
+        souvenirs = souvenirs.filter(user_id=user_id)
+        while True:
+            pks = list(souvenirs.order_by('pk')
+                       .values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            if deleted and pause:
+                time.sleep(pause)
+            # a range rather than pk__in, which has a parameter per souvenir
+            with transaction.atomic(using=using):
+                souvenirs.filter(pk__gte=pks[0], pk__lte=pks[-1]).delete()
+            deleted += len(pks)
+            logger.debug("purged %s souvenirs for user %s", deleted, user_id)
+    UserActivity.objects.using(using).filter(user_id=user_id).delete()
+    return deleted
+
+
+def rebuild_registration_days(using=None):
+    """
+    Recompute the RegistrationDay table from the users. Returns the number of
+    days with registrations. The users are read as routed, and the table is
+    written to using, or wherever the routers send RegistrationDay writes
+    (SOUVENIRS_DATABASE with SouvenirsRouter).
+    """
+    User = get_user_model()
+    if using is None:
+        using = router.db_for_write(RegistrationDay)
+    joined, activated = Counter(), Counter()
+    users = (User._default_manager.order_by()
+             .values_list('date_joined', 'is_active').iterator())
+    for date_joined, is_active in users:
+        day = local_date(date_joined)
+        joined[day] += 1
+        activated[day] += bool(is_active)
+    with transaction.atomic(using=using):
+        RegistrationDay.objects.using(using).all().delete()
+        RegistrationDay.objects.using(using).bulk_create(
+            RegistrationDay(day=day, joined=n, activated=activated[day])
+            for day, n in sorted(joined.items()))
+    return len(joined)
+
+
+def _update_user_activity(user_id, when, using):
+    """
+    Fold a newly saved souvenir into the user's UserActivity row. Must be
+    called in the same transaction that saved the souvenir.
+    """
+    activity, created = (UserActivity.objects.using(using).select_for_update()
+                         .get_or_create(user_id=user_id, defaults=dict(
+                             first_seen=when,
+                             last_seen=when,
+                             active_days=1,
+                             souvenir_count=1,
+                         )))
+    if created:
+        return
+
+    day = local_date(when)
+    if when >= activity.last_seen:
+        new_day = day != local_date(activity.last_seen)
+    elif when <= activity.first_seen:
+        new_day = day != local_date(activity.first_seen)
+    else:
+        # backfilling into the middle of the history, so look for another
+        # souvenir on the same day.
+        day_start = local_day_start(day)
+        day_end = local_day_start(day + timedelta(days=1))
+        same_day = (partitions.souvenir_model(when, using).objects.using(using)
+                    .filter(user_id=user_id, when__gte=day_start, when__lt=day_end)
+                    .values_list('pk', flat=True))
+        new_day = len(same_day[:2]) == 1
+
+    activity.first_seen = min(activity.first_seen, when)
+    activity.last_seen = max(activity.last_seen, when)
+    activity.active_days += new_day
+    activity.souvenir_count += 1
+    activity.save(using=using)
@@ -0,0 +1,165 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime, timedelta
+import hashlib
+import math
+import struct
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import six, timezone
+from .utils import local_date, local_day_start, next_month
+
+
+# how long counters outlive their period, so the last one can still be read
+GRACE = timedelta(days=1)
+
+# the longest window concurrent_users can look back over
+MAX_MINUTES = 60
+
+# HyperLogLog sketches of 2 ** PRECISION registers, about 3% error
+PRECISION = 10
+
+
+def enabled():
+    return getattr(settings, 'SOUVENIRS_LIVE_COUNTERS', False)
+
+
+def record(user_id, when, added):
+    """
+    Update the live counters for user_id seen at when. The per-day and
+    per-month counts only change for added souvenirs, since the user is
+    already counted for a rate-limited one. The per-minute sketches for
+    concurrent_users change either way.
+    """
+    if not enabled():
+        return
+    cache = _cache()
+    now = timezone.now()
+    if added:
+        for granularity in ('day', 'month'):
+            key, end = _period(granularity, when)
+            ttl = _seconds(end + GRACE - now)
+            if ttl <= 0:
+                continue  # backfilling a period that's gone
+            # the marker makes the count distinct: only the first souvenir of
+            # the period adds it, and only that one increments the counter.
+            if cache.add('{}.{}'.format(key, user_id), 1, ttl):
+                cache.add(key, 0, ttl)
+                try:
+                    cache.incr(key)
+                except ValueError:
+                    # evicted between add and incr
+                    cache.add(key, 1, ttl)
+
+    ttl = _seconds(timedelta(minutes=MAX_MINUTES + 1) - (now - when))
+    if ttl > 0:
+        key = _minute_key(_minute(when))
+        sketch = _Sketch(cache.get(key))
+        if sketch.add(user_id):
+            # races can lose an update here, which costs accuracy but never
+            # counts a user twice.
+            cache.set(key, sketch.dumps(), ttl)
+
+
+def live_active_users(granularity='day', when=None):
+    """
+    Return the number of distinct users with souvenirs in the current day or
+    month (granularity 'day' or 'month') of the default timezone, or the one
+    containing when. This reads a counter from the cache, never the
+    database, so it's 0 if SOUVENIRS_LIVE_COUNTERS wasn't on for the period
+    or the counter was evicted.
+    """
+    key, _ = _period(granularity, when or timezone.now())
+    return _cache().get(key) or 0
+
+
+def concurrent_users(minutes=5):
+    """
+    Return an estimate of the number of distinct users seen by souvenez in
+    the last minutes, from per-minute sketches in the cache.
+    """
+    if not 0 < minutes <= MAX_MINUTES:
+        raise ValueError("minutes must be between 1 and {}".format(MAX_MINUTES))
+    now = _minute(timezone.now())
+    keys = [_minute_key(m) for m in range(now - minutes + 1, now + 1)]
+    sketch = _Sketch()
+    for data in _cache().get_many(keys).values():
+        sketch.update(_Sketch(data))
+    return sketch.estimate()
+
+
+def _cache():
+    return caches[getattr(settings, 'SOUVENIRS_CACHE_NAME', 'default')]
+
+
+def _prefix():
+    return '{}.live'.format(getattr(settings, 'SOUVENIRS_CACHE_PREFIX', 'souvenir.'))
+
+
+def _period(granularity, when):
+    day = local_date(when)
+    if granularity == 'day':
+        return ('{}.day.{}'.format(_prefix(), day.isoformat()),
+                local_day_start(day + timedelta(days=1)))
+    if granularity == 'month':
+        first = day.replace(day=1)
+        return ('{}.month.{:%Y-%m}'.format(_prefix(), first),
+                local_day_start(next_month(first)))
+    raise ValueError("unknown granularity: {}".format(granularity))
+
+
+def _minute(when):
+    epoch = datetime(1970, 1, 1)
+    if timezone.is_aware(when):
+        epoch = epoch.replace(tzinfo=timezone.utc)
+    return _seconds(when - epoch) // 60
+
+
+def _minute_key(minute):
+    return '{}.minute.{}'.format(_prefix(), minute)
+
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds
+
+
+class _Sketch(object):
+    """
+    HyperLogLog sketch of a set of user ids, kept as bytes so that it caches
+    compactly: one byte register each.
+    """
+    M = 1 << PRECISION
+
+    def __init__(self, data=None):
+        self.registers = bytearray(data or self.M)
+
+    def add(self, user_id):
+        """
+        Add user_id, returning whether the sketch changed.
+        """
+        digest = hashlib.md5(six.text_type(user_id).encode('utf-8')).digest()
+        h = struct.unpack(str('<Q'), digest[:8])[0]
+        index = h >> (64 - PRECISION)
+        rest = h & ((1 << (64 - PRECISION)) - 1)
+        rank = (64 - PRECISION) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def update(self, other):
+        for i, r in enumerate(other.registers):
+            if r > self.registers[i]:
+                self.registers[i] = r
+
+    def estimate(self):
+        alpha = 0.7213 / (1 + 1.079 / self.M)
+        raw = alpha * self.M ** 2 / sum(2.0 ** -r for r in self.registers)
+        zeros = sum(1 for r in self.registers if not r)
+        if raw <= 2.5 * self.M and zeros:
+            # linear counting is more accurate for small sets
+            return int(round(self.M * math.log(float(self.M) / zeros)))
+        return int(round(raw))
+
+    def dumps(self):
+        return bytes(self.registers)
@@ -1,10 +1,17 @@
 from __future__ import absolute_import, unicode_literals
 
+import dateutil.tz
 from django.core.management.base import CommandError
 from django.core.management.base import BaseCommand, CommandError
-from souvenirs.reports import (daily_usage, customer_monthly_usage,
-                               customer_quarterly_usage, customer_yearly_usage)
-from ._helpers import DateAction
+from django.utils import timezone
+from souvenirs.reports import (activity_heatmap, daily_usage, customer_monthly_usage,
+                               customer_quarterly_usage, customer_yearly_usage,
+                               cohort_retention, rolling_active_users, UsageRow,
+                               engagement_histogram, engagement_ranges,
+                               ENGAGEMENT_BUCKETS, label_engagement,
+                               label_year_month_m)
+from souvenirs.utils import iter_months
+from ._helpers import DateAction, int_list
 
 
 class ReportCommand(BaseCommand):
@@ -25,6 +32,24 @@ class ReportCommand(BaseCommand):
                             help="report on quarterly activity")
         parser.add_argument('--yearly', action='store_const', dest='report', const='yearly',
                             help="report on yearly activity")
+        parser.add_argument('--cohorts', action='store_const', dest='report', const='cohorts',
+                            help="report on monthly retention of registration cohorts")
+        parser.add_argument('--rolling', metavar='DAYS', type=int,
+                            help="report daily on activity in the trailing DAYS")
+        parser.add_argument('--engagement', action='store_const', dest='report', const='engagement',
+                            help="report monthly on users by number of days active")
+        parser.add_argument('--buckets', metavar='DAYS,...', type=int_list,
+                            default=ENGAGEMENT_BUCKETS,
+                            help="lower bounds of the --engagement buckets "
+                                 "(default: {})".format(
+                                     ','.join(map(str, ENGAGEMENT_BUCKETS))))
+        parser.add_argument('--heatmap', action='store_const', dest='report', const='heatmap',
+                            help="report active users by weekday and hour")
+        parser.add_argument('--timezone', metavar='NAME',
+                            help="timezone of the --heatmap hours (default: "
+                                 "TIME_ZONE)")
+        parser.add_argument('--souvenirs', action='store_true',
+                            help="count souvenirs rather than users for --heatmap")
 
         parser.add_argument('--recent', nargs='?', const=1, type=int, metavar='NUM',
                             help="show only the most recent N (1) entries")
@@ -32,16 +57,30 @@ class ReportCommand(BaseCommand):
                             help="output in date-ascending order (default: descending)")
         parser.add_argument('--datefmt', default='%Y-%m-%d',
                             help="strftime for date columns (default: %%Y-%%m-%%d)")
+        parser.add_argument('--database',
+                            help="database alias to report from (default: routed)")
 
     def handle(self, *args, **options):
         report = options['report'] or 'monthly'
+        if options['rolling'] is not None:
+            report = 'rolling'
+            if options['rolling'] < 1:
+                raise CommandError("--rolling requires at least one day")
 
-        if (report in ['daily', 'monthly', 'quarterly', 'yearly'] and
+        if (report in ['daily', 'monthly', 'quarterly', 'yearly', 'cohorts',
+                       'engagement'] and
             options['subscription_start'] is None
         ):
             raise CommandError("{} report requires --subscription-start"
                                .format(report))
 
+        if (report in ['rolling', 'heatmap'] and
+            options['after'] is None and
+            options['subscription_start'] is None
+        ):
+            raise CommandError("{} report requires --after or "
+                               "--subscription-start".format(report))
+
         report_method = getattr(self, '{}_report'.format(report))
         headers, rows = report_method(options)
 
@@ -50,7 +89,8 @@ class ReportCommand(BaseCommand):
 
         # reports are chronologically ascending by default (mainly because of
         # enumerations), but for display we prefer reversed by default.
-        if not options['ascending']:
+        # The heatmap's rows are weekdays, which stay in order.
+        if not options['ascending'] and report != 'heatmap':
             rows = reversed(rows)
 
         return headers, rows
@@ -61,13 +101,14 @@ class ReportCommand(BaseCommand):
             subscription_start=options['subscription_start'],
             start=options['after'],
             end=options['before'],
+            using=options['database'],
         )
         rows = [
-            [d['period']['end'].strftime(options['datefmt']),
-             d['usage']['registered_users'],
-             d['usage']['activated_users'],
-             d['usage']['active_users'],
-            ] for d in usage
+            [d.end.strftime(options['datefmt']),
+             d.registered_users,
+             d.activated_users,
+             d.active_users,
+            ] for d in map(UsageRow.coerce, usage)
         ]
         return headers, rows
 
@@ -77,15 +118,16 @@ class ReportCommand(BaseCommand):
             subscription_start=options['subscription_start'],
             start=options['after'],
             end=options['before'],
+            using=options['database'],
         )
         rows = [
-            [d['labels']['year_month'],
-             d['period']['start'].strftime(options['datefmt']),
-             d['period']['end'].strftime(options['datefmt']),
-             d['usage']['registered_users'],
-             d['usage']['activated_users'],
-             d['usage']['active_users'],
-            ] for d in usage
+            [d.labels['year_month'],
+             d.start.strftime(options['datefmt']),
+             d.end.strftime(options['datefmt']),
+             d.registered_users,
+             d.activated_users,
+             d.active_users,
+            ] for d in map(UsageRow.coerce, usage)
         ]
         return headers, rows
 
@@ -95,15 +137,16 @@ class ReportCommand(BaseCommand):
             subscription_start=options['subscription_start'],
             start=options['after'],
             end=options['before'],
+            using=options['database'],
         )
         rows = [
-            [d['labels']['year_quarter'],
-             d['period']['start'].strftime(options['datefmt']),
-             d['period']['end'].strftime(options['datefmt']),
-             d['usage']['registered_users'],
-             d['usage']['activated_users'],
-             d['usage']['active_users'],
-            ] for d in usage
+            [d.labels['year_quarter'],
+             d.start.strftime(options['datefmt']),
+             d.end.strftime(options['datefmt']),
+             d.registered_users,
+             d.activated_users,
+             d.active_users,
+            ] for d in map(UsageRow.coerce, usage)
         ]
         return headers, rows
 
@@ -113,14 +156,93 @@ class ReportCommand(BaseCommand):
             subscription_start=options['subscription_start'],
             start=options['after'],
             end=options['before'],
+            using=options['database'],
+        )
+        rows = [
+            [d.labels['year'],
+             d.start.strftime(options['datefmt']),
+             d.end.strftime(options['datefmt']),
+             d.registered_users,
+             d.activated_users,
+             d.active_users,
+            ] for d in map(UsageRow.coerce, usage)
+        ]
+        return headers, rows
+
+    def cohorts_report(self, options):
+        usage = list(cohort_retention(
+            subscription_start=options['subscription_start'],
+            start=options['after'],
+            end=options['before'],
+            using=options['database'],
+        ))
+        months = len(usage)
+        headers = ['month', 'start', 'registered'] + [
+            'M+{}'.format(m) for m in range(months)]
+        rows = [
+            [d.labels['year_month'],
+             d.start.strftime(options['datefmt']),
+             d.registered_users,
+            ] + d.active_users + [''] * c
+            for c, d in enumerate(usage)
+        ]
+        return headers, rows
+
+    def rolling_report(self, options):
+        headers = ['date', 'active']
+        usage = rolling_active_users(
+            start=options['after'] or options['subscription_start'],
+            end=options['before'],
+            window=options['rolling'],
+            using=options['database'],
         )
         rows = [
-            [d['labels']['year'],
-             d['period']['start'].strftime(options['datefmt']),
-             d['period']['end'].strftime(options['datefmt']),
-             d['usage']['registered_users'],
-             d['usage']['activated_users'],
-             d['usage']['active_users'],
+            [d.end.strftime(options['datefmt']),
+             d.active_users,
             ] for d in usage
         ]
         return headers, rows
+
+    def engagement_report(self, options):
+        try:
+            ranges = engagement_ranges(options['buckets'])
+        except ValueError as e:
+            raise CommandError(e)
+        headers = ['month', 'start', 'end'] + [
+            label_engagement(low, high) for low, high in ranges]
+
+        start = options['after'] or options['subscription_start']
+        periods = iter_months(start=options['subscription_start'],
+                              end=options['before'] or timezone.now())
+        rows = []
+        for m, (period_start, period_end) in enumerate(periods, 1):
+            if period_end <= start:
+                continue
+            histogram = engagement_histogram(period_start, period_end,
+                                             buckets=options['buckets'],
+                                             using=options['database'])
+            rows.append(
+                [label_year_month_m(m),
+                 period_start.strftime(options['datefmt']),
+                 period_end.strftime(options['datefmt']),
+                ] + [users for _, _, users in histogram])
+        return headers, rows
+
+    def heatmap_report(self, options):
+        tz = None
+        if options['timezone']:
+            tz = dateutil.tz.gettz(options['timezone'])
+            if tz is None:
+                raise CommandError("unknown timezone: {}".format(
+                    options['timezone']))
+        headers = ['day'] + ['{:02d}'.format(h) for h in range(24)]
+        matrix = activity_heatmap(
+            start=options['after'] or options['subscription_start'],
+            end=options['before'] or timezone.now(),
+            tz=tz,
+            distinct_users=not options['souvenirs'],
+            using=options['database'],
+        )
+        days = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+        rows = [[day] + hours for day, hours in zip(days, matrix)]
+        return headers, rows
@@ -18,3 +18,13 @@ class DateAction(argparse.Action):
         if dt.tzinfo is None:
             dt = timezone.make_aware(dt)
         setattr(namespace, self.dest, dt)
+
+
+def int_list(value):
+    """
+    argparse type for a comma-separated list of integers
+    """
+    try:
+        return [int(v) for v in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("not a list of integers: {}".format(value))
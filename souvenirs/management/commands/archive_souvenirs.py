@@ -0,0 +1,44 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from souvenirs import archive
+from souvenirs.control import _souvenir_querysets
+from souvenirs.utils import local_date, next_month
+from ._helpers import DateAction
+
+
+class Command(BaseCommand):
+    help = ("Moves closed months of souvenirs from the database to archive "
+            "files in SOUVENIRS_ARCHIVE_DIR")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', metavar='DATE', action=DateAction,
+                            help="archive the months ending at or before DATE "
+                                 "(default: a year ago)")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="souvenirs per DELETE (default: 1000)")
+        parser.add_argument('--database',
+                            help="database alias to archive from (default: routed)")
+
+    def handle(self, *args, **options):
+        if not archive.enabled():
+            raise CommandError("SOUVENIRS_ARCHIVE_DIR isn't set")
+        before = min(options['before'] or timezone.now() - timedelta(days=365),
+                     timezone.now())
+
+        # the oldest souvenir in the table or the partitions
+        oldest = [qs.order_by('when').values_list('when', flat=True).first()
+                  for qs in _souvenir_querysets(None, options['database'])]
+        oldest = [when for when in oldest if when is not None]
+        if not oldest:
+            return
+        month = local_date(min(oldest)).replace(day=1)
+        while archive.month_range(month)[1] <= before:
+            moved = archive.archive_month(month, using=options['database'],
+                                          batch_size=options['batch_size'])
+            if moved:
+                self.stdout.write("archived {} souvenirs from {:%Y-%m}".format(
+                    moved, month))
+            month = next_month(month)
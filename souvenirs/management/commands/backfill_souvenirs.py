@@ -0,0 +1,43 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.exceptions import FieldDoesNotExist
+from django.core.management.base import BaseCommand, CommandError
+from souvenirs.control import backfill_souvenirs, rebuild_user_activity
+
+
+class Command(BaseCommand):
+    help = ("Seeds souvenirs from the users' date_joined and last_login, "
+            "for new installs")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--field', action='append', dest='fields',
+                            metavar='FIELD',
+                            help="user DateTimeField to seed from, may be "
+                                 "repeated (default: date_joined and "
+                                 "last_login, or none with --sql)")
+        parser.add_argument('--sql',
+                            help="SELECT of more souvenirs, with the columns "
+                                 "user_id and seen")
+        parser.add_argument('--chunk-size', type=int, default=100000,
+                            help="users per INSERT (default: 100000)")
+        parser.add_argument('--rebuild-activity', action='store_true',
+                            help="rebuild the UserActivity summary afterward")
+        parser.add_argument('--database',
+                            help="database alias to backfill (default: routed)")
+
+    def handle(self, *args, **options):
+        fields = options['fields']
+        if fields is None:
+            fields = () if options['sql'] else ('date_joined', 'last_login')
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be positive")
+        try:
+            added = backfill_souvenirs(fields=fields, sql=options['sql'],
+                                       chunk_size=options['chunk_size'],
+                                       using=options['database'])
+        except (FieldDoesNotExist, ValueError) as e:
+            raise CommandError(e)
+        self.stdout.write("added {} souvenirs".format(added))
+        if options['rebuild_activity']:
+            count = rebuild_user_activity(using=options['database'])
+            self.stdout.write("rebuilt activity for {} users".format(count))
@@ -0,0 +1,122 @@
+from __future__ import absolute_import, unicode_literals
+
+import gzip
+import json
+import os
+import dateutil.parser
+from django.core.management.base import BaseCommand, CommandError
+from souvenirs.control import _souvenir_querysets, iter_keyset
+from souvenirs.models import Souvenir
+from ._helpers import DateAction
+
+
+class Command(BaseCommand):
+    help = ("Exports raw souvenirs as CSV or NDJSON, oldest first, including "
+            "those in partitions and archive files")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--after', metavar='DATE', action=DateAction,
+                            help="include souvenirs at or after (inclusive)")
+        parser.add_argument('--before', metavar='DATE', action=DateAction,
+                            help="include souvenirs before (exclusive)")
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv',
+                            help="output format (default: csv)")
+        parser.add_argument('--output', metavar='FILE',
+                            help="write to FILE instead of stdout")
+        parser.add_argument('--gzip', action='store_true',
+                            help="gzip the output, requires --output")
+        parser.add_argument('--cursor', metavar='FILE',
+                            help="resume after the position saved in FILE, and "
+                                 "save the position there as the export goes")
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help="souvenirs per query (default: 10000)")
+        parser.add_argument('--database',
+                            help="database alias to export from (default: routed)")
+
+    def handle(self, *args, **options):
+        if options['gzip'] and not options['output']:
+            raise CommandError("--gzip requires --output")
+
+        position = self.read_cursor(options['cursor'])
+        resuming = position is not None
+
+        querysets = []
+        for qs in _souvenir_querysets(None, options['database'],
+                                      options['after'], options['before']):
+            if options['after']:
+                qs = qs.filter(when__gte=options['after'])
+            if options['before']:
+                qs = qs.filter(when__lt=options['before'])
+            querysets.append(qs)
+
+        write, flush, close = self.open_output(options, append=resuming)
+        try:
+            if options['format'] == 'csv' and not resuming:
+                write('user_id,when\n')
+            format_row = getattr(self, 'format_{}'.format(options['format']))
+            chunk_size = options['chunk_size']
+            written = 0
+            rows = iter_keyset(querysets, chunk_size, position,
+                               archived=(options['after'], options['before']))
+            for when, source, pk, user_id in rows:
+                write(format_row(user_id, when))
+                written += 1
+                if written % chunk_size == 0:
+                    flush()
+                    self.write_cursor(options['cursor'], when, source, pk)
+            if written % chunk_size:
+                flush()
+                self.write_cursor(options['cursor'], when, source, pk)
+        finally:
+            close()
+
+    @staticmethod
+    def format_csv(user_id, when):
+        return '{},{}\n'.format(user_id, when.isoformat())
+
+    @staticmethod
+    def format_ndjson(user_id, when):
+        return json.dumps({'user_id': user_id, 'when': when.isoformat()}) + '\n'
+
+    def open_output(self, options, append):
+        """
+        Return (write, flush, close) functions for the output.
+        """
+        if not options['output']:
+            return (lambda s: self.stdout.write(s, ending=''),
+                    self.stdout.flush,
+                    lambda: None)
+
+        f = open(options['output'], 'ab' if append else 'wb')
+        if not options['gzip']:
+            return (lambda s: f.write(s.encode('utf-8')), f.flush, f.close)
+
+        # appending starts a new gzip member, which gunzip handles
+        z = gzip.GzipFile(fileobj=f, mode='ab' if append else 'wb')
+
+        def flush():
+            z.flush()
+            f.flush()
+
+        def close():
+            z.close()
+            f.close()
+
+        return (lambda s: z.write(s.encode('utf-8')), flush, close)
+
+    def read_cursor(self, path):
+        if not path or not os.path.exists(path):
+            return None
+        with open(path) as f:
+            cursor = json.load(f)
+        # cursors from before partitions have no source
+        return (dateutil.parser.parse(cursor['when']),
+                cursor.get('source', Souvenir._meta.db_table),
+                cursor['id'])
+
+    def write_cursor(self, path, when, source, pk):
+        if not path:
+            return
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'when': when.isoformat(), 'source': source, 'id': pk}, f)
+        os.rename(path + '.tmp', path)
@@ -0,0 +1,124 @@
+from __future__ import absolute_import, unicode_literals
+
+import csv
+import gzip
+import io
+import itertools
+import json
+import sys
+import dateutil.parser
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import six, timezone
+from souvenirs.control import bulk_souvenez
+
+
+# how many usernames to look up per query
+USERNAMES_PER_QUERY = 500
+
+
+class Command(BaseCommand):
+    help = "Imports souvenirs from CSV or NDJSON, for backfilling"
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', metavar='FILE',
+                            help="file to import, or - for stdin. Each record "
+                                 "has a user_id or username, and a when")
+        parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv',
+                            help="input format (default: csv)")
+        parser.add_argument('--gzip', action='store_true',
+                            help="the input is gzipped")
+        parser.add_argument('--ratelimit', metavar='SECONDS', type=int,
+                            default=0,
+                            help="drop a user's souvenirs less than SECONDS "
+                                 "after the last one imported (default: 0)")
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help="records per duplicate check (default: 10000)")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="rows per INSERT (default: 1000)")
+        parser.add_argument('--database',
+                            help="database alias to import to (default: routed)")
+
+    def handle(self, *args, **options):
+        if options['file'] == '-':
+            f = getattr(sys.stdin, 'buffer', sys.stdin)
+        else:
+            f = open(options['file'], 'rb')
+        try:
+            if options['gzip']:
+                f = gzip.GzipFile(fileobj=f, mode='rb')
+            rows = getattr(self, 'read_{}'.format(options['format']))(f)
+            records = self.resolve_users(rows, options['chunk_size'])
+            results = bulk_souvenez(records,
+                                    ratelimit=options['ratelimit'],
+                                    chunk_size=options['chunk_size'],
+                                    batch_size=options['batch_size'],
+                                    using=options['database'])
+        finally:
+            if options['file'] != '-':
+                f.close()
+        self.stdout.write(
+            "added {}, duplicated {}, rate-limited {}, unknown users {}".format(
+                results['added'], results['duplicated'],
+                results['rate-limited'], self.unknown))
+
+    @staticmethod
+    def read_csv(f):
+        if six.PY2:
+            rows = ([c.decode('utf-8') for c in row] for row in csv.reader(f))
+        else:
+            rows = csv.reader(io.TextIOWrapper(f, encoding='utf-8', newline=''))
+        header = next(rows, [])
+        for row in rows:
+            yield dict(zip(header, row))
+
+    @staticmethod
+    def read_ndjson(f):
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode('utf-8'))
+
+    def resolve_users(self, rows, chunk_size):
+        """
+        Generate (user PK, when) from rows, which are dicts with a user_id or
+        username and a when. Usernames are looked up a chunk at a time, and
+        records for unknown usernames are counted in self.unknown and dropped.
+        """
+        User = get_user_model()
+        to_pk = User._meta.pk.to_python
+        usernames = {}
+        self.unknown = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            wanted = sorted(set(r['username'] for r in chunk
+                                if not r.get('user_id') and r.get('username')
+                                and r['username'] not in usernames))
+            for i in range(0, len(wanted), USERNAMES_PER_QUERY):
+                batch = wanted[i:i + USERNAMES_PER_QUERY]
+                usernames.update((u, None) for u in batch)
+                usernames.update(User._default_manager
+                                 .filter(**{User.USERNAME_FIELD + '__in': batch})
+                                 .values_list(User.USERNAME_FIELD, 'pk'))
+            for r in chunk:
+                if r.get('user_id'):
+                    user_id = to_pk(r['user_id'])
+                else:
+                    user_id = usernames.get(r.get('username'))
+                if user_id is None:
+                    self.unknown += 1
+                    continue
+                yield user_id, self.parse_when(r.get('when'))
+
+    @staticmethod
+    def parse_when(value):
+        try:
+            when = dateutil.parser.parse(value)
+        except (AttributeError, TypeError, ValueError):
+            raise CommandError("can't parse date: {}".format(value))
+        if when.tzinfo is None:
+            when = timezone.make_aware(when)
+        return when
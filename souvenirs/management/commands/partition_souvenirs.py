@@ -0,0 +1,48 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from souvenirs import partitions
+from souvenirs.utils import next_month
+from ._helpers import DateAction
+
+
+class Command(BaseCommand):
+    help = ("Creates monthly souvenir partitions ahead of time, and drops old "
+            "ones, for SOUVENIRS_STORAGE = 'partitioned'")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', metavar='MONTHS', type=int, default=1,
+                            help="create partitions for this month and MONTHS "
+                                 "after it (default: 1)")
+        parser.add_argument('--drop-before', metavar='DATE', action=DateAction,
+                            help="drop the partitions of months ending at or "
+                                 "before DATE, with all of their souvenirs")
+        parser.add_argument('--list', action='store_true',
+                            help="list the partitions")
+        parser.add_argument('--database',
+                            help="database alias of the partitions (default: routed)")
+
+    def handle(self, *args, **options):
+        if not partitions.enabled():
+            raise CommandError("SOUVENIRS_STORAGE isn't 'partitioned'")
+        using = options['database']
+
+        month = partitions.partition_month(timezone.now())
+        for _ in range(options['ahead'] + 1):
+            if partitions.create_partition(month, using=using):
+                self.stdout.write("created {}".format(
+                    partitions.partition_table(month)))
+            month = next_month(month)
+
+        if options['drop_before']:
+            for month in partitions.list_partitions(using=using):
+                if partitions.partition_range(month)[1] > options['drop_before']:
+                    break
+                partitions.drop_partition(month, using=using)
+                self.stdout.write("dropped {}".format(
+                    partitions.partition_table(month)))
+
+        if options['list']:
+            for month in partitions.list_partitions(using=using):
+                self.stdout.write(partitions.partition_table(month))
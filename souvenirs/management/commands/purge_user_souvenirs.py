@@ -0,0 +1,44 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from souvenirs.control import purge_user_souvenirs
+
+
+class Command(BaseCommand):
+    help = "Deletes users' souvenirs in batches, for example before deleting them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('users', metavar='USER', nargs='+',
+                            help="username, or PK with --pk")
+        parser.add_argument('--pk', action='store_true',
+                            help="USER arguments are PKs rather than usernames")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="souvenirs per DELETE (default: 1000)")
+        parser.add_argument('--pause', metavar='SECONDS', type=float, default=0,
+                            help="sleep between batches (default: 0)")
+        parser.add_argument('--delete-users', action='store_true',
+                            help="delete the users afterward")
+        parser.add_argument('--database',
+                            help="database alias to purge (default: routed)")
+
+    def handle(self, *args, **options):
+        User = get_user_model()
+        field = 'pk' if options['pk'] else User.USERNAME_FIELD
+        users = []
+        for name in options['users']:
+            try:
+                users.append(User._default_manager.get(**{field: name}))
+            except (User.DoesNotExist, ValueError):
+                raise CommandError("no such user: {}".format(name))
+
+        for user in users:
+            count = purge_user_souvenirs(user,
+                                         batch_size=options['batch_size'],
+                                         pause=options['pause'],
+                                         using=options['database'])
+            self.stdout.write("purged {} souvenirs for {}".format(
+                count, user.get_username()))
+            if options['delete_users']:
+                user.delete()
+                self.stdout.write("deleted {}".format(user.get_username()))
@@ -0,0 +1,16 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand
+from souvenirs.control import rebuild_registration_days
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the per-day registration counts from users"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database',
+                            help="database alias to rebuild (default: routed)")
+
+    def handle(self, *args, **options):
+        count = rebuild_registration_days(using=options['database'])
+        self.stdout.write("rebuilt registrations for {} days".format(count))
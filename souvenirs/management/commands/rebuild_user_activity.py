@@ -0,0 +1,19 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand
+from souvenirs.control import rebuild_user_activity
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the per-user activity summary from souvenirs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="rows per INSERT (default: 1000)")
+        parser.add_argument('--database',
+                            help="database alias to rebuild (default: routed)")
+
+    def handle(self, *args, **options):
+        count = rebuild_user_activity(batch_size=options['batch_size'],
+                                      using=options['database'])
+        self.stdout.write("rebuilt activity for {} users".format(count))
@@ -1,10 +1,147 @@
 from __future__ import absolute_import, unicode_literals
 
-from souvenirs.control import souvenez
+from datetime import datetime
+import logging
+import re
+import threading
+import time
+from django.conf import settings
+from django.core.signals import request_finished
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from souvenirs.control import _souvenez_window, souvenez
+
+
+logger = logging.getLogger(__name__)
 
 
 class SouvenirsMiddleware(object):
+    """
+    Call souvenez for each request by an authenticated user, except for
+    SOUVENIRS_EXCLUDE_PATHS (regexes matched against the path) and
+    SOUVENIRS_EXCLUDE_METHODS.
+
+    With SOUVENIRS_USE_SESSION, the start of the rate-limit window of the
+    last souvenez call is kept in the session, and souvenez isn't called at
+    all while that window lasts. For a souvenir rate-limited by another
+    session (on a second device, say) that's the time of the other session's
+    souvenir, so the window ends when souvenez's would.
+
+    SOUVENIRS_TENANT_RESOLVER is an optional dotted path to a function taking
+    the request and returning the tenant (site or organization) to record
+    with the souvenir, or None.
+
+    With SOUVENIRS_DEFER_WRITES, the request only notes the souvenir, and
+    souvenez runs once the response has been sent, when the server closes
+    it, so the rate-limit lookup and INSERT don't hold up the response. An
+    exception from the deferred souvenez is logged and otherwise ignored.
+    The session (with SOUVENIRS_USE_SESSION) is saved before the outcome is
+    known, so it's marked when the souvenir is deferred. The souvenirs wait
+    in a thread local for the request_finished signal, which Django sends
+    when the server closes the response.
+    """
+    session_key = '_souvenirs_last_seen'
+    tenant_session_key = '_souvenirs_last_tenant'
 
     def process_request(self, request):
-        if request.user.is_authenticated():
-            souvenez(request.user)
+        if not request.user.is_authenticated():
+            return
+        if self.is_excluded(request):
+            return
+
+        tenant = self.resolve_tenant(request)
+        session = None
+        if getattr(settings, 'SOUVENIRS_USE_SESSION', False):
+            session = getattr(request, 'session', None)
+        now = time.time()
+        if session is not None and self.seen_recently(session, now, tenant):
+            return
+
+        if getattr(settings, 'SOUVENIRS_DEFER_WRITES', False):
+            request._souvenirs_deferred = DeferredSouvenir(
+                request.user, timezone.now(), tenant)
+            if session is not None:
+                session[self.session_key] = now
+                session[self.tenant_session_key] = tenant
+            return
+
+        when = _datetime(now)
+        since = _souvenez_window(request.user, when=when, tenant=tenant)[1]
+        if since is not None and session is not None:
+            session[self.session_key] = now - (when - since).total_seconds()
+            session[self.tenant_session_key] = tenant
+
+    def process_response(self, request, response):
+        deferred = getattr(request, '_souvenirs_deferred', None)
+        if deferred is not None:
+            # the response is closed in the thread that handled the request
+            if not hasattr(_pending, 'souvenirs'):
+                _pending.souvenirs = []
+            _pending.souvenirs.append(deferred)
+        return response
+
+    def resolve_tenant(self, request):
+        resolver = getattr(settings, 'SOUVENIRS_TENANT_RESOLVER', None)
+        if not resolver:
+            return None
+        return import_string(resolver)(request)
+
+    def is_excluded(self, request):
+        methods = getattr(settings, 'SOUVENIRS_EXCLUDE_METHODS', ())
+        if methods and request.method in methods:
+            return True
+        paths = getattr(settings, 'SOUVENIRS_EXCLUDE_PATHS', ())
+        return any(re.match(p, request.path_info) for p in paths)
+
+    def seen_recently(self, session, now, tenant=None):
+        last_seen = session.get(self.session_key)
+        if last_seen is None or last_seen > now:
+            return False
+        if session.get(self.tenant_session_key) != tenant:
+            return False
+        window = getattr(settings, 'SOUVENIRS_RATELIMIT_SECONDS', 3600)
+        if getattr(settings, 'SOUVENIRS_STORAGE', 'rows') == 'bucketed':
+            # fixed windows, so only skip until the end of the bucket
+            return last_seen // window == now // window
+        return now < last_seen + window
+
+
+def _datetime(timestamp):
+    """
+    Return the datetime of timestamp, like timezone.now() returns.
+    """
+    if settings.USE_TZ:
+        return datetime.fromtimestamp(timestamp, timezone.utc)
+    return datetime.fromtimestamp(timestamp)
+
+
+# deferred souvenirs of this thread's responses, until they're closed
+_pending = threading.local()
+
+
+@receiver(request_finished)
+def _write_deferred(**kwargs):
+    deferred = getattr(_pending, 'souvenirs', None)
+    if deferred:
+        _pending.souvenirs = []
+        for d in deferred:
+            d.close()
+
+
+class DeferredSouvenir(object):
+    """
+    A souvenez call waiting for the response to close.
+    """
+
+    def __init__(self, user, when, tenant=None):
+        self.user = user
+        self.when = when
+        self.tenant = tenant
+
+    def close(self):
+        try:
+            souvenez(self.user, when=self.when, tenant=self.tenant)
+        except Exception:
+            logger.exception("deferred souvenir for %s failed",
+                             getattr(self.user, 'pk', self.user))
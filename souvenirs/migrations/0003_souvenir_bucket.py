@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('souvenirs', '0002_useractivity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='souvenir',
+            name='bucket',
+            field=models.BigIntegerField(blank=True, null=True, editable=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='souvenir',
+            unique_together=set([('user', 'bucket')]),
+        ),
+    ]
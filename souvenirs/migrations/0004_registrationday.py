@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('souvenirs', '0003_souvenir_bucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistrationDay',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('day', models.DateField(unique=True)),
+                ('joined', models.IntegerField(default=0)),
+                ('activated', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['day'],
+            },
+        ),
+    ]
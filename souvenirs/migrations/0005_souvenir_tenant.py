@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('souvenirs', '0004_registrationday'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='souvenir',
+            name='tenant',
+            field=models.CharField(max_length=100, blank=True, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='souvenir',
+            index_together=set([('tenant', 'when')]),
+        ),
+    ]
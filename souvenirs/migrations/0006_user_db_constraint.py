@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('souvenirs', '0005_souvenir_tenant'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='souvenir',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=models.DO_NOTHING, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='useractivity',
+            name='user',
+            field=models.OneToOneField(db_constraint=False, on_delete=models.DO_NOTHING, primary_key=True, related_name='souvenir_activity', serialize=False, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
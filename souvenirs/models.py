@@ -11,11 +11,63 @@ class Souvenir(models.Model):
     """
     One instance of seeing an active user
     """
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    # No constraint, so that the souvenirs can be in another database than
+    # the users (SOUVENIRS_DATABASE). They're deleted with the user by
+    # signals.user_post_delete_souvenirs instead of cascading.
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING,
+                             db_constraint=False)
     when = models.DateTimeField(default=timezone.now, db_index=True)
 
+    # epoch seconds of the rate-limit bucket, only with SOUVENIRS_STORAGE =
+    # 'bucketed'. Otherwise null, which doesn't take part in the uniqueness.
+    bucket = models.BigIntegerField(null=True, blank=True, editable=False)
+
+    # optional site or organization the user was active on, from
+    # SOUVENIRS_TENANT_RESOLVER
+    tenant = models.CharField(max_length=100, null=True, blank=True)
+
     class Meta:
         ordering = ['-when']
+        unique_together = [('user', 'bucket')]
+        index_together = [('tenant', 'when')]
 
     def __str__(self):
         return 'user={} when={}'.format(self.user_id, self.when)
+
+
+@python_2_unicode_compatible
+class UserActivity(models.Model):
+    """
+    Summary of a user's souvenirs, maintained by souvenez
+    """
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.DO_NOTHING,
+                                db_constraint=False, primary_key=True,
+                                related_name='souvenir_activity')
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField(db_index=True)
+    active_days = models.PositiveIntegerField(default=0)
+    souvenir_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'user activity'
+
+    def __str__(self):
+        return 'user={} last_seen={}'.format(self.user_id, self.last_seen)
+
+
+@python_2_unicode_compatible
+class RegistrationDay(models.Model):
+    """
+    Users registered on a day (in the default timezone) and how many of them
+    are active, maintained from User signals with SOUVENIRS_REGISTRATION_DAYS
+    """
+    day = models.DateField(unique=True)
+    joined = models.IntegerField(default=0)
+    activated = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ['day']
+
+    def __str__(self):
+        return 'day={} joined={} activated={}'.format(
+            self.day, self.joined, self.activated)
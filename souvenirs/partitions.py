@@ -0,0 +1,171 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import date
+import re
+import time
+from django.apps.registry import Apps
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, connections, models, router
+from django.dispatch import receiver
+from .models import Souvenir
+from .utils import local_date, local_day_start, next_month
+
+
+# the partition models live apart from the project's models, so they aren't
+# migrated and don't show up in the admin
+_apps = Apps()
+_models = {}
+
+# (alias, table) of partitions known to exist
+_existing = set()
+
+# alias: (time listed, months) from list_partitions, so that counting doesn't
+# query the catalog every time. Partitions created or dropped by other
+# processes are seen after LIST_SECONDS.
+LIST_SECONDS = 60
+_listed = {}
+
+
+@receiver(setting_changed)
+def _reset_existing(setting, **kwargs):
+    if setting in ('SOUVENIRS_STORAGE', 'DATABASES'):
+        _existing.clear()
+        _listed.clear()
+
+
+def enabled():
+    return getattr(settings, 'SOUVENIRS_STORAGE', 'rows') == 'partitioned'
+
+
+def partition_month(when):
+    """
+    Return the first day of the month (in the default timezone) containing
+    when, which names its partition.
+    """
+    return local_date(when).replace(day=1)
+
+
+def partition_table(month):
+    return '{}_{:%Y%m}'.format(Souvenir._meta.db_table, month)
+
+
+def partition_range(month):
+    """
+    Return the (start, end) datetimes of the souvenirs in month's partition.
+    """
+    return local_day_start(month), local_day_start(next_month(month))
+
+
+def partition_model(month):
+    """
+    Return a model for month's partition table, which has the columns of
+    Souvenir without the foreign key constraint on user_id.
+    """
+    table = partition_table(month)
+    try:
+        return _models[table]
+    except KeyError:
+        pass
+
+    class Meta:
+        apps = _apps
+        app_label = 'souvenirs'
+        db_table = table
+        index_together = [('tenant', 'when')]
+
+    _models[table] = type(str('Souvenir{:%Y%m}'.format(month)), (models.Model,), {
+        '__module__': __name__,
+        'Meta': Meta,
+        'user_id': models.IntegerField(db_index=True),
+        'when': models.DateTimeField(db_index=True),
+        'tenant': models.CharField(max_length=100, null=True, blank=True),
+    })
+    return _models[table]
+
+
+def souvenir_model(when, using):
+    """
+    Return the model a souvenir at when is written to: Souvenir, or with
+    partitioned storage the model of its month's partition, which is created
+    if it doesn't exist yet.
+    """
+    if not enabled():
+        return Souvenir
+    month = partition_month(when)
+    create_partition(month, using)
+    return partition_model(month)
+
+
+def create_partition(month, using=None):
+    """
+    Create the partition table for month, unless it exists. Returns whether
+    it was created.
+    """
+    using = using or router.db_for_write(Souvenir)
+    table = partition_table(month)
+    if (using, table) in _existing:
+        return False
+    connection = connections[using]
+    created = False
+    if table not in connection.introspection.table_names():
+        try:
+            with connection.schema_editor() as editor:
+                editor.create_model(partition_model(month))
+        except DatabaseError:
+            # at the start of a month, another process may have won the race
+            if table not in connection.introspection.table_names():
+                raise
+        else:
+            created = True
+            _listed.pop(using, None)
+    _existing.add((using, table))
+    return created
+
+
+def drop_partition(month, using=None):
+    """
+    Drop the partition table for month, and with it all of its souvenirs.
+    """
+    using = using or router.db_for_write(Souvenir)
+    with connections[using].schema_editor() as editor:
+        editor.delete_model(partition_model(month))
+    _existing.discard((using, partition_table(month)))
+    _listed.pop(using, None)
+
+
+def list_partitions(using=None):
+    """
+    Return the months with partition tables, in ascending order. The list is
+    cached for LIST_SECONDS.
+    """
+    using = using or router.db_for_read(Souvenir)
+    listed, months = _listed.get(using, (None, None))
+    if listed is not None and time.time() - listed < LIST_SECONDS:
+        return list(months)
+    pattern = re.compile(r'^{}_(\d{{4}})(\d{{2}})$'.format(
+        re.escape(Souvenir._meta.db_table)))
+    months = []
+    for table in connections[using].introspection.table_names():
+        match = pattern.match(table)
+        if match:
+            months.append(date(int(match.group(1)), int(match.group(2)), 1))
+    months.sort()
+    _listed[using] = (time.time(), months)
+    return list(months)
+
+
+def partition_querysets(start=None, end=None, using=None):
+    """
+    Return querysets of the partitions with souvenirs between start and end
+    (either may be None for unbounded). The others are pruned, so they aren't
+    queried at all.
+    """
+    using = using or router.db_for_read(Souvenir)
+    querysets = []
+    for month in list_partitions(using):
+        month_start, month_end = partition_range(month)
+        if ((start is None or start < month_end) and
+                (end is None or month_start < end)):
+            querysets.append(partition_model(month).objects.using(using))
+    return querysets
@@ -0,0 +1,192 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime, timedelta
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import six, timezone
+from django.utils.module_loading import import_string
+
+
+_ratelimiters = {}
+
+
+def get_ratelimiter():
+    """
+    Return the rate limiter named by SOUVENIRS_RATELIMIT_BACKEND, one instance
+    per process.
+    """
+    name = getattr(settings, 'SOUVENIRS_RATELIMIT_BACKEND',
+                   'souvenirs.ratelimit.CacheRateLimiter')
+    try:
+        return _ratelimiters[name]
+    except KeyError:
+        return _ratelimiters.setdefault(name, import_string(name)())
+
+
+@receiver(setting_changed)
+def _reset_ratelimiters(setting, **kwargs):
+    if setting.startswith('SOUVENIRS_RATELIMIT_'):
+        _ratelimiters.clear()
+
+
+class CacheRateLimiter(object):
+    """
+    Rate limiter keeping the last souvenir per user in a Django cache,
+    SOUVENIRS_CACHE_NAME. With a per-process cache such as locmem, each
+    worker process rate-limits separately.
+    """
+
+    def hit(self, user_id, when, seconds):
+        """
+        Record user_id as seen at when, unless it was already recorded less
+        than seconds earlier. Returns the earlier time if rate-limited,
+        otherwise None.
+        """
+        name = getattr(settings, 'SOUVENIRS_CACHE_NAME', 'default')
+        prefix = getattr(settings, 'SOUVENIRS_CACHE_PREFIX', 'souvenir.')
+        key = '{}.{}'.format(prefix, user_id)
+        cache = caches[name]
+        value = cache.get(key)
+        if value and when < value + timedelta(seconds=seconds):
+            return value
+        cache.set(key, when)
+        return None
+
+
+class MmapRateLimiter(object):
+    """
+    Rate limiter keeping the last souvenir per user in a memory-mapped file,
+    so that all the worker processes on a host share it without a cache
+    server. POSIX only.
+
+    The file is a fixed-size open-addressing hash table of (user key, epoch
+    seconds) slots, split into stripes of STRIPE slots. A user always lives
+    in one stripe, which is locked with a byte-range lock while it is probed
+    and updated, so workers only contend on the same stripe.
+
+    When a stripe has no free or expired slot, the eviction policy decides:
+    'oldest' replaces the slot seen longest ago, 'none' leaves the table
+    alone and lets the souvenir through unrecorded. Either way a full table
+    costs extra INSERTs rather than lost souvenirs.
+
+    The file name gets the table's geometry appended, so that processes with
+    a different number of slots (say, during a deploy changing it) use their
+    own file instead of resizing one that others have mapped.
+    """
+    MAGIC = b'SOUVRL01'
+    HEADER = struct.Struct(str('<8sII'))
+    SLOT = struct.Struct(str('<qd'))
+    STRIPE = 8
+
+    def __init__(self, path=None, slots=None, eviction=None):
+        import fcntl
+        self._fcntl = fcntl
+        path = path or getattr(
+            settings, 'SOUVENIRS_RATELIMIT_MMAP_PATH',
+            os.path.join(tempfile.gettempdir(), 'souvenirs-ratelimit'))
+        slots = slots or getattr(settings, 'SOUVENIRS_RATELIMIT_MMAP_SLOTS', 65536)
+        self.eviction = eviction or getattr(
+            settings, 'SOUVENIRS_RATELIMIT_MMAP_EVICTION', 'oldest')
+        if self.eviction not in ('oldest', 'none'):
+            raise ValueError("unknown eviction policy: {}".format(self.eviction))
+
+        self.stripes = max(1, -(-slots // self.STRIPE))
+        self.slots = self.stripes * self.STRIPE
+        size = self.HEADER.size + self.slots * self.SLOT.size
+        self.path = '{}.{}.{}x{}'.format(path, self.MAGIC.decode('ascii'),
+                                         self.stripes, self.STRIPE)
+
+        header = self.HEADER.pack(self.MAGIC, self.slots, self.STRIPE)
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock(0, self.HEADER.size)
+        try:
+            # Only ever grow the file: shrinking it under another process's
+            # mapping would crash that process with SIGBUS.
+            if os.fstat(self.fd).st_size < size:
+                os.ftruncate(self.fd, size)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            if os.read(self.fd, self.HEADER.size) != header:
+                # new file, zero-filled by ftruncate
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, header)
+            self.map = mmap.mmap(self.fd, size)
+        finally:
+            self._unlock(0, self.HEADER.size)
+
+        # byte-range locks are per process, so threads need their own.
+        self._thread_locks = [threading.Lock() for _ in range(self.stripes)]
+
+    def hit(self, user_id, when, seconds):
+        """
+        Record user_id as seen at when, unless it was already recorded less
+        than seconds earlier. Returns the earlier time if rate-limited,
+        otherwise None.
+        """
+        key = self._key(user_id)
+        now = self._epoch(when)
+        stripe = (key * 0x9E3779B97F4A7C15 >> 16) % self.stripes
+        first = self.HEADER.size + stripe * self.STRIPE * self.SLOT.size
+        length = self.STRIPE * self.SLOT.size
+
+        with self._thread_locks[stripe]:
+            self._lock(first, length)
+            try:
+                free = oldest = None
+                for i in range(self.STRIPE):
+                    offset = first + i * self.SLOT.size
+                    slot_key, last = self.SLOT.unpack_from(self.map, offset)
+                    if slot_key == key:
+                        if now < last + seconds:
+                            return self._datetime(last, when)
+                        free = offset
+                        break
+                    if free is None and (slot_key == 0 or last + seconds <= now):
+                        free = offset
+                    if oldest is None or last < oldest[1]:
+                        oldest = offset, last
+                if free is None and self.eviction == 'oldest':
+                    free = oldest[0]
+                if free is not None:
+                    self.SLOT.pack_into(self.map, free, key, now)
+                return None
+            finally:
+                self._unlock(first, length)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def _key(self, user_id):
+        # stable across processes (unlike hash()) and never 0, which marks
+        # an empty slot.
+        if isinstance(user_id, six.integer_types) and 0 < user_id < 2 ** 63:
+            return user_id
+        digest = hashlib.md5(six.text_type(user_id).encode('utf-8')).digest()
+        return struct.unpack(str('<q'), digest[:8])[0] | 1
+
+    def _epoch(self, when):
+        return (when - _epoch_like(when)).total_seconds()
+
+    def _datetime(self, seconds, like):
+        return _epoch_like(like) + timedelta(seconds=seconds)
+
+    def _lock(self, start, length):
+        self._fcntl.lockf(self.fd, self._fcntl.LOCK_EX, length, start)
+
+    def _unlock(self, start, length):
+        self._fcntl.lockf(self.fd, self._fcntl.LOCK_UN, length, start)
+
+
+def _epoch_like(dt):
+    epoch = datetime(1970, 1, 1)
+    if timezone.is_aware(dt):
+        epoch = epoch.replace(tzinfo=timezone.utc)
+    return epoch
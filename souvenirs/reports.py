@@ -1,33 +1,215 @@
 from __future__ import absolute_import, unicode_literals
 
+import bisect
+from collections import Counter, deque
+from datetime import timedelta
+import heapq
 import itertools
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.signals import setting_changed
+from django.db import connections
+from django.db.models import (Case, Count, F, Func, IntegerField, Sum, Value,
+                              When)
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.module_loading import import_string
-from .control import count_active_users
+from . import archive
+from .control import (_archived_rows, _archived_users, _count_users_by,
+                      _from_epoch, _souvenir_querysets, count_active_users,
+                      count_active_users_many)
+from .models import RegistrationDay
 from .utils import (iter_days, iter_quarters, iter_months, iter_years,
-                    adjust_to_calendar_month)
+                    adjust_to_calendar_month, local_date, local_day_start)
 
 
 izip = getattr(itertools, 'izip', zip)
 
 
-def daily_usage(subscription_start, start=None, end=None):
+class UsageRow(object):
+    """
+    Usage for one period, as generated by the report functions. The fields
+    are attributes, in __slots__ so that a row is no bigger than it has to
+    be:
+
+        row.start, row.end  # the period
+        row.registered_users, row.activated_users, row.active_users
+        row.labels          # dict, or None
+
+    For compatibility with the dictionaries the report functions generated
+    before, a row can also be read and updated like one, for example
+    row['period']['start'], row['usage']['active_users'] = 5 or
+    row.update(labels=...). row['period'] and row['usage'] are views of the
+    row's fields, made on access, so changing them changes the row. Usage
+    fields a report doesn't fill in are None as attributes, and missing from
+    row['usage']. as_dict() returns the row as plain dictionaries, for JSON.
+    """
+    __slots__ = ('start', 'end', 'registered_users', 'activated_users',
+                 'active_users', 'labels')
+    period_fields = ('start', 'end')
+    usage_fields = ('registered_users', 'activated_users', 'active_users')
+
+    def __init__(self, start, end, registered_users=None, activated_users=None,
+                 active_users=None, labels=None):
+        self.start = start
+        self.end = end
+        self.registered_users = registered_users
+        self.activated_users = activated_users
+        self.active_users = active_users
+        self.labels = labels
+
+    @classmethod
+    def coerce(cls, d):
+        """
+        Return d if it's a UsageRow, otherwise a UsageRow from a dictionary of
+        the same form, such as a SOUVENIRS_USAGE_REPORTS_FUNCTION might
+        generate.
+        """
+        if isinstance(d, cls):
+            return d
+        usage = d['usage']
+        return cls(d['period']['start'], d['period']['end'],
+                   labels=d.get('labels'),
+                   **{f: usage.get(f) for f in cls.usage_fields})
+
+    def as_dict(self):
+        d = dict(period={f: getattr(self, f) for f in self.period_fields},
+                 usage={f: getattr(self, f) for f in self.usage_fields
+                        if getattr(self, f) is not None})
+        if self.labels is not None:
+            d['labels'] = self.labels
+        return d
+
+    def keys(self):
+        keys = ['period', 'usage']
+        if self.labels is not None:
+            keys.append('labels')
+        return keys
+
+    def __getitem__(self, key):
+        if key == 'period':
+            return _FieldsView(self, self.period_fields)
+        if key == 'usage':
+            return _FieldsView(self, self.usage_fields)
+        if key == 'labels' and self.labels is not None:
+            return self.labels
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == 'period':
+            self.start, self.end = value['start'], value['end']
+        elif key == 'usage':
+            for f in self.usage_fields:
+                setattr(self, f, value.get(f))
+        elif key == 'labels':
+            self.labels = value
+        else:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, UsageRow):
+            return self.as_dict() == other.as_dict()
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'UsageRow({!r})'.format(self.as_dict())
+
+
+class _FieldsView(MutableMapping):
+    """
+    The period or usage of a UsageRow as a dictionary, reading and writing
+    the row's fields. Fields that are None aren't in it.
+    """
+    __slots__ = ('row', 'fields')
+
+    def __init__(self, row, fields):
+        self.row = row
+        self.fields = fields
+
+    def __getitem__(self, key):
+        value = getattr(self.row, key) if key in self.fields else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self.row, key, value)
+
+    def __delitem__(self, key):
+        self[key]
+        setattr(self.row, key, None)
+
+    def __iter__(self):
+        return (f for f in self.fields if getattr(self.row, f) is not None)
+
+    def __len__(self):
+        return len(list(self))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+def daily_usage(subscription_start, start=None, end=None, using=None):
     # labeling depends on having a month number, so defer to
     # customer_monthly_usage for that.
-    for monthly_usage in customer_monthly_usage(subscription_start,
-                                                start=start,
-                                                end=end):
-        periods = iter_days(monthly_usage['period']['start'],
-                            monthly_usage['period']['end'])
-        for daily_usage in usage_for_periods(periods):
-            usage = dict(daily_usage,
-                         labels=monthly_usage['labels'])
+    months = customer_monthly_usage(subscription_start, start=start, end=end,
+                                    using=using)
+    if get_usage_backend().batch:
+        # all of the days in one call
+        days = [(monthly_usage['labels'], day) for monthly_usage in months
+                for day in iter_days(*_period(monthly_usage))]
+        usages = usage_for_periods((day for _, day in days), using=using)
+        for (labels, _), usage in izip(days, usages):
+            usage['labels'] = labels
+            yield usage
+        return
+
+    for monthly_usage in months:
+        periods = iter_days(*_period(monthly_usage))
+        for usage in usage_for_periods(periods, using=using):
+            # the days of a month share its labels
+            usage['labels'] = monthly_usage['labels']
             yield usage
 
 
-def customer_monthly_usage(subscription_start, start=None, end=None):
+def customer_monthly_usage(subscription_start, start=None, end=None,
+                           using=None):
     if start is None:
         start = subscription_start
 
@@ -36,20 +218,19 @@ def customer_monthly_usage(subscription_start, start=None, end=None):
     periods = iter_months(start=subscription_start,
                           end=end or timezone.now())
 
-    for m, usage in enumerate(usage_for_periods(periods), 1):
-        if usage['period']['end'] <= start:
+    for m, usage in enumerate(usage_for_periods(periods, using=using), 1):
+        if _period(usage)[1] <= start:
             continue
-        usage.update(
-            labels=dict(
-                year_month=label_year_month_m(m),
-                year_quarter=label_year_quarter_m(m),
-                year=label_year_m(m),
-            ),
+        usage['labels'] = dict(
+            year_month=label_year_month_m(m),
+            year_quarter=label_year_quarter_m(m),
+            year=label_year_m(m),
         )
         yield usage
 
 
-def customer_quarterly_usage(subscription_start, start=None, end=None):
+def customer_quarterly_usage(subscription_start, start=None, end=None,
+                             using=None):
     if start is None:
         start = subscription_start
 
@@ -58,19 +239,18 @@ def customer_quarterly_usage(subscription_start, start=None, end=None):
     periods = iter_quarters(start=subscription_start,
                             end=end or timezone.now())
 
-    for q, usage in enumerate(usage_for_periods(periods), 1):
-        if usage['period']['end'] <= start:
+    for q, usage in enumerate(usage_for_periods(periods, using=using), 1):
+        if _period(usage)[1] <= start:
             continue
-        usage.update(
-            labels=dict(
-                year_quarter=label_year_quarter_q(q),
-                year=label_year_q(q),
-            ),
+        usage['labels'] = dict(
+            year_quarter=label_year_quarter_q(q),
+            year=label_year_q(q),
         )
         yield usage
 
 
-def customer_yearly_usage(subscription_start, start=None, end=None):
+def customer_yearly_usage(subscription_start, start=None, end=None,
+                          using=None):
     if start is None:
         start = subscription_start
 
@@ -79,28 +259,479 @@ def customer_yearly_usage(subscription_start, start=None, end=None):
     periods = iter_years(start=subscription_start,
                          end=end or timezone.now())
 
-    for y, usage in enumerate(usage_for_periods(periods), 1):
-        if usage['period']['end'] <= start:
+    for y, usage in enumerate(usage_for_periods(periods, using=using), 1):
+        if _period(usage)[1] <= start:
             continue
-        usage.update(
-            labels=dict(
-                year=label_year_y(y)
-            ),
+        usage['labels'] = dict(
+            year=label_year_y(y)
         )
         yield usage
 
 
-def calendar_monthly_usage(start, end=None):
+def calendar_monthly_usage(start, end=None, using=None):
     start = adjust_to_calendar_month(start)
     periods = iter_months(start, end or timezone.now())
-    for usage in usage_for_periods(periods):
-        usage.update(
+    for usage in usage_for_periods(periods, using=using):
+        period_start = _period(usage)[0]
+        usage['labels'] = dict(
+            calendar_year_month=label_calendar_year_month(period_start),
+            calendar_year=label_calendar_year(period_start),
+        )
+        yield usage
+
+
+def cohort_retention(subscription_start, start=None, end=None, qs=None,
+                     using=None):
+    """
+    Generate a sequence of UsageRows, one per subscription month cohort, of
+    users who registered in that month and how many of them were active in
+    each month since. The activity for the whole triangle comes from a single
+    grouped query, joined to the users unless they're in another database or
+    the souvenirs are in partitions or the archive files (without qs), when
+    the months each user was active in are read and their cohorts looked up
+    in Python.
+
+    Read as a dictionary, each row in the generated sequence has this form:
+
+        {
+            period: {
+                start: datetime,
+                end: datetime,
+            }
+            labels: {
+                year_month: str,
+            }
+            usage: {
+                registered_users: int,
+                active_users: [int, ...],  # cohort month, then each month after
+            }
+        }
+
+    """
+    if start is None:
+        start = subscription_start
+
+    # regardless of start, the monthly iterator must use subscription_start for
+    # the sake of enumerating.
+    periods = list(iter_months(start=subscription_start,
+                               end=end or timezone.now()))
+    first = next((i for i, p in enumerate(periods) if p[1] > start), None)
+    if first is None:
+        return
+    months = periods[first:]
+    lo, hi = months[0][0], months[-1][1]
+
+    def month_of(field):
+        return Case(*[When(then=Value(i), **{field + '__lt': p[1]})
+                      for i, p in enumerate(months)],
+                    output_field=IntegerField())
+
+    users = (get_user_model()._default_manager
+             .filter(date_joined__gte=lo, date_joined__lt=hi))
+    registered = dict(
+        users.annotate(cohort=month_of('date_joined'))
+        .order_by()
+        .values_list('cohort')
+        .annotate(Count('pk'))
+    )
+
+    querysets = [q.filter(when__gte=lo, when__lt=hi)
+                 for q in _souvenir_querysets(qs, using, lo, hi)]
+    months_active = set()  # (user, month)
+    if qs is None:
+        ends = [archive.epoch(p[1]) for p in months]
+        months_active.update((user_id, bisect.bisect_right(ends, t))
+                             for t, user_id in _archived_rows(lo, hi))
+    if (len(querysets) == 1 and not months_active and
+            querysets[0].db == users.db):
+        active = {
+            (cohort, month): n for cohort, month, n in
+            querysets[0]
+            .filter(user__date_joined__gte=lo, user__date_joined__lt=hi)
+            .annotate(cohort=month_of('user__date_joined'),
+                      month=month_of('when'))
+            .order_by()
+            .values_list('cohort', 'month')
+            .annotate(Count('user', distinct=True))
+        }
+    else:
+        # join the users' cohorts to the months each user was active in, which
+        # can repeat across partitions
+        cohorts = dict(users.annotate(cohort=month_of('date_joined'))
+                       .values_list('pk', 'cohort').iterator())
+        for q in querysets:
+            months_active.update(q.annotate(month=month_of('when'))
+                                 .order_by()
+                                 .values_list('user_id', 'month')
+                                 .distinct()
+                                 .iterator())
+        active = Counter((cohorts[user_id], month)
+                         for user_id, month in months_active
+                         if user_id in cohorts)
+
+    for c, (cohort_start, cohort_end) in enumerate(months):
+        yield UsageRow(
+            start=cohort_start,
+            end=cohort_end,
             labels=dict(
-                calendar_year_month=label_calendar_year_month(usage['period']['start']),
-                calendar_year=label_calendar_year(usage['period']['start']),
+                year_month=label_year_month_m(first + c + 1),
             ),
+            registered_users=registered.get(c, 0),
+            active_users=[active.get((c, m), 0)
+                          for m in range(c, len(months))],
         )
-        yield usage
+
+
+def rolling_active_users(start, end=None, window=30, qs=None, using=None):
+    """
+    Generate a sequence of UsageRows with the number of users active in the
+    trailing window of days ending with each day between start and end. This
+    is the same as calling count_active_users for each day's window, but the
+    souvenirs are walked once in order and each day is derived from the
+    previous one by adding the newest day and dropping the oldest. Like
+    count_active_users, the partitions and archive files are read too.
+
+    Read as a dictionary, each row in the generated sequence has this form:
+
+        {
+            period: {
+                start: datetime,  # day end minus window days
+                end: datetime,    # day end
+            }
+            usage: {
+                active_users: int,
+            }
+        }
+
+    """
+    if window < 1:
+        raise ValueError("window must be at least one day")
+    end = end or timezone.now()
+
+    # the first reported day needs the window-1 days preceding it. The days
+    # are local days, which aren't all 24 hours long.
+    lead = timedelta(days=window - 1)
+    days = _iter_local_days(local_date(start) - lead, end)
+
+    in_window = deque()
+    seen = Counter()  # user -> number of days in window with activity
+    for (day_start, day_end), users in _iter_daily_users(days, qs=qs,
+                                                         using=using):
+        in_window.append(users)
+        for u in users:
+            seen[u] += 1
+        if len(in_window) > window:
+            for u in in_window.popleft():
+                seen[u] -= 1
+                if not seen[u]:
+                    del seen[u]
+        if day_end <= start:
+            continue
+        yield UsageRow(
+            start=local_day_start(local_date(day_start) - lead),
+            end=day_end,
+            active_users=len(seen),
+        )
+
+
+# lower bounds of the default engagement_histogram buckets: 1 day, 2-5 days,
+# 6-15 days and 16 or more
+ENGAGEMENT_BUCKETS = (1, 2, 6, 16)
+
+# how many days engagement_histogram tells apart in one query, which has two
+# parameters per day
+_DAYS_PER_QUERY = 366
+
+
+def engagement_histogram(start, end, buckets=ENGAGEMENT_BUCKETS, qs=None,
+                         using=None):
+    """
+    Return the distribution of users active between start and end by the
+    number of distinct days they were active, as a list of tuples (low, high,
+    users), one per bucket. buckets is the ascending lower bounds, and each
+    bucket runs to the day before the next one (high is inclusive) or, for
+    the last bucket, without limit (high is None).
+
+    Days are those of the default timezone, like local_date. The days per
+    user come from a query grouping by user and counting distinct days (one
+    query per year of the period), so no per-user queries. With partitions
+    or archive files (and no qs), where a user's days are spread over several
+    tables or files, the distinct days of each user are read from each and
+    merged instead. For a histogram per month, call this for each period of
+    iter_months.
+    """
+    ranges = engagement_ranges(buckets)
+    querysets = _souvenir_querysets(qs, using, start, end)
+
+    # the ends of the days from start to end, the last cut short by end
+    first = local_date(start)
+    day_ends = []
+    while not day_ends or day_ends[-1] < end:
+        next_day = first + timedelta(days=len(day_ends) + 1)
+        day_ends.append(min(end, local_day_start(next_day)))
+
+    days_per_user = Counter()
+    days_of_user = {}  # user -> set of days, from more than one source
+    if qs is None:
+        epochs = [archive.epoch(e) for e in day_ends]
+        for t, user_id in _archived_rows(start, end):
+            days_of_user.setdefault(user_id, set()).add(
+                bisect.bisect_right(epochs, t))
+    lo = start
+    for i in range(0, len(day_ends), _DAYS_PER_QUERY):
+        ends = day_ends[i:i + _DAYS_PER_QUERY]
+        day = Case(*[When(when__lt=e, then=Value(d)) for d, e in enumerate(ends)],
+                   output_field=IntegerField())
+        for q in querysets:
+            q = q.filter(when__gte=lo, when__lt=ends[-1]).order_by()
+            if len(querysets) == 1 and not days_of_user:
+                days_per_user.update(dict(
+                    q.values('user_id')
+                    .annotate(days=Count(day, distinct=True))
+                    .values_list('user_id', 'days')
+                    .iterator()))
+                continue
+            for user_id, d in (q.annotate(day=day)
+                               .values_list('user_id', 'day')
+                               .distinct()
+                               .iterator()):
+                days_of_user.setdefault(user_id, set()).add(i + d)
+        lo = ends[-1]
+    days_per_user.update({u: len(d) for u, d in days_of_user.items()})
+
+    lows = [low for low, high in ranges]
+    counts = [0] * len(ranges)
+    for days in days_per_user.values():
+        counts[bisect.bisect_right(lows, days) - 1] += 1
+    return [(low, high, n) for (low, high), n in izip(ranges, counts)]
+
+
+def engagement_ranges(buckets):
+    """
+    Return the (low, high) days of each of the engagement_histogram buckets,
+    or raise ValueError if they aren't valid.
+    """
+    buckets = list(buckets)
+    if not buckets or buckets[0] < 1 or buckets != sorted(set(buckets)):
+        raise ValueError("buckets must be ascending and at least one day")
+    return list(izip(buckets, [b - 1 for b in buckets[1:]] + [None]))
+
+
+def active_users_by_tenant(periods, qs=None, using=None):
+    """
+    Return a dictionary of lists of the number of active users for each
+    tenant in each of periods, which should be contiguous (start, end) tuples
+    in ascending order, such as from iter_months. The counts come from one
+    query grouping by tenant and period (per partition, see _count_users_by)
+    rather than one per tenant and period. Souvenirs without a tenant are
+    counted under None, with the users in the archive files (and no qs).
+    """
+    periods = list(periods)
+    if not periods:
+        return {}
+    start, end = periods[0][0], periods[-1][1]
+    archived = {}
+    for i, (lo, hi) in enumerate(periods if qs is None else []):
+        users = _archived_users(lo, hi)
+        if users:
+            archived[None, i] = users
+
+    period = Case(*[When(when__lt=p[1], then=Value(i))
+                    for i, p in enumerate(periods)],
+                  output_field=IntegerField())
+    querysets = [q.filter(when__gte=start, when__lt=end).annotate(period=period)
+                 for q in _souvenir_querysets(qs, using, start, end)]
+    counts = {}
+    for (tenant, i), users in _count_users_by(querysets, ('tenant', 'period'),
+                                              archived).items():
+        counts.setdefault(tenant, [0] * len(periods))[i] = users
+    return counts
+
+
+def activity_heatmap(start, end, tz=None, distinct_users=True, qs=None,
+                     using=None):
+    """
+    Return a matrix of activity between start and end by hour of the week in
+    tz (default the current timezone): a list of 7 weekdays, Monday first,
+    each a list of 24 hours. Each cell is the number of distinct users active
+    in that hour on any of those weekdays, or with distinct_users=False, the
+    number of souvenirs.
+
+    The whole matrix comes from one query grouping by hour of the week (per
+    partition, see _count_users_by), computed in the database from the UTC
+    time and tz's offset, which changes at daylight saving transitions. On
+    databases other than SQLite, PostgreSQL and MySQL, the souvenirs are read
+    and grouped in Python, as are those in the archive files (without qs).
+    """
+    matrix = [[0] * 24 for _ in range(7)]
+    if end <= start:
+        return matrix
+    querysets = [q.filter(when__gte=start, when__lt=end)
+                 for q in _souvenir_querysets(qs, using, start, end)]
+    tz = tz or timezone.get_current_timezone()
+    offset, changes = _utc_offsets(start, end, tz)
+
+    # the souvenirs grouped here: those in the archive files, and the rest
+    # too on other databases
+    sources = []
+    if qs is None:
+        sources.append(_archived_hours(start, end, offset, changes))
+    if connections[querysets[0].db].vendor not in _HourOfWeek.templates:
+        sources += [_local_hours(q, tz) for q in querysets]
+        querysets = []
+    users, counts = {}, Counter()
+    for hour, user_id in itertools.chain.from_iterable(sources):
+        if distinct_users:
+            users.setdefault((hour,), set()).add(user_id)
+        else:
+            counts[hour] += 1
+
+    if querysets:
+        if changes:
+            offset = Case(*[When(when__lt=change, then=Value(before))
+                            for change, before in changes],
+                          default=Value(offset), output_field=IntegerField())
+        else:
+            offset = Value(offset)
+        querysets = [q.annotate(hour=_HourOfWeek('when', offset))
+                     for q in querysets]
+        if distinct_users:
+            users = _count_users_by(querysets, ('hour',), users)
+        else:
+            for q in querysets:
+                counts.update(dict(q.order_by().values_list('hour')
+                                   .annotate(Count('pk'))
+                                   .values_list('hour', 'pk__count')))
+    elif distinct_users:
+        users = {key: len(ids) for key, ids in users.items()}
+    if distinct_users:
+        counts = {hour: n for (hour,), n in users.items()}
+    for hour, n in counts.items():
+        matrix[hour // 24][hour % 24] = n
+    return matrix
+
+
+def _local_hours(qs, tz):
+    """
+    Generate (hour of the week in tz, user id) of the souvenirs in qs.
+    """
+    for when, user_id in qs.order_by().values_list('when', 'user_id').iterator():
+        when = timezone.localtime(when, tz)
+        yield when.weekday() * 24 + when.hour, user_id
+
+
+def _archived_hours(start, end, offset, changes):
+    """
+    Generate (hour of the week, user id) of the souvenirs in the archive
+    files between start and end, as _HourOfWeek computes it from the offset
+    and changes returned by _utc_offsets.
+    """
+    changes = [(archive.epoch(change), before) for change, before in changes]
+    for t, user_id in _archived_rows(start, end):
+        minutes = next((before for change, before in changes if t < change),
+                       offset)
+        yield ((t // 60 + minutes) // 60 + 72) % 168, user_id
+
+
+def _utc_offsets(start, end, tz):
+    """
+    Return (minutes, changes) for tz between start and end, where minutes is
+    the UTC offset at end, and changes is a list of tuples (when, minutes)
+    of each time the offset changes and the offset before it.
+    """
+    def offset(t):
+        return int(t.astimezone(tz).utcoffset().total_seconds()) // 60
+
+    changes = []
+    lo, current = start, offset(start)
+    while lo < end:
+        hi = min(lo + timedelta(days=1), end)
+        if offset(hi) == current:
+            lo = hi
+            continue
+        # bisect to the second
+        while hi - lo > timedelta(seconds=1):
+            mid = lo + (hi - lo) // 2
+            if offset(mid) == current:
+                lo = mid
+            else:
+                hi = mid
+        changes.append((hi, current))
+        lo, current = hi, offset(hi)
+    return current, changes
+
+
+class _HourOfWeek(Func):
+    """
+    Hour of the week of a datetime field (0 is Monday midnight), after adding
+    an offset in minutes. The Unix epoch was a Thursday, 72 hours into its
+    week.
+    """
+    templates = {
+        'sqlite': "(((CAST(strftime('%%s', {when}) AS INTEGER) / 60"
+                  " + {offset}) / 60 + 72) %% 168)",
+        'postgresql': "(((CAST(FLOOR(EXTRACT(EPOCH FROM {when}) / 60) AS BIGINT)"
+                      " + {offset}) / 60 + 72) %% 168)",
+        'mysql': "(((TIMESTAMPDIFF(MINUTE, '1970-01-01', {when})"
+                 " + {offset}) DIV 60 + 72) %% 168)",
+    }
+
+    def __init__(self, when, offset):
+        super(_HourOfWeek, self).__init__(F(when), offset,
+                                          output_field=IntegerField())
+
+    def as_sql(self, compiler, connection):
+        template = self.templates.get(connection.vendor)
+        if template is None:
+            raise NotImplementedError(
+                "activity_heatmap doesn't support {}".format(connection.vendor))
+        (when, when_params), (offset, offset_params) = [
+            compiler.compile(e) for e in self.get_source_expressions()]
+        return (template.format(when=when, offset=offset),
+                when_params + offset_params)
+
+
+def _iter_local_days(day, end):
+    """
+    Generate (start, end) tuples of the local days from day (a date) until
+    end, the last cut short by end.
+    """
+    day_start = local_day_start(day)
+    while day_start < end:
+        day += timedelta(days=1)
+        next_start = local_day_start(day)
+        yield day_start, min(next_start, end)
+        day_start = next_start
+
+
+def _iter_daily_users(days, qs=None, using=None):
+    """
+    Generate a sequence of tuples (day, users) for days, which should be
+    contiguous (start, end) tuples in ascending order, where users is the set
+    of user ids active during that day. Souvenirs are read with a single
+    ordered query, per partition if there are any, merged in order with the
+    archive files (without qs).
+    """
+    days = list(days)
+    if not days:
+        return
+    start, end = days[0][0], days[-1][1]
+    sources = [q.filter(when__gte=start, when__lt=end)
+               .order_by('when')
+               .values_list('when', 'user_id')
+               .iterator()
+               for q in _souvenir_querysets(qs, using, start, end)]
+    if qs is None:
+        sources.append((_from_epoch(t), user_id)
+                       for t, user_id in _archived_rows(start, end))
+    rows = heapq.merge(*sources)
+    row = next(rows, None)
+    for day in days:
+        users = set()
+        while row is not None and row[0] < day[1]:
+            users.add(row[1])
+            row = next(rows, None)
+        yield day, users
 
 
 month_to_year = lambda m: (m - 1) // 12 + 1
@@ -116,21 +747,146 @@ label_year_q = lambda q: 'Y{:02d}'.format(quarter_to_year(q))
 label_year_m = lambda m: 'Y{:02d}'.format(month_to_year(m))
 label_calendar_year_month = lambda d: d.strftime('%Y-%m')
 label_calendar_year = lambda d: d.year  # int
+label_engagement = lambda low, high: (
+    '{}+'.format(low) if high is None else
+    '{}'.format(low) if high == low else
+    '{}-{}'.format(low, high))
+
 
+class UsageBackend(object):
+    """
+    Engine behind usage_for_periods. Subclasses implement usage_for_periods,
+    and set the flags for what they can do:
+
+    batch: evaluates all of the periods together, so callers pass them in
+    one call rather than one call per group of periods (see daily_usage).
+
+    approximate: counts may be estimates.
+
+    tail_only: only has data for recent periods, so counts for older periods
+    may be missing.
+    """
+    batch = False
+    approximate = False
+    tail_only = False
+
+    def usage_for_periods(self, periods, using=None):
+        """
+        Generate a UsageRow (or a dictionary of the same form) for each of
+        periods, like _usage_for_periods.
+        """
+        raise NotImplementedError
+
+
+class QueryUsageBackend(UsageBackend):
+    """
+    The reference backend, counting exactly with queries per period.
+    """
+
+    def usage_for_periods(self, periods, using=None):
+        return _usage_for_periods(periods, using=using)
+
+
+class BatchQueryUsageBackend(QueryUsageBackend):
+    """
+    Backend counting exactly, reading the souvenirs for all of the periods
+    at once with count_active_users_many instead of counting each period in
+    the database. It suits many short periods, such as daily_usage's.
+    """
+    batch = True
+
+    def usage_for_periods(self, periods, using=None):
+        return _usage_for_periods(periods, using=using, batch=True)
+
+
+class SampledUsageBackend(UsageBackend):
+    """
+    Backend estimating active users from a sample of users, by default
+    SOUVENIRS_USAGE_SAMPLE (0.05), see count_active_users. The same users are
+    sampled in every period, so the estimates are coherent with each other.
+    Registered and activated users are still counted exactly.
+    """
+    approximate = True
+
+    def __init__(self, sample=None):
+        self.sample = sample or getattr(settings, 'SOUVENIRS_USAGE_SAMPLE', 0.05)
+
+    def usage_for_periods(self, periods, using=None):
+        return _usage_for_periods(periods, using=using, sample=self.sample)
+
+
+class FunctionUsageBackend(UsageBackend):
+    """
+    Backend calling a function with the signature of _usage_for_periods, as
+    named by SOUVENIRS_USAGE_REPORTS_FUNCTION.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def usage_for_periods(self, periods, using=None):
+        # functions written before using= existed don't accept it, so only
+        # pass it along when it was given.
+        if using is None:
+            return self.function(periods)
+        return self.function(periods, using=using)
+
+
+_usage_backends = {}
+
+
+def get_usage_backend(name=None):
+    """
+    Return an instance of the usage backend class named by the dotted path
+    name, or by default the one named by SOUVENIRS_USAGE_BACKEND (or wrapping
+    SOUVENIRS_USAGE_REPORTS_FUNCTION). The instance is cached, one per name
+    per process, until the settings change.
+    """
+    try:
+        return _usage_backends[name]
+    except KeyError:
+        pass
+    if name is not None:
+        backend = import_string(name)()
+    elif getattr(settings, 'SOUVENIRS_USAGE_BACKEND', None):
+        backend = import_string(settings.SOUVENIRS_USAGE_BACKEND)()
+    elif getattr(settings, 'SOUVENIRS_USAGE_REPORTS_FUNCTION', None):
+        backend = FunctionUsageBackend(
+            import_string(settings.SOUVENIRS_USAGE_REPORTS_FUNCTION))
+    else:
+        backend = QueryUsageBackend()
+    return _usage_backends.setdefault(name, backend)
+
+
+@receiver(setting_changed)
+def _reset_usage_backends(setting, **kwargs):
+    if setting.startswith('SOUVENIRS_USAGE_'):
+        _usage_backends.clear()
 
-def usage_for_periods(*args, **kwargs):
-    name = getattr(settings, 'SOUVENIRS_USAGE_REPORTS_FUNCTION', None)
-    func = import_string(name) if name else _usage_for_periods
-    return func(*args, **kwargs)
+
+def usage_for_periods(periods, using=None, backend=None, exact=False):
+    """
+    Generate usage data for periods from backend, a UsageBackend or the
+    dotted path of one, by default the configured one (see
+    get_usage_backend). With exact, a backend that's approximate or
+    tail_only is passed over for QueryUsageBackend.
+    """
+    if not isinstance(backend, UsageBackend):
+        backend = get_usage_backend(backend)
+    if exact and (backend.approximate or backend.tail_only):
+        backend = get_usage_backend('souvenirs.reports.QueryUsageBackend')
+    return backend.usage_for_periods(periods, using=using)
 
 
-def _usage_for_periods(periods):
+def _usage_for_periods(periods, using=None, sample=None, batch=False):
     """
-    Generate a sequence of dictionaries of usage data corresponding to periods,
+    Generate a sequence of UsageRows of usage data corresponding to periods,
     each of which should be a tuple of (start, end) datetimes, where start is
-    inclusive and end is exclusive.
+    inclusive and end is exclusive. With sample, active_users are Estimates
+    from that fraction of users. With batch, they're counted together by
+    count_active_users_many.
 
-    Each dictionary in the generated sequence has this form:
+    Read as a dictionary, each row in the generated sequence has this form:
 
         {
             period: {
@@ -145,30 +901,63 @@ def _usage_for_periods(periods):
         }
 
     """
-    rp, ap, periods = itertools.tee(periods, 3)
-    ir = (registered_users_as_of(end) for start, end in rp)
-    ia = (count_active_users(*p) for p in ap)
+    if batch:
+        periods = list(periods)
+        ia = count_active_users_many(periods, using=using, sample=sample)
+        rp = periods
+    else:
+        rp, ap, periods = itertools.tee(periods, 3)
+        ia = (count_active_users(*p, using=using, sample=sample) for p in ap)
+    ir = (registered_users_as_of(end, using=using) for start, end in rp)
     for p, r, active in izip(periods, ir, ia):
         start, end = p
         registered, activated = r
-        yield dict(
-            period=dict(
-                start=start,
-                end=end,
-            ),
-            usage=dict(
-                registered_users=registered,
-                activated_users=activated,
-                active_users=active,
-            ),
+        yield UsageRow(
+            start=start,
+            end=end,
+            registered_users=registered,
+            activated_users=activated,
+            active_users=active,
         )
 
 
-def registered_users_as_of(date):
+def _period(usage):
+    """
+    Return (start, end) of usage, which is a UsageRow, or a dictionary from a
+    SOUVENIRS_USAGE_REPORTS_FUNCTION that doesn't generate them.
+    """
+    if isinstance(usage, UsageRow):
+        return usage.start, usage.end
+    return usage['period']['start'], usage['period']['end']
+
+
+def registered_users_as_of(date, using=None):
     """
     Return a tuple of the form (registered, activated) indicating the total
     registered and activated users for the given date.
+
+    With SOUVENIRS_REGISTRATION_DAYS this sums the RegistrationDay rows for
+    the days before date, and only counts users for the part of date's own
+    day before date, if any.
+
+    The users are read from their own database, as routed, and using is the
+    alias of RegistrationDay.
     """
     User = get_user_model()
-    users = User.objects.filter(date_joined__lt=date)
+    if getattr(settings, 'SOUVENIRS_REGISTRATION_DAYS', False):
+        day = local_date(date)
+        day_start = local_day_start(day)
+        totals = (RegistrationDay.objects.using(using)
+                  .filter(day__lt=day)
+                  .aggregate(joined=Sum('joined'), activated=Sum('activated')))
+        registered = totals['joined'] or 0
+        activated = totals['activated'] or 0
+        if date > day_start:
+            users = User._default_manager.filter(date_joined__gte=day_start,
+                                                 date_joined__lt=date)
+            registered += users.count()
+            activated += users.filter(is_active=True).count()
+        return registered, activated
+
+    users = User._default_manager.filter(date_joined__lt=date)
     return users.count(), users.filter(is_active=True).count()
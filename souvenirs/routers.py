@@ -0,0 +1,41 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+from django.db import router
+
+
+class SouvenirsRouter(object):
+    """
+    Database router for the souvenirs models. Writes go to
+    SOUVENIRS_DATABASE, reads go to SOUVENIRS_REPORTS_DATABASE (falling back to
+    SOUVENIRS_DATABASE), and migrations only run on SOUVENIRS_DATABASE. When
+    neither is set, the router has no opinion.
+    """
+    app_label = 'souvenirs'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return (getattr(settings, 'SOUVENIRS_REPORTS_DATABASE', None) or
+                    getattr(settings, 'SOUVENIRS_DATABASE', None))
+        instance = hints.get('instance')
+        if (instance is not None and
+                instance._meta.app_label == self.app_label and
+                getattr(settings, 'SOUVENIRS_DATABASE', None)):
+            # souvenir.user is read where users are, not where the souvenir
+            # came from
+            return router.db_for_read(model)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return getattr(settings, 'SOUVENIRS_DATABASE', None)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # souvenirs only refer to users by id, without a foreign key
+        # constraint, which is meaningful on any of the configured aliases.
+        if self.app_label in (obj1._meta.app_label, obj2._meta.app_label):
+            return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        alias = getattr(settings, 'SOUVENIRS_DATABASE', None)
+        if app_label == self.app_label and alias:
+            return db == alias
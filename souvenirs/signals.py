@@ -0,0 +1,98 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.db.models import F
+from . import partitions
+from .models import RegistrationDay, Souvenir, UserActivity
+from .utils import local_date
+
+
+def _enabled():
+    return getattr(settings, 'SOUVENIRS_REGISTRATION_DAYS', False)
+
+
+def user_pre_save(sender, instance, raw=False, using=None, update_fields=None,
+                  **kwargs):
+    """
+    Remember the user's registration day and active flag as currently saved,
+    so that user_post_save can move them.
+    """
+    if not _enabled() or raw:
+        return
+    instance._souvenirs_registration = None
+    if instance._state.adding:
+        return
+    if (update_fields is not None and
+            not {'date_joined', 'is_active'}.intersection(update_fields)):
+        # for example update_last_login on every sign-in
+        instance._souvenirs_registration = registration_of(instance)
+        return
+    old = (sender._default_manager.using(using)
+           .filter(pk=instance.pk)
+           .values_list('date_joined', 'is_active')
+           .first())
+    if old is not None:
+        instance._souvenirs_registration = (local_date(old[0]), old[1])
+
+
+def user_post_save(sender, instance, created=False, raw=False, using=None,
+                   **kwargs):
+    if not _enabled() or raw:
+        return
+    old = getattr(instance, '_souvenirs_registration', None)
+    new = registration_of(instance)
+    if old == new:
+        return
+    using = router.db_for_write(RegistrationDay, instance=instance)
+    if old is not None:
+        add_registration(old[0], -1, -old[1], using)
+    add_registration(new[0], 1, int(new[1]), using)
+
+
+def user_post_delete(sender, instance, using=None, **kwargs):
+    if not _enabled():
+        return
+    day, active = registration_of(instance)
+    add_registration(day, -1, -active,
+                     router.db_for_write(RegistrationDay, instance=instance))
+
+
+def user_post_delete_souvenirs(sender, instance, **kwargs):
+    """
+    Delete the user's souvenirs (from the partitions too) and UserActivity,
+    which don't cascade from the user, since they may be in another database.
+    """
+    using = router.db_for_write(Souvenir)
+    souvenirs = [Souvenir.objects.using(using)]
+    if partitions.enabled():
+        souvenirs += partitions.partition_querysets(using=using)
+    for qs in souvenirs:
+        qs.filter(user_id=instance.pk).delete()
+    UserActivity.objects.using(using).filter(user_id=instance.pk).delete()
+
+
+def registration_of(user):
+    return local_date(user.date_joined), bool(user.is_active)
+
+
+def add_registration(day, joined, activated, using=None):
+    """
+    Add to the joined and activated counts for day, creating its
+    RegistrationDay if necessary. The counts are written to using, or
+    wherever the routers send RegistrationDay writes.
+    """
+    if using is None:
+        using = router.db_for_write(RegistrationDay)
+    days = RegistrationDay.objects.using(using).filter(day=day)
+    changes = dict(joined=F('joined') + joined,
+                   activated=F('activated') + activated)
+    if days.update(**changes):
+        return
+    try:
+        with transaction.atomic(using=using):
+            RegistrationDay(day=day, joined=joined,
+                            activated=activated).save(using=using)
+    except IntegrityError:
+        # created concurrently
+        days.update(**changes)
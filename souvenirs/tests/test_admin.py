@@ -0,0 +1,94 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime, timedelta
+from django.contrib import admin
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+from django.utils.six.moves import reload_module
+import pytest
+from souvenirs import admin as souvenirs_admin
+from souvenirs.admin import SouvenirAdmin
+from souvenirs.models import Souvenir
+from .factories import SouvenirFactory
+
+
+@pytest.mark.django_db
+class TestSouvenirAdmin:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db, admin_client, settings, mocker):
+        settings.SOUVENIRS_EXCLUDE_PATHS = [r'^/admin/']
+        mocker.patch.object(SouvenirAdmin, 'list_per_page', 2)
+        self.client = admin_client
+        self.url = reverse('admin:souvenirs_souvenir_changelist')
+        start = datetime(2017, 3, 10, 12, tzinfo=timezone.utc)
+        self.souvenirs = [SouvenirFactory(when=start + timedelta(days=d))
+                          for d in range(5)]
+        # same when as the newest, to exercise the id tie-break
+        self.souvenirs.append(SouvenirFactory(when=self.souvenirs[-1].when))
+
+    def pages(self, url):
+        pages = []
+        while url:
+            response = self.client.get(url)
+            assert response.status_code == 200
+            cl = response.context['cl']
+            pages.append([s.pk for s in cl.result_list])
+            url = cl.next_url and self.url + cl.next_url
+        return pages, cl
+
+    def test_keyset_pages(self):
+        pages, cl = self.pages(self.url)
+        s = [x.pk for x in self.souvenirs]
+        assert pages == [[s[5], s[4]], [s[3], s[2]], [s[1], s[0]]]
+        assert cl.result_count == 6
+        assert cl.newest_url == '?'
+
+    def test_filters(self):
+        pages, cl = self.pages(self.url + '?month=2017-03&when__gte=2017-03-12')
+        s = [x.pk for x in self.souvenirs]
+        assert pages == [[s[5], s[4]], [s[3], s[2]]]
+        assert cl.result_count == 4
+        pages, cl = self.pages(self.url + '?month=2017-02')
+        assert pages == [[]]
+
+    def test_bad_cursor(self):
+        response = self.client.get(self.url + '?before=yesterday_1')
+        assert response.status_code == 302
+        assert response['Location'].endswith('?e=1')
+
+    def test_estimated_count(self, mocker):
+        mocker.patch('souvenirs.admin._estimate_rows', return_value=12345678)
+        response = self.client.get(self.url)
+        assert response.context['cl'].result_count == 12345678
+        assert b'about 12345678 souvenirs' in response.content
+
+    def test_change_form(self):
+        response = self.client.get(reverse('admin:souvenirs_souvenir_change',
+                                           args=[self.souvenirs[0].pk]))
+        assert response.status_code == 200
+        assert 'vForeignKeyRawIdAdminField' in response.content.decode('utf-8')
+
+
+@pytest.fixture
+def unregistered():
+    admin.site.unregister(Souvenir)
+    yield
+    admin.site.unregister(Souvenir)
+    admin.site.register(Souvenir, SouvenirAdmin)
+    # the URLconf keeps the views of the first SouvenirAdmin, whose super()
+    # calls look the class up in the reloaded module
+    souvenirs_admin.SouvenirAdmin = SouvenirAdmin
+
+
+def test_registered_by_project(unregistered):
+    admin.site.register(Souvenir)
+    reload_module(souvenirs_admin)  # no AlreadyRegistered
+    assert type(admin.site._registry[Souvenir]) is admin.ModelAdmin
+
+
+def test_registration_setting(unregistered, settings):
+    settings.SOUVENIRS_ADMIN = False
+    reload_module(souvenirs_admin)
+    assert not admin.site.is_registered(Souvenir)
+    admin.site.register(Souvenir)
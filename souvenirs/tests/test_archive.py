@@ -0,0 +1,231 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import date, datetime
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+import pytest
+from souvenirs import archive
+from souvenirs.control import (count_active_users, count_active_users_by_tenant,
+                               count_active_users_many, rebuild_user_activity)
+from souvenirs.models import Souvenir, UserActivity
+from souvenirs.reports import (_HourOfWeek, active_users_by_tenant,
+                               activity_heatmap, calendar_monthly_usage,
+                               cohort_retention, engagement_histogram,
+                               rolling_active_users)
+from .factories import SouvenirFactory, UserFactory
+
+
+@pytest.mark.django_db
+class TestArchive:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, settings, tmpdir):
+        settings.SOUVENIRS_ARCHIVE_DIR = str(tmpdir.join('archive'))
+        self.tzinfo = timezone.get_default_timezone()
+        self.when = lambda m, d=14, h=12: timezone.make_aware(
+            datetime(2017, m, d, h), self.tzinfo)
+        self.users = [UserFactory() for _ in range(4)]
+        u, u2, u3, u4 = self.users
+        for user, whens in [(u, [(1, 1, 0), (1, 31, 23), (2, 14, 12)]),
+                            (u2, [(1, 14, 12), (1, 14, 13), (3, 3, 3)]),
+                            (u3, [(3, 31, 23), (4, 1, 0)]),
+                            (u4, [(2, 28, 12)])]:
+            for w in whens:
+                SouvenirFactory(user=user, when=self.when(*w))
+        self.periods = [
+            (None, None),
+            (self.when(1, 1, 0), self.when(2, 1, 0)),
+            (self.when(1, 14, 12), self.when(1, 14, 13)),
+            (self.when(1, 31, 0), self.when(2, 28, 12)),
+            (self.when(2, 1, 0), self.when(4, 1, 0)),
+            (self.when(3, 31, 0), None),
+            (None, self.when(1, 14, 13)),
+        ]
+
+    def counts(self, **kwargs):
+        return [count_active_users(*p, **kwargs) for p in self.periods]
+
+    def test_archive_month(self):
+        expected = self.counts()
+        assert expected == [4, 2, 1, 1, 4, 1, 2]
+        usage = [r.active_users for r in calendar_monthly_usage(
+            self.when(1, 1, 0), self.when(5, 1, 0))]
+
+        assert archive.archive_month(date(2017, 1, 1)) == 4
+        assert archive.archive_month(date(2017, 2, 1)) == 2
+        assert archive.archive_month(date(2017, 2, 1)) == 0
+        assert archive.archived_months() == [date(2017, 1, 1), date(2017, 2, 1)]
+        assert Souvenir.objects.count() == 3
+
+        assert self.counts() == expected
+        assert count_active_users_many(self.periods) == expected
+        assert [r.active_users for r in calendar_monthly_usage(
+            self.when(1, 1, 0), self.when(5, 1, 0))] == usage
+        assert self.counts(sample=1) == expected
+        assert count_active_users_many(self.periods, sample=1) == expected
+
+    def test_archive_merges(self):
+        archive.archive_month(date(2017, 1, 1))
+        # backfilled after archiving
+        SouvenirFactory(user=self.users[3], when=self.when(1, 20))
+        SouvenirFactory(user=self.users[3], when=self.when(1, 1, 0))
+        assert archive.archive_month(date(2017, 1, 1)) == 2
+        with archive.MonthArchive(archive.archive_path(date(2017, 1, 1))) as a:
+            assert a.count == 6
+            times, users = a.columns(0, a.count)
+            assert list(times) == sorted(times)
+            assert a.span(archive.epoch(self.when(1, 14, 12)),
+                          archive.epoch(self.when(1, 20))) == (2, 4)
+        assert count_active_users(*self.periods[1]) == 3
+
+    def test_tenants_stay(self):
+        u, u2, u3, u4 = self.users
+        SouvenirFactory(user=u4, when=self.when(1, 20), tenant='acme')
+        periods = [(self.when(1, 1, 0), self.when(2, 1, 0)),
+                   (self.when(2, 1, 0), self.when(3, 1, 0))]
+        expected = active_users_by_tenant(periods)
+        assert expected == {None: [2, 2], 'acme': [1, 0]}
+        assert count_active_users_by_tenant(*periods[0]) == {None: 2, 'acme': 1}
+
+        assert archive.archive_month(date(2017, 1, 1)) == 4
+        assert archive.archive_month(date(2017, 2, 1)) == 2
+        assert Souvenir.objects.filter(tenant='acme').count() == 1
+        assert active_users_by_tenant(periods) == expected
+        assert count_active_users_by_tenant(*periods[0]) == {None: 2, 'acme': 1}
+        assert count_active_users_by_tenant() == {None: 4, 'acme': 1}
+
+    def test_rebuild_user_activity(self):
+        u, u2, u3, u4 = self.users
+        archive.archive_month(date(2017, 1, 1))
+        archive.archive_month(date(2017, 2, 1))
+        # backfilled after archiving, on an archived day
+        SouvenirFactory(user=u2, when=self.when(1, 14, 20))
+
+        assert rebuild_user_activity() == 4
+        activity = UserActivity.objects.get(user=u)
+        assert (activity.first_seen, activity.last_seen) == (
+            self.when(1, 1, 0), self.when(2, 14, 12))
+        assert (activity.souvenir_count, activity.active_days) == (3, 3)
+        activity = UserActivity.objects.get(user=u2)
+        assert (activity.first_seen, activity.last_seen) == (
+            self.when(1, 14, 12), self.when(3, 3, 3))
+        assert (activity.souvenir_count, activity.active_days) == (4, 2)
+        assert UserActivity.objects.get(user=u4).souvenir_count == 1
+
+        assert rebuild_user_activity(users=[u4]) == 1
+        assert rebuild_user_activity(
+            users=get_user_model().objects.filter(pk=u.pk)) == 1
+        assert UserActivity.objects.count() == 4
+
+    def reports(self):
+        start, end = self.when(1, 1, 0), self.when(5, 1, 0)
+        return [
+            list(cohort_retention(start, end=self.when(4, 1, 0))),
+            list(rolling_active_users(start, end, window=7)),
+            engagement_histogram(start, end),
+            activity_heatmap(start, end),
+            activity_heatmap(start, end, distinct_users=False),
+        ]
+
+    def test_reports(self, mocker):
+        get_user_model().objects.update(date_joined=self.when(1, 1, 0))
+        expected = self.reports()
+        assert [c['usage']['active_users'] for c in expected[0]] == [
+            [2, 2, 2], [0, 0], [0]]
+        assert expected[2] == [(1, 1, 1), (2, 5, 3), (6, 15, 0), (16, None, 0)]
+
+        archive.archive_month(date(2017, 1, 1))
+        archive.archive_month(date(2017, 2, 1))
+        assert self.reports() == expected
+        # grouped in Python on other databases
+        mocker.patch.dict(_HourOfWeek.templates, clear=True)
+        assert self.reports()[3:] == expected[3:]
+
+    def export(self, *args):
+        out = StringIO()
+        call_command('export_souvenirs', '--chunk-size=2', *args, stdout=out)
+        return out.getvalue().splitlines()
+
+    def test_export(self, tmpdir):
+        expected = self.export()
+        assert len(expected) == 10
+        assert self.export('--after=1/14/2017', '--before=3/1/2017') == (
+            expected[:1] + expected[2:7])
+
+        cursor = str(tmpdir.join('cursor'))
+        archive.archive_month(date(2017, 1, 1))
+        assert self.export() == expected
+        assert self.export('--after=1/14/2017', '--before=3/1/2017') == (
+            expected[:1] + expected[2:7])
+        assert self.export('--cursor', cursor, '--before=1/20/2017') == (
+            expected[:4])
+        assert self.export('--cursor', cursor) == expected[4:]
+
+    def test_admin(self, admin_client, mocker, settings):
+        settings.SOUVENIRS_EXCLUDE_PATHS = [r'^/admin/']
+        mocker.patch('souvenirs.admin.SouvenirAdmin.list_per_page', 4)
+        url = reverse('admin:souvenirs_souvenir_changelist')
+
+        def pages(query=''):
+            pages, next_url = [], url + query
+            while next_url:
+                response = admin_client.get(next_url)
+                assert response.status_code == 200
+                cl = response.context['cl']
+                pages.append([(s.when, s.user_id) for s in cl.result_list])
+                next_url = cl.next_url and url + cl.next_url
+            return pages, cl.result_count
+
+        expected = pages()
+        assert [len(p) for p in expected[0]] == [4, 4, 1]
+        january = pages('?month=2017-01')
+        assert january[1] == 4
+        u2 = pages('?month=2017-01&user={}'.format(self.users[1].pk))
+        assert u2[1] == 2
+
+        archive.archive_month(date(2017, 1, 1))
+        assert pages() == expected
+        assert pages('?month=2017-01') == january
+        assert pages('?month=2017-01&user={}'.format(self.users[1].pk)) == u2
+        assert pages('?month=2017-01&when__gte=2017-01-14') == (
+            [january[0][0][:3]], 3)
+        assert pages('?month=2017-01&tenant=acme') == ([[]], 0)
+
+    def test_batches(self, mocker):
+        with CaptureQueriesContext(connection) as queries:
+            assert archive.archive_month(date(2017, 1, 1), batch_size=1) == 4
+        assert sum('DELETE FROM' in q['sql'] for q in
+                   queries.captured_queries) == 4
+
+        # a failure to delete leaves rows in the table, skipped next time
+        mocker.patch('souvenirs.archive._delete_in_batches',
+                     side_effect=RuntimeError)
+        with pytest.raises(RuntimeError):
+            archive.archive_month(date(2017, 2, 1))
+        assert Souvenir.objects.filter(when__lt=self.when(3, 1, 0)).count() == 2
+        mocker.stopall()
+        assert archive.archive_month(date(2017, 2, 1)) == 0
+        with archive.MonthArchive(archive.archive_path(date(2017, 2, 1))) as a:
+            assert a.count == 2
+        assert Souvenir.objects.filter(when__lt=self.when(3, 1, 0)).count() == 0
+        assert activity_heatmap(self.when(2, 1, 0), self.when(3, 1, 0),
+                                distinct_users=False)[1][12] == 2
+
+    def test_command(self):
+        out = StringIO()
+        call_command('archive_souvenirs', '--before=3/2/2017', stdout=out)
+        assert out.getvalue().splitlines() == [
+            'archived 4 souvenirs from 2017-01',
+            'archived 2 souvenirs from 2017-02',
+        ]
+        assert self.counts() == [4, 2, 1, 1, 4, 1, 2]
+
+    def test_command_requires_dir(self, settings):
+        settings.SOUVENIRS_ARCHIVE_DIR = None
+        with pytest.raises(Exception):
+            call_command('archive_souvenirs')
@@ -1,11 +1,17 @@
 from __future__ import absolute_import, unicode_literals
 
-from datetime import datetime
+from datetime import date, datetime
+import gzip
+import json
+from django.contrib.auth import get_user_model
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.utils import timezone
 from django.utils.six import StringIO
 import pytest
-from .factories import SouvenirFactory
+from souvenirs.control import backfill_souvenirs
+from souvenirs.models import RegistrationDay, Souvenir, UserActivity
+from .factories import SouvenirFactory, UserFactory
 
 
 @pytest.mark.django_db
@@ -176,3 +182,300 @@ class TestShowUsage:
             Y07     2016-01-24  2017-01-24             8            8         1
             Y08     2017-01-24  2017-04-04             9            9         1
         '''.split()
+
+    def test_show_usage_rolling(self):
+        out = StringIO()
+        call_command('show_usage', '--rolling=3',
+                     '--after=2/12/2011',
+                     '--before=2/19/2011',
+                     stdout=out)
+        assert out.getvalue().split() == '''
+            date          active
+            ----------  --------
+            2011-02-19         0
+            2011-02-18         0
+            2011-02-17         1
+            2011-02-16         1
+            2011-02-15         1
+            2011-02-14         0
+            2011-02-13         0
+        '''.split()
+
+    def test_show_usage_cohorts(self):
+        out = StringIO()
+        call_command('show_usage', '--cohorts',
+                     '--subscription-start=12/14/2016',
+                     '--before=3/14/2017',
+                     stdout=out)
+        assert out.getvalue().split() == '''
+            month    start         registered    M+0  M+1    M+2
+            -------  ----------  ------------  -----  -----  -----
+            Y01 M03  2017-02-14             1      1
+            Y01 M02  2017-01-14             0      0  0
+            Y01 M01  2016-12-14             0      0  0      0
+        '''.split()
+
+
+@pytest.mark.django_db
+def test_rebuild_user_activity():
+    tzinfo = timezone.get_current_timezone()
+    s = SouvenirFactory(when=datetime(2017, 3, 10, 12, tzinfo=tzinfo))
+    SouvenirFactory(user=s.user, when=datetime(2017, 3, 11, 12, tzinfo=tzinfo))
+    SouvenirFactory(when=datetime(2017, 3, 12, 12, tzinfo=tzinfo))
+    out = StringIO()
+    call_command('rebuild_user_activity', stdout=out)
+    assert out.getvalue() == 'rebuilt activity for 2 users\n'
+    a = UserActivity.objects.get(user=s.user)
+    assert (a.active_days, a.souvenir_count) == (2, 2)
+
+
+@pytest.mark.django_db
+def test_rebuild_registration_days():
+    tzinfo = timezone.get_current_timezone()
+    SouvenirFactory(when=datetime(2017, 3, 10, 12, tzinfo=tzinfo))
+    SouvenirFactory(when=datetime(2017, 3, 10, 13, tzinfo=tzinfo))
+    SouvenirFactory(when=datetime(2017, 3, 12, 12, tzinfo=tzinfo))
+    out = StringIO()
+    call_command('rebuild_registration_days', stdout=out)
+    assert out.getvalue() == 'rebuilt registrations for 2 days\n'
+    assert (RegistrationDay.objects.values_list('joined', 'activated')
+            .get(day=date(2017, 3, 10))) == (2, 2)
+
+
+@pytest.mark.django_db
+class TestExportSouvenirs:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db):
+        self.souvenirs = [
+            SouvenirFactory(when=datetime(2017, 3, day, 12, tzinfo=timezone.utc))
+            for day in (12, 10, 11)
+        ]
+        # same when as the first, to exercise the id tie-break
+        self.souvenirs.append(SouvenirFactory(when=self.souvenirs[1].when))
+
+    def expected(self):
+        return ['{},{}'.format(s.user_id, s.when.isoformat())
+                for s in sorted(self.souvenirs, key=lambda s: (s.when, s.id))]
+
+    def test_csv(self):
+        out = StringIO()
+        call_command('export_souvenirs', '--chunk-size=2', stdout=out)
+        assert out.getvalue().splitlines() == (
+            ['user_id,when'] + self.expected())
+
+    def test_ndjson(self):
+        out = StringIO()
+        call_command('export_souvenirs', '--format=ndjson',
+                     '--after=3/11/2017', '--before=3/12/2017', stdout=out)
+        assert [json.loads(line) for line in out.getvalue().splitlines()] == [
+            {'user_id': self.souvenirs[2].user_id,
+             'when': '2017-03-11T12:00:00+00:00'}]
+
+    def test_gzip_cursor(self, tmpdir):
+        output = str(tmpdir.join('souvenirs.csv.gz'))
+        cursor = str(tmpdir.join('cursor'))
+        call_command('export_souvenirs', '--chunk-size=2', '--gzip',
+                     '--output', output, '--cursor', cursor)
+        with open(cursor) as f:
+            assert json.load(f) == {'when': '2017-03-12T12:00:00+00:00',
+                                    'source': 'souvenirs_souvenir',
+                                    'id': self.souvenirs[0].id}
+
+        # resuming appends only the new souvenirs, without another header
+        self.souvenirs.append(SouvenirFactory(
+            when=datetime(2017, 3, 13, 12, tzinfo=timezone.utc)))
+        call_command('export_souvenirs', '--chunk-size=2', '--gzip',
+                     '--output', output, '--cursor', cursor)
+        with gzip.open(output) as f:
+            assert f.read().decode('utf-8').splitlines() == (
+                ['user_id,when'] + self.expected())
+
+    def test_gzip_requires_output(self):
+        with pytest.raises(CommandError):
+            call_command('export_souvenirs', '--gzip')
+
+
+@pytest.mark.django_db
+class TestImportSouvenirs:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db, tmpdir):
+        self.u1, self.u2 = UserFactory(), UserFactory()
+        self.path = str(tmpdir.join('souvenirs'))
+
+    def whens(self, user):
+        return [w.isoformat() for w in Souvenir.objects.filter(user=user)
+                .order_by('when').values_list('when', flat=True)]
+
+    def test_csv(self):
+        with open(self.path, 'w') as f:
+            f.write('user_id,username,when\n'
+                    '{0},,2017-03-10T12:00:00+00:00\n'
+                    ',{1},2017-03-10T12:30:00+00:00\n'
+                    ',nobody,2017-03-10T12:30:00+00:00\n'
+                    '{0},,2017-03-10T12:00:00+00:00\n'
+                    '{0},,2017-03-10T12:10:00+00:00\n'.format(
+                        self.u1.pk, self.u2.username))
+        out = StringIO()
+        call_command('import_souvenirs', self.path, '--ratelimit=300',
+                     stdout=out)
+        assert out.getvalue() == (
+            'added 3, duplicated 1, rate-limited 0, unknown users 1\n')
+        assert self.whens(self.u1) == ['2017-03-10T12:00:00+00:00',
+                                       '2017-03-10T12:10:00+00:00']
+        assert self.whens(self.u2) == ['2017-03-10T12:30:00+00:00']
+        assert UserActivity.objects.get(user=self.u1).souvenir_count == 2
+
+    def test_export_roundtrip_ndjson(self):
+        SouvenirFactory(user=self.u1,
+                        when=datetime(2017, 3, 10, 12, tzinfo=timezone.utc))
+        SouvenirFactory(user=self.u2,
+                        when=datetime(2017, 3, 10, 13, tzinfo=timezone.utc))
+        call_command('export_souvenirs', '--format=ndjson', '--gzip',
+                     '--output', self.path)
+        Souvenir.objects.filter(user=self.u2).delete()
+        out = StringIO()
+        call_command('import_souvenirs', self.path, '--format=ndjson',
+                     '--gzip', stdout=out)
+        assert out.getvalue() == (
+            'added 1, duplicated 1, rate-limited 0, unknown users 0\n')
+        assert self.whens(self.u2) == ['2017-03-10T13:00:00+00:00']
+
+    def test_bad_date(self):
+        with open(self.path, 'w') as f:
+            f.write('user_id,when\n{},yesterday-ish\n'.format(self.u1.pk))
+        with pytest.raises(CommandError):
+            call_command('import_souvenirs', self.path)
+
+
+@pytest.mark.django_db
+class TestBackfillSouvenirs:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db):
+        self.joined = datetime(2017, 3, 1, 12, tzinfo=timezone.utc)
+        self.login = datetime(2017, 3, 10, 12, tzinfo=timezone.utc)
+        self.u1 = UserFactory(date_joined=self.joined, last_login=self.login)
+        self.u2 = UserFactory(date_joined=self.joined, last_login=None)
+        self.u3 = UserFactory(date_joined=self.login, last_login=self.login)
+
+    def whens(self, user):
+        return list(Souvenir.objects.filter(user=user)
+                    .order_by('when').values_list('when', flat=True))
+
+    def test_backfill(self):
+        SouvenirFactory(user=self.u1, when=self.login)
+        out = StringIO()
+        call_command('backfill_souvenirs', '--chunk-size=1', stdout=out)
+        assert out.getvalue() == 'added 3 souvenirs\n'
+        assert self.whens(self.u1) == [self.joined, self.login]
+        assert self.whens(self.u2) == [self.joined]
+        assert self.whens(self.u3) == [self.login]
+
+        # running it again adds nothing
+        out = StringIO()
+        call_command('backfill_souvenirs', '--rebuild-activity', stdout=out)
+        assert out.getvalue() == ('added 0 souvenirs\n'
+                                  'rebuilt activity for 3 users\n')
+        assert UserActivity.objects.get(user=self.u1).souvenir_count == 2
+
+    def test_users_and_sql(self):
+        later = datetime(2017, 3, 20, 12, tzinfo=timezone.utc)
+        SouvenirFactory(user=self.u1, when=later)
+        added = backfill_souvenirs(
+            fields=['last_login'],
+            users=get_user_model().objects.filter(pk=self.u1.pk),
+            sql='SELECT id AS user_id, date_joined AS seen FROM auth_user '
+                'WHERE id = %s',
+            params=[self.u3.pk])
+        assert added == 2
+        assert self.whens(self.u1) == [self.login, later]
+        assert self.whens(self.u2) == []
+        assert self.whens(self.u3) == [self.login]
+
+    def test_sql_repeats(self):
+        sql = ('SELECT id AS user_id, date_joined AS seen FROM auth_user '
+               'UNION ALL SELECT id, date_joined FROM auth_user')
+        assert backfill_souvenirs(fields=[], sql=sql) == 3
+        assert self.whens(self.u1) == [self.joined]
+
+    def test_bad_field(self):
+        with pytest.raises(CommandError):
+            call_command('backfill_souvenirs', '--field=nope')
+
+    @pytest.mark.parametrize('storage', ['bucketed', 'partitioned'])
+    def test_storage_unsupported(self, settings, storage):
+        settings.SOUVENIRS_STORAGE = storage
+        with pytest.raises(CommandError):
+            call_command('backfill_souvenirs')
+        assert not Souvenir.objects.exists()
+
+
+@pytest.mark.django_db
+def test_purge_user_souvenirs():
+    tzinfo = timezone.get_current_timezone()
+    s = SouvenirFactory(when=datetime(2017, 3, 10, 12, tzinfo=tzinfo))
+    SouvenirFactory(user=s.user, when=datetime(2017, 3, 11, 12, tzinfo=tzinfo))
+    other = SouvenirFactory(when=datetime(2017, 3, 12, 12, tzinfo=tzinfo))
+    out = StringIO()
+    call_command('purge_user_souvenirs', s.user.username, '--batch-size=1',
+                 '--delete-users', stdout=out)
+    assert out.getvalue() == 'purged 2 souvenirs for {0}\ndeleted {0}\n'.format(
+        s.user.username)
+    assert list(Souvenir.objects.all()) == [other]
+    with pytest.raises(CommandError):
+        call_command('purge_user_souvenirs', '--pk', 'x')
+
+
+@pytest.mark.django_db
+def test_show_usage_engagement():
+    tzinfo = timezone.get_current_timezone()
+    s = SouvenirFactory(when=datetime(2017, 3, 10, 12, tzinfo=tzinfo))
+    SouvenirFactory(user=s.user, when=datetime(2017, 3, 11, 12, tzinfo=tzinfo))
+    SouvenirFactory(user=s.user, when=datetime(2017, 4, 11, 12, tzinfo=tzinfo))
+    SouvenirFactory(when=datetime(2017, 3, 12, 12, tzinfo=tzinfo))
+    out = StringIO()
+    call_command('show_usage', '--engagement', '--buckets=1,2',
+                 '--subscription-start=1/1/2017', '--after=2/1/2017',
+                 '--before=5/1/2017', stdout=out)
+    assert out.getvalue().split() == '''
+        month    start       end           1    2+
+        -------  ----------  ----------  ---  ----
+        Y01 M04  2017-04-01  2017-05-01    1     0
+        Y01 M03  2017-03-01  2017-04-01    1     1
+        Y01 M02  2017-02-01  2017-03-01    0     0
+    '''.split()
+    with pytest.raises(CommandError):
+        call_command('show_usage', '--engagement', '--buckets=2,1',
+                     '--subscription-start=1/1/2017')
+
+
+@pytest.mark.django_db
+def test_show_usage_heatmap():
+    make_aware = timezone.make_aware
+    s = SouvenirFactory(when=make_aware(datetime(2017, 3, 6, 9, 30)))
+    SouvenirFactory(user=s.user, when=make_aware(datetime(2017, 3, 13, 9, 30)))
+    SouvenirFactory(when=make_aware(datetime(2017, 3, 12, 23, 30)))
+    out = StringIO()
+    call_command('show_usage', '--heatmap', '--csv', '--after=3/1/2017',
+                 '--before=3/20/2017', stdout=out)
+    lines = out.getvalue().splitlines()
+    assert lines[0].startswith('day,00,01,')
+    assert [line.split(',')[0] for line in lines[1:]] == [
+        'Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+    assert lines[1].split(',')[10] == '1'
+    assert lines[7].split(',')[24] == '1'
+
+    out = StringIO()
+    call_command('show_usage', '--heatmap', '--csv', '--souvenirs',
+                 '--timezone=UTC', '--after=3/1/2017', '--before=3/20/2017',
+                 stdout=out)
+    monday = out.getvalue().splitlines()[1].split(',')
+    assert (monday[4], monday[14], monday[15]) == ('1', '1', '1')
+
+    with pytest.raises(CommandError):
+        call_command('show_usage', '--heatmap', '--timezone=Nowhere/Else',
+                     '--after=3/1/2017')
+    with pytest.raises(CommandError):
+        call_command('show_usage', '--heatmap')
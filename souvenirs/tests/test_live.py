@@ -0,0 +1,74 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.utils import timezone
+import pytest
+from souvenirs.control import souvenez
+from souvenirs.live import _Sketch, concurrent_users, live_active_users
+from .factories import UserFactory
+
+
+@pytest.mark.django_db
+class TestLiveCounters:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db, settings, mocker):
+        settings.SOUVENIRS_LIVE_COUNTERS = True
+        cache.clear()
+        tzinfo = timezone.get_default_timezone()
+        self.now = timezone.make_aware(datetime(2017, 3, 10, 23, 30), tzinfo)
+        mocker.patch('souvenirs.live.timezone.now', lambda: self.now)
+        self.users = [UserFactory() for _ in range(3)]
+
+    def test_live_active_users(self, django_assert_num_queries):
+        u1, u2, u3 = self.users
+        souvenez(u1, when=self.now)
+        souvenez(u1, when=self.now + timedelta(minutes=5))  # rate-limited
+        souvenez(u1, when=self.now + timedelta(hours=2))    # the next day
+        souvenez(u2, when=self.now)
+        souvenez(u3, when=self.now - timedelta(days=5))
+
+        with django_assert_num_queries(0):
+            assert live_active_users('day') == 2
+            assert live_active_users('month') == 3
+            assert live_active_users('day', when=self.now + timedelta(hours=2)) == 1
+            # that day ended too long ago to start counting
+            assert live_active_users('day', when=self.now - timedelta(days=5)) == 0
+            assert live_active_users('month', when=self.now + timedelta(days=30)) == 0
+
+        with pytest.raises(ValueError):
+            live_active_users('week')
+
+    def test_old_periods_are_not_counted(self):
+        souvenez(self.users[0], when=self.now - timedelta(days=40))
+        assert live_active_users('month',
+                                 when=self.now - timedelta(days=40)) == 0
+
+    def test_disabled(self, settings):
+        settings.SOUVENIRS_LIVE_COUNTERS = False
+        souvenez(self.users[0], when=self.now)
+        assert live_active_users() == 0
+        assert concurrent_users() == 0
+
+    def test_concurrent_users(self, django_assert_num_queries):
+        u1, u2, u3 = self.users
+        souvenez(u1, when=self.now - timedelta(minutes=2))
+        souvenez(u1, when=self.now)  # rate-limited, but still seen
+        souvenez(u2, when=self.now - timedelta(minutes=1))
+        souvenez(u3, when=self.now - timedelta(minutes=10))
+        with django_assert_num_queries(0):
+            assert concurrent_users(1) == 1
+            assert concurrent_users(5) == 2
+            assert concurrent_users(15) == 3
+        with pytest.raises(ValueError):
+            concurrent_users(61)
+
+
+def test_sketch():
+    sketch, other = _Sketch(), _Sketch()
+    for i in range(20000):
+        (sketch if i % 2 else other).add(i)
+    assert sketch.add(1) is False
+    sketch.update(_Sketch(other.dumps()))
+    assert abs(sketch.estimate() - 20000) < 20000 * 0.1
@@ -1,9 +1,15 @@
 from __future__ import absolute_import, unicode_literals
 
-from datetime import timedelta
+from datetime import datetime, timedelta
+import time
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.signals import request_finished
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory
 from django.utils import timezone
 import pytest
+from souvenirs.control import _souvenez_window, souvenez
 from souvenirs.middleware import SouvenirsMiddleware
 from souvenirs.models import Souvenir
 from .factories import UserFactory
@@ -31,3 +37,181 @@ class TestMiddleware:
         assert Souvenir.objects.count() == 0
         assert self.sm.process_request(self.request) is None
         assert Souvenir.objects.count() == 0
+
+
+@pytest.mark.django_db
+class TestMiddlewareSession:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, mocker, settings):
+        cache.clear()
+        settings.SOUVENIRS_USE_SESSION = True
+        settings.SOUVENIRS_RATELIMIT_SECONDS = 3600
+        self.sm = SouvenirsMiddleware()
+        self.request = mocker.Mock(path_info='/', method='GET', session={})
+        self.request.user = UserFactory()
+        self.souvenez = mocker.patch('souvenirs.middleware._souvenez_window',
+                                     wraps=_souvenez_window)
+        self.time = mocker.patch('souvenirs.middleware.time').time
+        self.time.return_value = 1489147200  # 2017-03-10 12:00 UTC
+
+    def test_session_skips_souvenez(self):
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 1
+        assert Souvenir.objects.count() == 1
+        assert self.request.session[self.sm.session_key] == 1489147200
+
+        self.time.return_value += 3599
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 1
+
+        # outside the window souvenez decides again
+        self.time.return_value += 1
+        cache.clear()
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 2
+        assert Souvenir.objects.count() == 2
+        assert self.request.session[self.sm.session_key] == 1489150800
+
+    def test_session_updated_when_rate_limited(self):
+        noon = datetime(2017, 3, 10, 12, tzinfo=timezone.utc)
+        souvenez(self.request.user, when=noon)  # e.g. from another session
+        self.time.return_value += 600
+        self.sm.process_request(self.request)
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 1
+        # the window started with the other session's souvenir
+        assert self.request.session[self.sm.session_key] == 1489147200
+        assert Souvenir.objects.count() == 1
+
+    def test_rate_limited_window_ends_on_time(self):
+        noon = datetime(2017, 3, 10, 12, tzinfo=timezone.utc)
+        souvenez(self.request.user, when=noon)  # e.g. from another session
+        self.time.return_value += 3599  # 12:59:59, rate-limited
+        self.sm.process_request(self.request)
+        assert Souvenir.objects.count() == 1
+
+        self.time.return_value += 2  # 13:00:01, after noon's window
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 2
+        assert Souvenir.objects.count() == 2
+        assert self.request.session[self.sm.session_key] == 1489150801
+
+    def test_session_bucketed(self, settings):
+        settings.SOUVENIRS_STORAGE = 'bucketed'
+        self.time.return_value += 3000  # 12:50
+        self.sm.process_request(self.request)
+        self.time.return_value += 599  # 12:59:59
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 1
+        self.time.return_value += 1  # 13:00, new bucket
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 2
+
+    def test_without_session(self):
+        del self.request.session
+        self.sm.process_request(self.request)
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 2
+        assert Souvenir.objects.count() == 1
+
+    def test_exclusions(self, settings):
+        settings.SOUVENIRS_EXCLUDE_PATHS = [r'/static/', r'/health$']
+        settings.SOUVENIRS_EXCLUDE_METHODS = ['HEAD', 'OPTIONS']
+        for path, method in [('/static/app.js', 'GET'),
+                             ('/health', 'GET'),
+                             ('/', 'HEAD')]:
+            self.request.path_info, self.request.method = path, method
+            self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 0
+
+        self.request.path_info, self.request.method = '/health/detail', 'POST'
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 1
+
+    def test_tenant_resolver(self, settings):
+        settings.SOUVENIRS_TENANT_RESOLVER = (
+            'souvenirs.tests.test_middleware.tenant_from_host')
+        self.request.get_host.return_value = 'acme.example.com'
+        self.sm.process_request(self.request)
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 1
+        assert self.request.session[self.sm.tenant_session_key] == 'acme'
+
+        # another tenant isn't skipped by the session
+        self.request.get_host.return_value = 'initech.example.com'
+        self.sm.process_request(self.request)
+        assert self.souvenez.call_count == 2
+        assert sorted(Souvenir.objects.values_list('tenant', flat=True)) == [
+            'acme', 'initech']
+
+
+@pytest.mark.django_db
+class TestMiddlewareDeferred:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        cache.clear()
+        settings.SOUVENIRS_DEFER_WRITES = True
+        self.sm = SouvenirsMiddleware()
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user = UserFactory()
+
+    def test_latency(self, mocker):
+        def slow_souvenez(*args, **kwargs):
+            time.sleep(0.5)
+            return souvenez(*args, **kwargs)
+        slow = mocker.patch('souvenirs.middleware.souvenez',
+                            side_effect=slow_souvenez)
+        started = time.time()
+        assert self.sm.process_request(self.request) is None
+        response = self.sm.process_response(self.request, HttpResponse())
+        assert time.time() - started < 0.5
+        assert slow.call_count == 0
+        assert Souvenir.objects.count() == 0
+
+        response.close()
+        assert slow.call_count == 1
+        s = Souvenir.objects.get()
+        assert s.user == self.user
+        # the time of the request, not of the write
+        assert timezone.now() - s.when >= timedelta(seconds=0.5)
+
+    def test_request_finished(self):
+        self.sm.process_request(self.request)
+        response = HttpResponse()
+        assert self.sm.process_response(self.request, response) is response
+        assert Souvenir.objects.count() == 0
+        request_finished.send(sender=self.__class__)
+        assert Souvenir.objects.filter(user=self.user).count() == 1
+        # only once
+        request_finished.send(sender=self.__class__)
+        assert Souvenir.objects.count() == 1
+
+    def test_streaming(self):
+        self.sm.process_request(self.request)
+        response = self.sm.process_response(
+            self.request, StreamingHttpResponse(iter(['a', 'b'])))
+        assert b''.join(response.streaming_content) == b'ab'
+        assert Souvenir.objects.count() == 0
+        response.close()
+        assert Souvenir.objects.filter(user=self.user).count() == 1
+
+    def test_client(self, client):
+        client.login(username=self.user.username, password='password')
+        response = client.get('/nowhere/')
+        assert response.status_code == 404
+        assert Souvenir.objects.filter(user=self.user).count() == 1
+
+    def test_failure_isolated(self, client, mocker):
+        client.login(username=self.user.username, password='password')
+        mocker.patch('souvenirs.middleware.souvenez', side_effect=RuntimeError)
+        log = mocker.patch('souvenirs.middleware.logger')
+        response = client.get('/nowhere/')
+        assert response.status_code == 404
+        assert log.exception.call_count == 1
+        assert Souvenir.objects.count() == 0
+
+
+def tenant_from_host(request):
+    return request.get_host().split('.')[0]
@@ -1,10 +1,16 @@
 from __future__ import absolute_import, unicode_literals
 
 import datetime
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import IntegrityError
 from django.utils import timezone
 import pytest
-from souvenirs.models import Souvenir
-from souvenirs.control import count_active_users, souvenez
+from souvenirs.models import Souvenir, UserActivity
+from souvenirs.control import (Estimate, bulk_souvenez, count_active_users,
+                               count_active_users_by_tenant,
+                               count_active_users_many, purge_user_souvenirs,
+                               rebuild_user_activity, souvenez)
 from .factories import SouvenirFactory, UserFactory
 
 
@@ -56,3 +62,315 @@ class TestSouvenir:
             SouvenirFactory(user=s.user, when=s.when)
         self.test_count_active_users()
 
+    def test_count_active_users_many(self, django_assert_num_queries):
+        SouvenirFactory(user=self.souvenirs[0].user, when=datetime.datetime(
+            year=2014, month=6, day=1, tzinfo=self.tzinfo))
+        make_when = lambda y, m=2, d=14, h=12: datetime.datetime(
+            year=y, month=m, day=d, hour=h, tzinfo=self.tzinfo)
+        periods = [
+            (make_when(2013, 1), make_when(2015)),
+            (None, None),
+            (make_when(2012, d=1), make_when(2014, 7)),   # overlaps the first
+            (make_when(2015), make_when(2013)),          # backwards
+            (make_when(2013), make_when(2013)),          # empty
+            (make_when(2013), None),
+            (None, make_when(2013)),
+            (make_when(2016, 1), make_when(2016, 3)),    # disjoint
+            (make_when(2010), make_when(2010, h=13)),
+        ]
+        with django_assert_num_queries(1):
+            counts = count_active_users_many(periods)
+        assert counts == [count_active_users(*p) for p in periods]
+        assert counts == [3, 8, 4, 0, 0, 6, 3, 1, 1]
+
+        assert count_active_users_many([]) == []
+        assert count_active_users_many(periods, qs=Souvenir.objects.filter(
+            user=self.souvenirs[0].user)) == [1, 1, 1, 0, 0, 1, 1, 0, 1]
+
+    def test_count_active_users_many_chunks(self, django_assert_num_queries):
+        periods = [(datetime.datetime(year=y, month=m, day=d, tzinfo=self.tzinfo),
+                    datetime.datetime(year=y, month=m, day=d + 1, tzinfo=self.tzinfo))
+                   for y in range(2009, 2019) for m in range(1, 13) for d in (1, 14)]
+        with django_assert_num_queries(3):
+            counts = count_active_users_many(periods)
+        assert sum(counts) == 8
+        assert counts == [count_active_users(*p) for p in periods]
+
+
+@pytest.mark.django_db
+class TestSampling:
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.now = timezone.now()
+        User = get_user_model()
+        User.objects.bulk_create(User(username='sampled{}'.format(i))
+                                 for i in range(300))
+        self.users = list(User.objects.filter(username__startswith='sampled')
+                          .order_by('pk'))
+        Souvenir.objects.bulk_create(
+            Souvenir(user=u, when=self.now - datetime.timedelta(days=i % 3))
+            for i, u in enumerate(self.users))
+
+    def sampled(self, sample, days=3):
+        return sum(1 for i, u in enumerate(self.users)
+                   if u.pk % 1000 < sample * 1000 and i % 3 < days)
+
+    def test_count_active_users_sample(self):
+        n = self.sampled(0.2)
+        estimate = count_active_users(sample=0.2)
+        assert isinstance(estimate, Estimate)
+        assert estimate == round(n / 0.2)
+        assert n <= estimate.low < estimate < estimate.high
+        assert estimate.sample == 0.2
+
+        exact = count_active_users(sample=1)
+        assert exact == exact.low == exact.high == 300
+
+        start = self.now - datetime.timedelta(days=1, hours=12)
+        assert count_active_users(start=start, sample=0.2) == round(
+            self.sampled(0.2, days=2) / 0.2)
+
+        with pytest.raises(ValueError):
+            count_active_users(sample=0)
+        with pytest.raises(ValueError):
+            count_active_users(sample=1.5)
+
+    def test_estimate_without_users(self):
+        estimate = Estimate.scale(0, 0.05)
+        assert (estimate, estimate.low, estimate.high) == (0, 0, 60)
+
+    def test_count_active_users_many_sample(self):
+        start = self.now - datetime.timedelta(days=1, hours=12)
+        periods = [(None, None), (start, None)]
+        counts = count_active_users_many(periods, sample=0.2)
+        assert counts == [count_active_users(*p, sample=0.2) for p in periods]
+        assert [(c.low, c.high) for c in counts] == [
+            (c.low, c.high) for c in (count_active_users(*p, sample=0.2)
+                                      for p in periods)]
+
+
+@pytest.mark.django_db
+class TestTenant:
+
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        cache.clear()
+        self.u, self.u2 = UserFactory(), UserFactory()
+
+    def test_souvenez_tenant(self):
+        assert souvenez(self.u, tenant='acme') == 'added'
+        assert souvenez(self.u, tenant='acme') == 'rate-limited'
+        # rate-limited per tenant
+        assert souvenez(self.u, tenant='initech') == 'added'
+        assert souvenez(self.u) == 'added'
+        assert set(Souvenir.objects.values_list('tenant', flat=True)) == {
+            None, 'acme', 'initech'}
+
+    def test_count_active_users_by_tenant(self, django_assert_num_queries):
+        now = timezone.now()
+        souvenez(self.u, tenant='acme')
+        souvenez(self.u2, tenant='acme')
+        souvenez(self.u2, tenant='initech')
+        souvenez(self.u2)
+        souvenez(self.u, when=now - datetime.timedelta(days=2), tenant='initech')
+        with django_assert_num_queries(1):
+            counts = count_active_users_by_tenant()
+        assert counts == {'acme': 2, 'initech': 2, None: 1}
+        assert count_active_users_by_tenant(
+            start=now - datetime.timedelta(days=1)) == {
+                'acme': 2, 'initech': 1, None: 1}
+        assert count_active_users_by_tenant(end=now - datetime.timedelta(days=3)) == {}
+
+
+@pytest.mark.django_db
+class TestUserActivity:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db):
+        self.tzinfo = timezone.get_default_timezone()
+        self.user = UserFactory()
+
+    def when(self, day, hour):
+        return timezone.make_aware(
+            datetime.datetime(2017, 3, day, hour), self.tzinfo)
+
+    def test_souvenez_updates_activity(self):
+        souvenez(self.user, when=self.when(10, 12), ratelimit=False)
+        a = UserActivity.objects.get(user=self.user)
+        assert (a.first_seen, a.last_seen, a.active_days, a.souvenir_count) == (
+            self.when(10, 12), self.when(10, 12), 1, 1)
+
+        # later the same day, then a new day
+        souvenez(self.user, when=self.when(10, 23), ratelimit=False)
+        souvenez(self.user, when=self.when(12, 1), ratelimit=False)
+        # backfill before, inside an existing day, and into a gap
+        souvenez(self.user, when=self.when(8, 12), ratelimit=False)
+        souvenez(self.user, when=self.when(10, 0), ratelimit=False)
+        souvenez(self.user, when=self.when(11, 12), ratelimit=False)
+
+        a = UserActivity.objects.get(user=self.user)
+        assert (a.first_seen, a.last_seen, a.active_days, a.souvenir_count) == (
+            self.when(8, 12), self.when(12, 1), 4, 6)
+
+        # not added, so not counted
+        assert souvenez(self.user, when=self.when(12, 1), ratelimit=False,
+                        check_duplicate=True) == 'duplicated'
+        assert UserActivity.objects.get(user=self.user).souvenir_count == 6
+
+    def test_rebuild_user_activity(self):
+        u2 = UserFactory()
+        for day, hour in [(10, 12), (10, 23), (12, 1), (8, 12), (11, 12)]:
+            souvenez(self.user, when=self.when(day, hour), ratelimit=False)
+        souvenez(u2, when=self.when(1, 1), ratelimit=False)
+        expected = list(UserActivity.objects.order_by('user').values())
+
+        UserActivity.objects.all().delete()
+        assert rebuild_user_activity(batch_size=1) == 2
+        assert list(UserActivity.objects.order_by('user').values()) == expected
+
+        # rebuilding one user leaves the others alone
+        UserActivity.objects.filter(user=u2).update(souvenir_count=42)
+        assert rebuild_user_activity(users=[self.user]) == 1
+        assert list(UserActivity.objects.order_by('user').values_list(
+            'souvenir_count', flat=True)) == [5, 42]
+
+
+@pytest.mark.django_db
+class TestBulkSouvenez:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db):
+        self.u1, self.u2 = UserFactory(), UserFactory()
+
+    def when(self, hour, minute=0):
+        return datetime.datetime(2017, 3, 10, hour, minute, tzinfo=timezone.utc)
+
+    def test_bulk_souvenez(self):
+        souvenez(self.u1, when=self.when(12), ratelimit=False)
+        records = [(self.u1.pk, self.when(h, m)) for h, m in
+                   [(12, 0), (12, 30), (13, 0), (13, 0), (11, 0)]]
+        records.append((self.u2.pk, self.when(12, 30)))
+        assert bulk_souvenez(records) == {'added': 4, 'duplicated': 2}
+        assert Souvenir.objects.count() == 5
+        a = UserActivity.objects.get(user=self.u1)
+        assert (a.first_seen, a.last_seen, a.souvenir_count) == (
+            self.when(11), self.when(13), 4)
+
+    def test_chunks(self, django_assert_num_queries):
+        records = [(self.u1.pk, self.when(12, m)) for m in range(10)]
+        # per chunk: range query, savepoint, INSERT, release; then rebuilding
+        # the activity summary for the one user takes five more.
+        with django_assert_num_queries(3 * 4 + 5):
+            assert bulk_souvenez(records, chunk_size=4, batch_size=4) == {
+                'added': 10}
+        assert bulk_souvenez(records, chunk_size=4) == {'duplicated': 10}
+
+    def test_ratelimit(self):
+        records = [(self.u1.pk, self.when(h, m)) for h, m in
+                   [(12, 0), (12, 59), (13, 0), (13, 30), (14, 10)]]
+        records.append((self.u2.pk, self.when(12, 30)))
+        assert bulk_souvenez(records, ratelimit=3600, chunk_size=2) == {
+            'added': 4, 'rate-limited': 2}
+        assert list(Souvenir.objects.filter(user=self.u1).order_by('when')
+                    .values_list('when', flat=True)) == [
+            self.when(12), self.when(13), self.when(14, 10)]
+
+    def test_bucketed(self, settings):
+        settings.SOUVENIRS_STORAGE = 'bucketed'
+        settings.SOUVENIRS_RATELIMIT_SECONDS = 3600
+        souvenez(self.u1, when=self.when(12, 10))
+        records = [(self.u1.pk, self.when(h, m)) for h, m in
+                   [(12, 20), (13, 10), (13, 50)]]
+        assert bulk_souvenez(records) == {'added': 1, 'rate-limited': 2}
+        assert list(Souvenir.objects.order_by('when')
+                    .values_list('when', flat=True)) == [
+            self.when(12), self.when(13)]
+
+
+@pytest.mark.django_db
+class TestPurgeUserSouvenirs:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db):
+        self.user, self.other = UserFactory(), UserFactory()
+        start = datetime.datetime(2010, 1, 1, tzinfo=timezone.utc)
+        # a long history: hourly for more than a year
+        Souvenir.objects.bulk_create(
+            Souvenir(user=self.user, when=start + datetime.timedelta(hours=h))
+            for h in range(10000))
+        souvenez(self.user, when=start, ratelimit=False)
+        souvenez(self.other, when=start, ratelimit=False)
+
+    def test_purge(self, django_assert_num_queries):
+        # per batch: select, savepoint, delete, release; then the final
+        # select and deleting the activity.
+        with django_assert_num_queries(11 * 4 + 2):
+            assert purge_user_souvenirs(self.user, batch_size=1000) == 10001
+        assert not Souvenir.objects.filter(user=self.user).exists()
+        assert not UserActivity.objects.filter(user=self.user).exists()
+        assert Souvenir.objects.filter(user=self.other).count() == 1
+
+        self.user.delete()
+        assert UserActivity.objects.filter(user=self.other).exists()
+
+    def test_pause(self, mocker):
+        sleep = mocker.patch('souvenirs.control.time.sleep')
+        assert purge_user_souvenirs(self.user.pk, batch_size=4000,
+                                    pause=0.5) == 10001
+        assert sleep.call_args_list == [mocker.call(0.5)] * 2
+
+
+@pytest.mark.django_db
+class TestBucketedStorage:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db, settings, mocker):
+        settings.SOUVENIRS_STORAGE = 'bucketed'
+        settings.SOUVENIRS_RATELIMIT_SECONDS = 3600
+        self.caches = mocker.patch('souvenirs.ratelimit.caches')
+        self.user = UserFactory()
+
+    def when(self, hour, minute):
+        return datetime.datetime(2017, 3, 10, hour, minute, tzinfo=timezone.utc)
+
+    def test_souvenez_bucketed(self):
+        assert souvenez(self.user, when=self.when(12, 10)) == 'added'
+        assert souvenez(self.user, when=self.when(12, 50)) == 'rate-limited'
+        assert souvenez(self.user, when=self.when(13, 0)) == 'added'
+        assert souvenez(UserFactory(), when=self.when(12, 50)) == 'added'
+        # buckets are always SOUVENIRS_RATELIMIT_SECONDS wide
+        assert souvenez(self.user, when=self.when(13, 30), ratelimit=60) == (
+            'rate-limited')
+
+        assert list(Souvenir.objects.filter(user=self.user)
+                    .order_by('when').values_list('when', flat=True)) == [
+            self.when(12, 0), self.when(13, 0)]
+        assert UserActivity.objects.get(user=self.user).souvenir_count == 2
+        assert not self.caches.called
+
+    def test_no_ratelimit(self):
+        # the buckets are the storage, so ratelimit can't turn them off
+        assert souvenez(self.user, when=self.when(12, 50),
+                        ratelimit=False) == 'added'
+        for ratelimit in (False, 0, None):
+            assert souvenez(self.user, when=self.when(12, 55),
+                            ratelimit=ratelimit) == 'rate-limited'
+        assert souvenez(self.user, when=self.when(12, 55), ratelimit=False,
+                        check_duplicate=True) == 'rate-limited'
+        assert list(Souvenir.objects.values_list('when', 'bucket')) == [
+            (self.when(12, 0), 1489147200)]
+        assert not self.caches.called
+
+    def test_other_integrity_errors(self, mocker):
+        mocker.patch('souvenirs.control._update_user_activity',
+                     side_effect=IntegrityError('FOREIGN KEY constraint failed'))
+        with pytest.raises(IntegrityError):
+            souvenez(self.user, when=self.when(12, 10))
+        assert not Souvenir.objects.exists()
+
+    def test_unbucketed_rows_are_not_unique(self, settings):
+        settings.SOUVENIRS_STORAGE = 'rows'
+        assert souvenez(self.user, when=self.when(12, 10), ratelimit=False) == 'added'
+        assert souvenez(self.user, when=self.when(12, 10), ratelimit=False) == 'added'
+        assert Souvenir.objects.filter(bucket__isnull=True).count() == 2
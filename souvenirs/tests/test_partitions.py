@@ -0,0 +1,284 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import date, datetime
+import json
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+import pytest
+from souvenirs import archive, partitions
+from souvenirs.control import (bulk_souvenez, count_active_users,
+                               count_active_users_by_tenant,
+                               count_active_users_many, purge_user_souvenirs,
+                               rebuild_user_activity, souvenez)
+from souvenirs.models import Souvenir, UserActivity
+from souvenirs.reports import (active_users_by_tenant, activity_heatmap,
+                               calendar_monthly_usage, cohort_retention,
+                               engagement_histogram, rolling_active_users)
+from .factories import SouvenirFactory, UserFactory
+
+
+@pytest.mark.django_db
+class TestPartitions:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, settings):
+        cache.clear()
+        settings.SOUVENIRS_STORAGE = 'partitioned'
+        self.tzinfo = timezone.get_default_timezone()
+        self.when = lambda m, d=14: timezone.make_aware(
+            datetime(2017, m, d, 12), self.tzinfo)
+        self.users = [UserFactory() for _ in range(3)]
+
+    def test_souvenez_creates_partitions(self):
+        u, u2, u3 = self.users
+        assert partitions.list_partitions() == []
+        assert souvenez(u, when=self.when(2)) == 'added'
+        assert souvenez(u2, when=self.when(3)) == 'added'
+        assert souvenez(u2, when=self.when(3, 15)) == 'added'
+        assert souvenez(u2, when=self.when(3, 15), ratelimit=False,
+                        check_duplicate=True) == 'duplicated'
+        assert partitions.list_partitions() == [
+            datetime(2017, 2, 1).date(), datetime(2017, 3, 1).date()]
+        assert Souvenir.objects.count() == 0
+        march = partitions.partition_model(datetime(2017, 3, 1).date())
+        assert march.objects.filter(user_id=u2.pk).count() == 2
+        assert u2.souvenir_activity.active_days == 2
+
+    def test_count_active_users(self):
+        u, u2, u3 = self.users
+        souvenez(u, when=self.when(2))
+        souvenez(u2, when=self.when(3))
+        souvenez(u, when=self.when(4))
+        # from before partitioning
+        SouvenirFactory(user=u3, when=self.when(3, 20))
+
+        assert count_active_users() == 3
+        assert count_active_users(self.when(2, 1), self.when(3, 1)) == 1
+        assert count_active_users(self.when(3, 1), self.when(5, 1)) == 3
+        assert count_active_users(self.when(3, 1), self.when(5, 1),
+                                  sample=1) == 3
+        assert count_active_users_many([
+            (None, None), (self.when(3, 1), self.when(4, 1))]) == [3, 2]
+        actives = [r.active_users for r in calendar_monthly_usage(
+            self.when(2, 1), self.when(5, 1))]
+        assert actives == [1, 2, 1, 0]  # to noon on May 1
+
+        # the other months' partitions aren't queried
+        with CaptureQueriesContext(connection) as queries:
+            assert count_active_users(self.when(3, 1), self.when(3, 31)) == 2
+        sql = queries.captured_queries[-1]['sql']
+        assert partitions.partition_table(datetime(2017, 3, 1)) in sql
+        assert partitions.partition_table(datetime(2017, 2, 1)) not in sql
+        assert partitions.partition_table(datetime(2017, 4, 1)) not in sql
+
+    def test_user_delete(self):
+        u, u2, u3 = self.users
+        souvenez(u, when=self.when(2))
+        souvenez(u2, when=self.when(2))
+        u.delete()
+        assert count_active_users() == 1
+
+    def test_create_partition_race(self, monkeypatch):
+        month = datetime(2017, 2, 1).date()
+        assert partitions.create_partition(month)
+        # another process created it after this one looked
+        partitions._existing.clear()
+        table_names = connection.introspection.table_names
+        calls = []
+
+        def stale_table_names(*args, **kwargs):
+            calls.append(1)
+            return [] if len(calls) == 1 else table_names(*args, **kwargs)
+
+        monkeypatch.setattr(connection.introspection, 'table_names',
+                            stale_table_names)
+        assert not partitions.create_partition(month)
+        assert len(calls) == 2
+        assert souvenez(self.users[0], when=self.when(2)) == 'added'
+
+    def test_list_partitions_cached(self):
+        souvenez(self.users[0], when=self.when(2))
+        assert partitions.list_partitions() == [datetime(2017, 2, 1).date()]
+        with CaptureQueriesContext(connection) as queries:
+            assert count_active_users() == 1
+        assert len(queries.captured_queries) == 1
+        souvenez(self.users[0], when=self.when(3))
+        assert partitions.list_partitions() == [
+            datetime(2017, 2, 1).date(), datetime(2017, 3, 1).date()]
+
+    def test_rebuild_user_activity(self):
+        u, u2, u3 = self.users
+        souvenez(u, when=self.when(2))
+        souvenez(u, when=self.when(3))
+        SouvenirFactory(user=u2, when=self.when(3, 20))
+        UserActivity.objects.all().delete()
+        assert rebuild_user_activity() == 2
+        activity = UserActivity.objects.get(user=u)
+        assert (activity.first_seen, activity.last_seen) == (self.when(2),
+                                                             self.when(3))
+        assert activity.souvenir_count == 2
+        assert rebuild_user_activity(users=[u2]) == 1
+        assert UserActivity.objects.count() == 2
+
+    def test_bulk_souvenez(self):
+        u, u2, u3 = self.users
+        souvenez(u, when=self.when(2))
+        results = bulk_souvenez([(u.pk, self.when(2)), (u.pk, self.when(3)),
+                                 (u2.pk, self.when(3))])
+        assert results == {'added': 2, 'duplicated': 1}
+        assert Souvenir.objects.count() == 0
+        assert count_active_users(self.when(3, 1), self.when(4, 1)) == 2
+        assert UserActivity.objects.get(user=u).souvenir_count == 2
+
+    def test_purge_user_souvenirs(self):
+        u, u2, u3 = self.users
+        souvenez(u, when=self.when(2))
+        souvenez(u, when=self.when(3))
+        souvenez(u2, when=self.when(3))
+        SouvenirFactory(user=u, when=self.when(3, 20))
+        assert purge_user_souvenirs(u, batch_size=1) == 3
+        assert count_active_users() == 1
+        assert not UserActivity.objects.filter(user=u).exists()
+
+    def test_command(self):
+        souvenez(self.users[0], when=self.when(2))
+        souvenez(self.users[0], when=self.when(3))
+        out = StringIO()
+        call_command('partition_souvenirs', '--ahead=0', '--drop-before=3/1/2017',
+                     '--list', stdout=out)
+        now = partitions.partition_table(partitions.partition_month(timezone.now()))
+        assert out.getvalue().split() == [
+            'created', now,
+            'dropped', 'souvenirs_souvenir_201702',
+            'souvenirs_souvenir_201703', now]
+        assert count_active_users() == 1
+
+    def reports(self):
+        start, end = self.when(2, 1), self.when(4, 1)
+        periods = [(self.when(2, 1), self.when(3, 1)),
+                   (self.when(3, 1), self.when(4, 1))]
+        return [
+            list(cohort_retention(self.when(2, 1), end=end)),
+            list(rolling_active_users(start, end, window=7)),
+            engagement_histogram(start, end),
+            active_users_by_tenant(periods),
+            count_active_users_by_tenant(start, end),
+            activity_heatmap(start, end),
+            activity_heatmap(start, end, distinct_users=False),
+        ]
+
+    def test_reports(self, settings):
+        u, u2, u3 = self.users
+        get_user_model().objects.update(date_joined=self.when(2, 1))
+        souvenez(u, when=self.when(2))
+        souvenez(u, when=self.when(3))
+        souvenez(u2, when=self.when(3, 15))
+        souvenez(u3, when=self.when(3, 15), tenant='acme')
+        # from before partitioning, with the same users in the same months
+        SouvenirFactory(user=u, when=self.when(3, 16))
+        SouvenirFactory(user=u2, when=self.when(3, 15))
+        partitioned = self.reports()
+        assert [c['usage']['active_users'] for c in partitioned[0]] == [
+            [1, 3], [0]]
+        assert partitioned[2] == [(1, 1, 2), (2, 5, 1), (6, 15, 0),
+                                  (16, None, 0)]
+        assert partitioned[3] == {None: [1, 2], 'acme': [0, 1]}
+        assert partitioned[4] == {None: 2, 'acme': 1}
+
+        # the same as with all of the souvenirs in the table
+        for qs in partitions.partition_querysets():
+            for souvenir in qs:
+                Souvenir.objects.create(user_id=souvenir.user_id,
+                                        when=souvenir.when,
+                                        tenant=souvenir.tenant)
+        settings.SOUVENIRS_STORAGE = 'rows'
+        assert self.reports() == partitioned
+
+    def test_export(self, tmpdir):
+        u, u2, u3 = self.users
+        utc = lambda *w: self.when(*w).astimezone(timezone.utc).isoformat()
+        souvenez(u, when=self.when(2))
+        souvenez(u2, when=self.when(3, 15))
+        SouvenirFactory(user=u3, when=self.when(3, 14))
+        SouvenirFactory(user=u3, when=self.when(3, 15))  # same when
+        expected = ['user_id,when'] + [
+            '{},{}'.format(user.pk, utc(*w)) for user, w in
+            [(u, (2,)), (u3, (3, 14)), (u3, (3, 15)), (u2, (3, 15))]]
+
+        out = StringIO()
+        call_command('export_souvenirs', '--chunk-size=1', stdout=out)
+        assert out.getvalue().splitlines() == expected
+
+        output = str(tmpdir.join('souvenirs.csv'))
+        cursor = str(tmpdir.join('cursor'))
+        call_command('export_souvenirs', '--chunk-size=3', '--output', output,
+                     '--cursor', cursor)
+        with open(cursor) as f:
+            assert json.load(f)['source'] == 'souvenirs_souvenir_201703'
+        souvenez(u, when=self.when(4))
+        call_command('export_souvenirs', '--chunk-size=3', '--output', output,
+                     '--cursor', cursor)
+        with open(output) as f:
+            assert f.read().splitlines() == expected + [
+                '{},{}'.format(u.pk, utc(4))]
+
+    def test_admin(self, admin_client, mocker, settings):
+        settings.SOUVENIRS_EXCLUDE_PATHS = [r'^/admin/']
+        mocker.patch('souvenirs.admin.SouvenirAdmin.list_per_page', 2)
+        u, u2, u3 = self.users
+        souvenez(u, when=self.when(2))
+        souvenez(u2, when=self.when(3, 15))
+        table = [SouvenirFactory(user=u3, when=self.when(3, 14)),
+                 SouvenirFactory(user=u3, when=self.when(3, 16))]
+        url = reverse('admin:souvenirs_souvenir_changelist')
+
+        pages, next_url = [], url
+        while next_url:
+            response = admin_client.get(next_url)
+            assert response.status_code == 200
+            cl = response.context['cl']
+            pages.append([(s.when, s.user, s.pk) for s in cl.result_list])
+            next_url = cl.next_url and url + cl.next_url
+        assert pages == [
+            [(self.when(3, 16), u3, table[1].pk), (self.when(3, 15), u2, None)],
+            [(self.when(3, 14), u3, table[0].pk), (self.when(2), u, None)],
+        ]
+        assert cl.result_count == 4
+        # the partitions' rows can't be changed or selected
+        content = response.content.decode('utf-8')
+        assert reverse('admin:souvenirs_souvenir_change',
+                       args=[table[0].pk]) in content
+        assert 'None' not in content
+
+        response = admin_client.get(url + '?month=2017-03&user=' + str(u2.pk))
+        assert [s.user for s in response.context['cl'].result_list] == [u2]
+
+    def test_archive(self, settings, tmpdir):
+        settings.SOUVENIRS_ARCHIVE_DIR = str(tmpdir.join('archive'))
+        u, u2, u3 = self.users
+        souvenez(u, when=self.when(3))
+        souvenez(u2, when=self.when(3, 15))
+        souvenez(u3, when=self.when(3, 15), tenant='acme')
+        SouvenirFactory(user=u3, when=self.when(3, 16))
+        assert archive.archive_month(date(2017, 3, 1)) == 3
+        march = partitions.partition_model(date(2017, 3, 1))
+        assert list(march.objects.values_list('tenant', flat=True)) == ['acme']
+        assert Souvenir.objects.count() == 0
+        assert count_active_users(self.when(3, 1), self.when(4, 1)) == 3
+
+        # the command finds the months in the partitions
+        souvenez(u, when=self.when(2), ratelimit=False)
+        out = StringIO()
+        call_command('archive_souvenirs', '--before=4/1/2017', stdout=out)
+        assert out.getvalue() == 'archived 1 souvenirs from 2017-02\n'
+
+    def test_command_requires_partitioned(self, settings):
+        settings.SOUVENIRS_STORAGE = 'rows'
+        with pytest.raises(Exception):
+            call_command('partition_souvenirs')
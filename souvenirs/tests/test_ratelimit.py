@@ -0,0 +1,156 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime, timedelta
+import multiprocessing
+import os
+from django.core.cache import cache
+from django.utils import timezone
+import pytest
+from souvenirs.control import souvenez
+from souvenirs.models import Souvenir
+from souvenirs.ratelimit import (CacheRateLimiter, MmapRateLimiter,
+                                 get_ratelimiter)
+from .factories import UserFactory
+
+
+WHEN = datetime(2017, 3, 10, 12, tzinfo=timezone.utc)
+
+
+def test_cache_ratelimiter():
+    cache.clear()
+    limiter = CacheRateLimiter()
+    assert limiter.hit(1, WHEN, 3600) is None
+    assert limiter.hit(1, WHEN + timedelta(seconds=3599), 3600) == WHEN
+    assert limiter.hit(2, WHEN, 3600) is None
+    assert limiter.hit(1, WHEN + timedelta(seconds=3600), 3600) is None
+
+
+def test_get_ratelimiter(settings, tmpdir):
+    assert isinstance(get_ratelimiter(), CacheRateLimiter)
+    assert get_ratelimiter() is get_ratelimiter()
+    settings.SOUVENIRS_RATELIMIT_BACKEND = 'souvenirs.ratelimit.MmapRateLimiter'
+    settings.SOUVENIRS_RATELIMIT_MMAP_PATH = str(tmpdir.join('rl'))
+    settings.SOUVENIRS_RATELIMIT_MMAP_SLOTS = 100
+    limiter = get_ratelimiter()
+    assert isinstance(limiter, MmapRateLimiter)
+    assert limiter.slots == 104
+    assert get_ratelimiter() is limiter
+
+
+class TestMmapRateLimiter:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, tmpdir):
+        self.path = str(tmpdir.join('ratelimit'))
+
+    def test_hit(self):
+        limiter = MmapRateLimiter(self.path, slots=64)
+        assert limiter.hit(1, WHEN, 3600) is None
+        assert limiter.hit(1, WHEN + timedelta(seconds=3599), 3600) == WHEN
+        assert limiter.hit(2, WHEN, 3600) is None
+        assert limiter.hit('0b7a1f9e-uuid', WHEN, 3600) is None
+        assert limiter.hit('0b7a1f9e-uuid', WHEN, 3600) == WHEN
+        assert limiter.hit(1, WHEN + timedelta(seconds=3600), 3600) is None
+
+        # shared through the file
+        other = MmapRateLimiter(self.path, slots=64)
+        assert other.hit(2, WHEN + timedelta(seconds=60), 3600) == WHEN
+
+    def test_geometry_change(self):
+        limiter = MmapRateLimiter(self.path, slots=64)
+        assert limiter.hit(1, WHEN, 3600) is None
+        size = os.path.getsize(limiter.path)
+
+        # a different geometry starts over in its own file, leaving the one
+        # mapped by the old processes alone
+        other = MmapRateLimiter(self.path, slots=128)
+        assert other.path != limiter.path
+        assert other.hit(1, WHEN, 3600) is None
+        assert os.path.getsize(limiter.path) == size
+        assert limiter.hit(1, WHEN + timedelta(seconds=60), 3600) == WHEN
+        assert MmapRateLimiter(self.path, slots=64).hit(
+            1, WHEN + timedelta(seconds=60), 3600) == WHEN
+
+    def test_naive(self):
+        limiter = MmapRateLimiter(self.path, slots=8)
+        when = datetime(2017, 3, 10, 12)
+        assert limiter.hit(1, when, 60) is None
+        assert limiter.hit(1, when, 60) == when
+
+    def test_expired_slots_are_reused(self):
+        limiter = MmapRateLimiter(self.path, slots=8, eviction='none')
+        for u in range(1, 9):
+            assert limiter.hit(u, WHEN, 60) is None
+        later = WHEN + timedelta(seconds=60)
+        assert limiter.hit(9, later, 60) is None
+        assert limiter.hit(9, later, 60) == later
+
+    def test_eviction_oldest(self):
+        limiter = MmapRateLimiter(self.path, slots=8, eviction='oldest')
+        for u in range(1, 9):
+            limiter.hit(u, WHEN + timedelta(seconds=u), 3600)
+        assert limiter.hit(9, WHEN + timedelta(seconds=9), 3600) is None
+        assert limiter.hit(9, WHEN + timedelta(seconds=10), 3600) is not None
+        # user 1 was evicted, the rest are still there
+        assert limiter.hit(1, WHEN + timedelta(seconds=10), 3600) is None
+        assert limiter.hit(8, WHEN + timedelta(seconds=10), 3600) is not None
+
+    def test_eviction_none(self):
+        limiter = MmapRateLimiter(self.path, slots=8, eviction='none')
+        for u in range(1, 9):
+            limiter.hit(u, WHEN, 3600)
+        assert limiter.hit(9, WHEN, 3600) is None
+        assert limiter.hit(9, WHEN, 3600) is None  # not recorded
+        assert limiter.hit(1, WHEN, 3600) == WHEN
+
+    def test_bad_eviction(self):
+        with pytest.raises(ValueError):
+            MmapRateLimiter(self.path, eviction='random')
+
+    def test_multiprocess(self):
+        """
+        Workers hammering the same users all at once let exactly one hit per
+        user through, which is one INSERT per user per window.
+        """
+        workers, users, rounds = 8, 200, 5
+        start = multiprocessing.Event()
+        results = multiprocessing.Queue()
+
+        procs = [multiprocessing.Process(
+            target=_hit_users,
+            args=(self.path, users, rounds, start, results))
+            for _ in range(workers)]
+        MmapRateLimiter(self.path, slots=4096)  # create before the race
+        for p in procs:
+            p.start()
+        start.set()
+        passed = [results.get(timeout=60) for _ in procs]
+        for p in procs:
+            p.join()
+
+        assert sum(len(p) for p in passed) == users
+        assert sorted(u for p in passed for u in p) == list(range(1, users + 1))
+
+
+def _hit_users(path, users, rounds, start, results):
+    limiter = MmapRateLimiter(path, slots=4096)
+    start.wait()
+    passed = []
+    for r in range(rounds):
+        for u in range(1, users + 1):
+            if limiter.hit(u, WHEN + timedelta(seconds=r), 3600) is None:
+                passed.append(u)
+    results.put(passed)
+
+
+@pytest.mark.django_db
+def test_souvenez_mmap(settings, tmpdir, mocker):
+    settings.SOUVENIRS_RATELIMIT_BACKEND = 'souvenirs.ratelimit.MmapRateLimiter'
+    settings.SOUVENIRS_RATELIMIT_MMAP_PATH = str(tmpdir.join('rl'))
+    caches = mocker.patch('souvenirs.ratelimit.caches')
+    u = UserFactory()
+    assert souvenez(u, when=WHEN) == 'added'
+    assert souvenez(u, when=WHEN + timedelta(minutes=59)) == 'rate-limited'
+    assert souvenez(u, when=WHEN + timedelta(minutes=60)) == 'added'
+    assert Souvenir.objects.count() == 2
+    assert not caches.called
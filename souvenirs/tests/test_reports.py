@@ -1,14 +1,31 @@
 from __future__ import absolute_import, unicode_literals
 
 from datetime import datetime
+import json
+import sys
+from django.core.serializers.json import DjangoJSONEncoder
 from django.utils import timezone
 import pytest
-from .factories import SouvenirFactory
-from souvenirs.reports import (daily_usage,
+from .factories import SouvenirFactory, UserFactory
+from souvenirs.control import count_active_users
+from souvenirs.utils import iter_months
+from souvenirs.reports import (BatchQueryUsageBackend,
+                               UsageRow,
+                               _HourOfWeek,
+                               _usage_for_periods,
+                               active_users_by_tenant,
+                               activity_heatmap,
+                               daily_usage,
                                customer_monthly_usage,
                                customer_quarterly_usage,
                                customer_yearly_usage,
                                calendar_monthly_usage,
+                               cohort_retention,
+                               engagement_histogram,
+                               get_usage_backend,
+                               QueryUsageBackend,
+                               SampledUsageBackend,
+                               rolling_active_users,
                                usage_for_periods,
                                registered_users_as_of)
 
@@ -246,3 +263,332 @@ class TestSouvenir:
         # test number of months returned with custom start/end dates
         assert len(list(calendar_monthly_usage(start=make_when(2013, 2), end=make_when(2013,5)))) == 3
         assert len(list(calendar_monthly_usage(start=make_when(2013, 2), end=make_when(2013,2)))) == 0
+
+    def test_rolling_active_users(self):
+        make_when = lambda m, d, **kw: timezone.make_aware(datetime(
+            year=2015, month=m, day=d, **kw))
+
+        user = self.souvenirs[-1].user  # active 2015-10-17
+        SouvenirFactory(user=user, when=make_when(10, 20, hour=9))
+        SouvenirFactory(when=make_when(10, 20, hour=10))
+        SouvenirFactory(when=make_when(9, 28, hour=10))  # only in lead-in
+
+        rolling = list(rolling_active_users(make_when(10, 1), make_when(11, 1),
+                                            window=7))
+        assert len(rolling) == 31
+        assert rolling[0]['period'] == {
+            'start': make_when(9, 25),
+            'end': make_when(10, 2),
+        }
+        assert [r['usage']['active_users'] for r in rolling] == [
+            count_active_users(r['period']['start'], r['period']['end'])
+            for r in rolling
+        ]
+        assert [r['usage']['active_users'] for r in rolling] == (
+            [1] * 4 + [0] * 12 + [1] * 3 + [2] * 7 + [0] * 5)
+
+        # a one-day window is just daily activity
+        daily = rolling_active_users(make_when(10, 1), make_when(11, 1), window=1)
+        assert [d['usage']['active_users'] for d in daily] == (
+            [0] * 16 + [1] + [0] * 2 + [2] + [0] * 11)
+
+        with pytest.raises(ValueError):
+            list(rolling_active_users(make_when(10, 1), window=0))
+
+    def test_rolling_active_users_dst(self):
+        # daylight saving time starts on 2017-03-12 in America/New_York
+        make_when = lambda d, **kw: timezone.make_aware(datetime(
+            year=2017, month=3, day=d, **kw))
+        SouvenirFactory(when=make_when(8, hour=0, minute=30))
+        SouvenirFactory(when=make_when(13, hour=0, minute=30))
+
+        rolling = list(rolling_active_users(make_when(13), make_when(15),
+                                            window=7))
+        assert [(r.start, r.end, r.active_users) for r in rolling] == [
+            (make_when(7), make_when(14), 2),
+            (make_when(8), make_when(15), 2),
+        ]
+
+    def test_cohort_retention(self, django_assert_num_queries):
+        make_when = lambda y, m, **kw: datetime(
+            year=2010, month=1, day=24, hour=22, tzinfo=self.tzinfo).replace(
+                year=y, month=m, **kw)
+
+        # joined 2015-10-17, active again two months later
+        SouvenirFactory(user=self.souvenirs[-1].user, when=make_when(2015, 12, day=1))
+        # joined before the range, so not part of any cohort
+        SouvenirFactory(user=self.souvenirs[5].user, when=make_when(2015, 11, day=1))
+        # joined and active 2015-11-30, active again the following month
+        user = UserFactory(date_joined=make_when(2015, 11, day=30))
+        SouvenirFactory(user=user, when=make_when(2015, 11, day=30))
+        SouvenirFactory(user=user, when=make_when(2016, 1, day=1))
+
+        with django_assert_num_queries(2):
+            cohorts = list(cohort_retention(self.subscription_start,
+                                            start=make_when(2015, 9),
+                                            end=make_when(2016, 2)))
+
+        assert [(c['labels']['year_month'],
+                 c['period']['start'],
+                 c['period']['end'],
+                 c['usage']['registered_users'],
+                 c['usage']['active_users']) for c in cohorts] == [
+            ('Y06 M09', make_when(2015, 9), make_when(2015, 10), 1, [1, 0, 1, 0, 0]),
+            ('Y06 M10', make_when(2015, 10), make_when(2015, 11), 0, [0, 0, 0, 0]),
+            ('Y06 M11', make_when(2015, 11), make_when(2015, 12), 1, [1, 1, 0]),
+            ('Y06 M12', make_when(2015, 12), make_when(2016, 1), 0, [0, 0]),
+            ('Y07 M01', make_when(2016, 1), make_when(2016, 2), 1, [1]),
+        ]
+
+        assert len(list(cohort_retention(self.subscription_start))) == 87
+        assert list(cohort_retention(self.subscription_start,
+                                     start=make_when(2013, 2),
+                                     end=make_when(2013, 2))) == []
+
+    def test_usage_row(self):
+        row = UsageRow(start=self.subscription_start, end=self.now,
+                       active_users=3)
+        assert row == {
+            'period': {'start': self.subscription_start, 'end': self.now},
+            'usage': {'active_users': 3},
+        }
+        assert 'labels' not in row
+        assert row.get('labels') is None
+        row.update(labels={'year': 'Y01'})
+        assert dict(row)['labels'] == {'year': 'Y01'}
+        row['usage'] = {'registered_users': 2, 'active_users': 1}
+        assert (row.registered_users, row.activated_users, row.active_users) == (
+            2, None, 1)
+        with pytest.raises(KeyError):
+            row['other']
+        with pytest.raises(AttributeError):
+            row.other = 1
+
+    def test_usage_row_dict(self):
+        row = UsageRow(start=self.subscription_start, end=self.now,
+                       registered_users=2, active_users=1)
+        row['usage']['active_users'] = 5
+        row['period']['end'] = self.subscription_start
+        assert (row.active_users, row.end) == (5, self.subscription_start)
+        assert row['usage'] == {'registered_users': 2, 'active_users': 5}
+        del row['usage']['registered_users']
+        assert row.registered_users is None
+        rows = json.loads(json.dumps([row.as_dict()], cls=DjangoJSONEncoder))
+        assert rows[0]['usage'] == {'active_users': 5}
+        assert sorted(rows[0]['period']) == ['end', 'start']
+
+    def test_usage_row_size(self):
+        row = UsageRow(start=self.subscription_start, end=self.now,
+                       registered_users=2, activated_users=2, active_users=1,
+                       labels={'year': 'Y01'})
+        assert not hasattr(row, '__dict__')
+        d = row.as_dict()
+        assert sys.getsizeof(row) < sys.getsizeof(d)
+        assert sys.getsizeof(row) < sys.getsizeof(d['usage'])
+
+    def test_usage_reports_function_dicts(self, settings):
+        """
+        An overriding SOUVENIRS_USAGE_REPORTS_FUNCTION may still generate
+        dictionaries, with extra data.
+        """
+        settings.SOUVENIRS_USAGE_REPORTS_FUNCTION = (
+            'souvenirs.tests.test_reports.usage_as_dicts')
+        maus = list(customer_monthly_usage(self.subscription_start))
+        assert len(maus) == 87
+        assert maus[0]['labels']['year_month'] == 'Y01 M01'
+        assert maus[0]['extra'] == 42
+        row = UsageRow.coerce(maus[0])
+        assert (row.start, row.labels, row.registered_users) == (
+            maus[0]['period']['start'], maus[0]['labels'],
+            maus[0]['usage']['registered_users'])
+        daus = list(daily_usage(self.subscription_start,
+                                end=datetime(2010, 3, 1, tzinfo=self.tzinfo)))
+        assert daus[0]['labels']['year_month'] == 'Y01 M01'
+
+    def test_usage_backend_setting(self, settings):
+        assert isinstance(get_usage_backend(), QueryUsageBackend)
+        assert get_usage_backend() is get_usage_backend()
+
+        settings.SOUVENIRS_USAGE_BACKEND = (
+            'souvenirs.tests.test_reports.ApproximateBackend')
+        backend = get_usage_backend()
+        assert isinstance(backend, ApproximateBackend)
+        maus = list(customer_monthly_usage(self.subscription_start))
+        assert len(maus) == 87
+        assert maus[0].active_users == 1000
+        assert backend.calls == 1
+
+    def test_usage_backend_per_call(self, settings):
+        settings.SOUVENIRS_USAGE_REPORTS_FUNCTION = (
+            'souvenirs.tests.test_reports.usage_as_dicts')
+        periods = [(self.subscription_start,
+                    datetime(2011, 1, 1, tzinfo=self.tzinfo))]
+        assert next(usage_for_periods(periods))['extra'] == 42
+
+        backend = ApproximateBackend()
+        assert next(usage_for_periods(periods, backend=backend)).active_users == 1000
+        row = next(usage_for_periods(periods, backend=backend, exact=True))
+        assert row.active_users == 1
+        assert backend.calls == 1
+        row = next(usage_for_periods(
+            periods, backend='souvenirs.reports.QueryUsageBackend'))
+        assert row.active_users == 1
+
+    def test_batch_usage_backend(self, settings):
+        end = datetime(2010, 4, 1, tzinfo=self.tzinfo)
+        daus = list(daily_usage(self.subscription_start, end=end))
+        maus = list(customer_monthly_usage(self.subscription_start))
+        settings.SOUVENIRS_USAGE_BACKEND = (
+            'souvenirs.tests.test_reports.CountingBatchBackend')
+        backend = get_usage_backend()
+        assert backend.batch
+        assert list(daily_usage(self.subscription_start, end=end)) == daus
+        # one call for the months, and one for all of their days
+        assert backend.calls == 2
+        assert list(customer_monthly_usage(self.subscription_start)) == maus
+
+    def test_sampled_usage_backend(self, settings):
+        periods = [(self.subscription_start,
+                    datetime(2018, 1, 1, tzinfo=self.tzinfo))]
+        row = next(usage_for_periods(periods, backend=SampledUsageBackend(1)))
+        assert row.active_users == row.active_users.low == 9
+        settings.SOUVENIRS_USAGE_BACKEND = 'souvenirs.reports.SampledUsageBackend'
+        settings.SOUVENIRS_USAGE_SAMPLE = 0.5
+        assert get_usage_backend().sample == 0.5
+        row = next(usage_for_periods(periods))
+        assert row.active_users.sample == 0.5
+        assert row.active_users.low <= row.active_users <= row.active_users.high
+        assert next(usage_for_periods(periods, exact=True)).active_users == 9
+
+
+class CountingBatchBackend(BatchQueryUsageBackend):
+    calls = 0
+
+    def usage_for_periods(self, periods, using=None):
+        self.calls += 1
+        return super(CountingBatchBackend, self).usage_for_periods(
+            periods, using=using)
+
+
+class ApproximateBackend(QueryUsageBackend):
+    approximate = True
+    calls = 0
+
+    def usage_for_periods(self, periods, using=None):
+        self.calls += 1
+        for row in super(ApproximateBackend, self).usage_for_periods(
+                periods, using=using):
+            row.active_users = 1000
+            yield row
+
+
+def usage_as_dicts(periods, using=None):
+    for row in _usage_for_periods(periods, using=using):
+        yield dict(row.as_dict(), extra=42)
+
+
+@pytest.mark.django_db
+def test_engagement_histogram(django_assert_num_queries):
+    tzinfo = timezone.get_default_timezone()
+    when = lambda d, h: timezone.make_aware(datetime(2017, 3, d, h), tzinfo)
+    for days in [[1], [1, 1, 1], [2, 3], [1, 2, 3, 4, 5], [1, 2, 3, 4, 5, 6],
+                 list(range(1, 20))]:
+        user = UserFactory()
+        for d in days:
+            SouvenirFactory(user=user, when=when(d, 12))
+    # late evening in the default timezone is the same local day, although
+    # it's the next day in UTC
+    user = UserFactory()
+    SouvenirFactory(user=user, when=when(7, 1))
+    SouvenirFactory(user=user, when=when(7, 23))
+
+    with django_assert_num_queries(1):
+        assert engagement_histogram(when(1, 0), when(31, 0)) == [
+            (1, 1, 3), (2, 5, 2), (6, 15, 1), (16, None, 1)]
+    assert engagement_histogram(when(3, 0), when(6, 0), buckets=[1, 3]) == [
+        (1, 2, 1), (3, None, 3)]
+    assert engagement_histogram(when(25, 0), when(31, 0)) == [
+        (1, 1, 0), (2, 5, 0), (6, 15, 0), (16, None, 0)]
+
+    # a year and a half takes two queries, but days aren't counted twice
+    SouvenirFactory(user=user, when=when(7, 1).replace(year=2018))
+    with django_assert_num_queries(2):
+        assert engagement_histogram(when(1, 0), when(1, 0).replace(
+            year=2018, month=9)) == [
+            (1, 1, 2), (2, 5, 3), (6, 15, 1), (16, None, 1)]
+
+    with pytest.raises(ValueError):
+        engagement_histogram(when(1, 0), when(31, 0), buckets=[2, 1])
+
+
+@pytest.mark.django_db
+def test_active_users_by_tenant(django_assert_num_queries):
+    tzinfo = timezone.get_default_timezone()
+    when = lambda m, d: timezone.make_aware(datetime(2017, m, d, 12), tzinfo)
+    u, u2 = UserFactory(), UserFactory()
+    SouvenirFactory(user=u, when=when(1, 5), tenant='acme')
+    SouvenirFactory(user=u, when=when(1, 6), tenant='acme')
+    SouvenirFactory(user=u2, when=when(1, 6), tenant='acme')
+    SouvenirFactory(user=u2, when=when(3, 6), tenant='acme')
+    SouvenirFactory(user=u, when=when(2, 6), tenant='initech')
+    SouvenirFactory(user=u, when=when(2, 7))
+    SouvenirFactory(user=u, when=when(5, 7), tenant='initech')
+
+    periods = list(iter_months(when(1, 1), when(4, 1)))
+    with django_assert_num_queries(1):
+        counts = active_users_by_tenant(periods)
+    assert counts == {
+        'acme': [2, 0, 1],
+        'initech': [0, 1, 0],
+        None: [0, 1, 0],
+    }
+    assert active_users_by_tenant([]) == {}
+
+
+@pytest.mark.django_db
+def test_activity_heatmap(django_assert_num_queries):
+    tzinfo = timezone.get_default_timezone()
+    when = lambda d, h, m=30: timezone.make_aware(
+        datetime(2017, 3, d, h, m), tzinfo)
+    u, u2 = UserFactory(), UserFactory()
+    # Mondays 09:30, before and after the switch to daylight saving time
+    SouvenirFactory(user=u, when=when(6, 9))
+    SouvenirFactory(user=u, when=when(13, 9))
+    SouvenirFactory(user=u2, when=when(13, 9, 50))
+    # Sunday 23:30, after the switch but the same UTC day
+    SouvenirFactory(user=u2, when=when(12, 23))
+
+    start, end = when(1, 0, 0), when(20, 0, 0)
+    with django_assert_num_queries(1):
+        matrix = activity_heatmap(start, end)
+    assert len(matrix) == 7 and all(len(hours) == 24 for hours in matrix)
+    assert matrix[0][9] == 2
+    assert matrix[6][23] == 1
+    assert sum(map(sum, matrix)) == 3
+
+    assert activity_heatmap(start, end, distinct_users=False)[0][9] == 3
+    matrix = activity_heatmap(start, end, tz=timezone.utc)
+    assert (matrix[0][14], matrix[0][13], matrix[0][3]) == (1, 2, 1)
+    assert activity_heatmap(end, start) == [[0] * 24] * 7
+
+
+@pytest.mark.django_db
+def test_activity_heatmap_in_python(mocker):
+    """
+    Databases without an hour-of-week expression group in Python.
+    """
+    tzinfo = timezone.get_default_timezone()
+    when = lambda d, h, m=30: timezone.make_aware(
+        datetime(2017, 3, d, h, m), tzinfo)
+    u, u2 = UserFactory(), UserFactory()
+    for user, (d, h, m) in [(u, (6, 9, 30)), (u, (13, 9, 30)),
+                            (u2, (13, 9, 50)), (u2, (12, 23, 30))]:
+        SouvenirFactory(user=user, when=when(d, h, m))
+    start, end = when(1, 0, 0), when(20, 0, 0)
+    expected = [activity_heatmap(start, end, distinct_users=d, tz=tz)
+                for d in (True, False) for tz in (None, timezone.utc)]
+
+    mocker.patch.object(_HourOfWeek, 'templates', {})
+    assert [activity_heatmap(start, end, distinct_users=d, tz=tz)
+            for d in (True, False) for tz in (None, timezone.utc)] == expected
+    assert expected[0][0][9] == 2
@@ -0,0 +1,192 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils import timezone
+from django.utils.six import StringIO
+import pytest
+from souvenirs.control import (backfill_souvenirs, count_active_users,
+                               rebuild_registration_days, rebuild_user_activity,
+                               souvenez)
+from souvenirs.models import RegistrationDay, Souvenir, UserActivity
+from souvenirs.reports import (calendar_monthly_usage, cohort_retention,
+                               registered_users_as_of, rolling_active_users)
+from souvenirs.routers import SouvenirsRouter
+from .factories import UserFactory
+
+
+def test_router(settings):
+    User = get_user_model()
+    router = SouvenirsRouter()
+
+    assert router.db_for_read(Souvenir) is None
+    assert router.db_for_write(Souvenir) is None
+    assert router.allow_migrate('default', 'souvenirs') is None
+
+    settings.SOUVENIRS_DATABASE = 'souvenirs'
+    assert router.db_for_read(Souvenir) == 'souvenirs'
+    assert router.db_for_write(UserActivity) == 'souvenirs'
+    assert router.db_for_read(User) is None
+    assert router.db_for_write(User) is None
+    assert router.allow_migrate('souvenirs', 'souvenirs', 'souvenir') is True
+    assert router.allow_migrate('default', 'souvenirs', 'souvenir') is False
+    assert router.allow_migrate('default', 'auth', 'user') is None
+    assert router.allow_relation(Souvenir(), User()) is True
+    assert router.allow_relation(User(), User()) is None
+
+    settings.SOUVENIRS_REPORTS_DATABASE = 'default'
+    assert router.db_for_read(Souvenir) == 'default'
+    assert router.db_for_write(Souvenir) == 'souvenirs'
+
+
+@pytest.mark.django_db
+class TestUsing:
+    """
+    Writes and reads against a second SQLite database, with the users only
+    in the default one. Test cases only roll back the default database, so
+    this one cleans up after itself.
+    """
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db):
+        cache.clear()  # user ids repeat in the other database
+        self.tzinfo = timezone.get_current_timezone()
+        self.when = datetime(2017, 2, 14, 12, tzinfo=self.tzinfo)
+        self.user = UserFactory(date_joined=self.when)
+        yield
+        Souvenir.objects.using('souvenirs').all().delete()
+        UserActivity.objects.using('souvenirs').all().delete()
+        RegistrationDay.objects.using('souvenirs').all().delete()
+        get_user_model().objects.using('souvenirs').all().delete()
+
+    def test_souvenez_using(self):
+        assert souvenez(self.user, when=self.when, using='souvenirs') == 'added'
+        assert souvenez(self.user, when=self.when, ratelimit=False,
+                        check_duplicate=True, using='souvenirs') == 'duplicated'
+        assert Souvenir.objects.count() == 0
+        assert UserActivity.objects.count() == 0
+        assert Souvenir.objects.using('souvenirs').count() == 1
+        assert UserActivity.objects.using('souvenirs').get().souvenir_count == 1
+
+    def test_souvenez_routed(self, settings):
+        settings.DATABASE_ROUTERS = ['souvenirs.routers.SouvenirsRouter']
+        settings.SOUVENIRS_DATABASE = 'souvenirs'
+        assert souvenez(self.user, when=self.when) == 'added'
+        assert Souvenir.objects.db_manager('default').count() == 0
+        assert Souvenir.objects.using('souvenirs').count() == 1
+
+    def test_registration_days_routed(self, settings):
+        settings.DATABASE_ROUTERS = ['souvenirs.routers.SouvenirsRouter']
+        settings.SOUVENIRS_DATABASE = 'souvenirs'
+        settings.SOUVENIRS_REGISTRATION_DAYS = True
+        end = datetime(2017, 3, 1, tzinfo=self.tzinfo)
+        user = UserFactory(date_joined=self.when)
+        assert RegistrationDay.objects.db_manager('default').count() == 0
+        assert RegistrationDay.objects.using('souvenirs').get().joined == 1
+        assert registered_users_as_of(end) == (1, 1)
+
+        user.is_active = False
+        user.save()
+        assert registered_users_as_of(end) == (1, 0)
+        user.delete()
+        assert registered_users_as_of(end) == (0, 0)
+
+        UserFactory(date_joined=self.when)
+        RegistrationDay.objects.using('souvenirs').all().delete()
+        assert rebuild_registration_days() == 1
+        assert RegistrationDay.objects.db_manager('default').count() == 0
+        assert registered_users_as_of(end) == (2, 2)
+
+    def test_reports_using(self):
+        souvenez(self.user, when=self.when, using='souvenirs')
+        start = datetime(2017, 1, 1, tzinfo=self.tzinfo)
+        end = datetime(2017, 3, 1, tzinfo=self.tzinfo)
+
+        assert count_active_users() == 0
+        assert count_active_users(using='souvenirs') == 1
+        assert count_active_users(qs=Souvenir.objects.filter(user=self.user),
+                                  using='souvenirs') == 1
+        # the users are always read where they are
+        assert registered_users_as_of(end) == (1, 1)
+        assert registered_users_as_of(end, using='souvenirs') == (1, 1)
+
+        usage = [u['usage'] for u in calendar_monthly_usage(start, end)]
+        assert usage == [{'registered_users': 0,
+                          'activated_users': 0,
+                          'active_users': 0},
+                         {'registered_users': 1,
+                          'activated_users': 1,
+                          'active_users': 0}]
+        usage = [u['usage'] for u in calendar_monthly_usage(
+            start, end, using='souvenirs')]
+        assert usage == [{'registered_users': 0,
+                          'activated_users': 0,
+                          'active_users': 0},
+                         {'registered_users': 1,
+                          'activated_users': 1,
+                          'active_users': 1}]
+
+        rolling = rolling_active_users(start, end, window=30, using='souvenirs')
+        assert sum(r['usage']['active_users'] for r in rolling) == 15
+
+        cohorts = cohort_retention(start, end=end, using='souvenirs')
+        assert [c['usage'] for c in cohorts] == [
+            {'registered_users': 0, 'active_users': [0, 0]},
+            {'registered_users': 1, 'active_users': [1]},
+        ]
+
+    def test_users_elsewhere(self, settings):
+        settings.DATABASE_ROUTERS = ['souvenirs.routers.SouvenirsRouter']
+        settings.SOUVENIRS_DATABASE = 'souvenirs'
+        other = UserFactory(date_joined=self.when)
+        souvenez(self.user, when=self.when)
+        souvenez(other, when=self.when)
+        assert not get_user_model().objects.using('souvenirs').exists()
+
+        # read from the default database, where the user is
+        assert Souvenir.objects.get(user_id=self.user.pk).user == self.user
+        UserActivity.objects.all().delete()
+        assert rebuild_user_activity(
+            users=get_user_model().objects.filter(pk=self.user.pk)) == 1
+        assert UserActivity.objects.using('souvenirs').get().user_id == (
+            self.user.pk)
+
+        other.delete()
+        assert list(Souvenir.objects.values_list('user_id', flat=True)) == [
+            self.user.pk]
+
+        with pytest.raises(ValueError):
+            backfill_souvenirs()
+        assert backfill_souvenirs(fields=()) == 0
+
+    def test_cohort_retention_users_elsewhere(self, settings):
+        settings.DATABASE_ROUTERS = ['souvenirs.routers.SouvenirsRouter']
+        settings.SOUVENIRS_DATABASE = 'souvenirs'
+        start = datetime(2017, 1, 1, tzinfo=self.tzinfo)
+        end = datetime(2017, 4, 1, tzinfo=self.tzinfo)
+        souvenez(self.user, when=self.when)
+        souvenez(self.user, when=datetime(2017, 3, 2, tzinfo=self.tzinfo))
+        souvenez(UserFactory(date_joined=start), when=self.when)
+        cohorts = cohort_retention(start, end=end)
+        assert [c['usage'] for c in cohorts] == [
+            {'registered_users': 1, 'active_users': [0, 1, 0]},
+            {'registered_users': 1, 'active_users': [1, 1]},
+            {'registered_users': 0, 'active_users': [0]},
+        ]
+
+    def test_show_usage_database(self):
+        souvenez(self.user, when=self.when, using='souvenirs')
+        out = StringIO()
+        call_command('show_usage', '--monthly',
+                     '--subscription-start=1/1/2017',
+                     '--before=3/1/2017',
+                     '--database=souvenirs',
+                     stdout=out)
+        assert out.getvalue().split() == '''
+            month    start       end           registered    activated    active
+            -------  ----------  ----------  ------------  -----------  --------
+            Y01 M02  2017-02-01  2017-03-01             1            1         1
+            Y01 M01  2017-01-01  2017-02-01             0            0         0
+        '''.split()
@@ -0,0 +1,77 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime, timedelta
+from django.utils import timezone
+import pytest
+from souvenirs.control import rebuild_registration_days
+from souvenirs.models import RegistrationDay
+from souvenirs.reports import registered_users_as_of
+from .factories import UserFactory
+
+
+@pytest.mark.django_db
+class TestRegistrationDays:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db, settings):
+        settings.SOUVENIRS_REGISTRATION_DAYS = True
+        self.tzinfo = timezone.get_default_timezone()
+
+    def when(self, day, hour=0):
+        return timezone.make_aware(datetime(2017, 3, day, hour), self.tzinfo)
+
+    def days(self):
+        return {d.day.day: (d.joined, d.activated)
+                for d in RegistrationDay.objects.all()}
+
+    def test_signals(self, django_assert_num_queries):
+        u1 = UserFactory(date_joined=self.when(10, 12))
+        u2 = UserFactory(date_joined=self.when(10, 23), is_active=False)
+        u3 = UserFactory(date_joined=self.when(12, 1))
+        assert self.days() == {10: (2, 1), 12: (1, 1)}
+
+        u2.is_active = True
+        u2.save()
+        assert self.days() == {10: (2, 2), 12: (1, 1)}
+
+        u3.date_joined = self.when(11, 5)
+        u3.save()
+        assert self.days() == {10: (2, 2), 11: (1, 1), 12: (0, 0)}
+
+        u1.delete()
+        assert self.days() == {10: (1, 1), 11: (1, 1), 12: (0, 0)}
+
+        # signing in only updates last_login, which costs nothing extra
+        u2.last_login = timezone.now()
+        with django_assert_num_queries(1):
+            u2.save(update_fields=['last_login'])
+        assert self.days() == {10: (1, 1), 11: (1, 1), 12: (0, 0)}
+
+    def test_disabled(self, settings):
+        settings.SOUVENIRS_REGISTRATION_DAYS = False
+        UserFactory(date_joined=self.when(10, 12))
+        assert not RegistrationDay.objects.exists()
+
+    def test_registered_users_as_of(self, settings):
+        for day, hour, active in [(1, 0, True), (1, 12, False), (3, 23, True),
+                                  (4, 0, True), (4, 15, True), (9, 9, False)]:
+            UserFactory(date_joined=self.when(day, hour), is_active=active)
+
+        dates = [self.when(day, hour) for day in range(1, 11)
+                 for hour in (0, 1, 12, 23)]
+        dates.append(self.when(4) + timedelta(microseconds=1))
+        with_days = [registered_users_as_of(d) for d in dates]
+        settings.SOUVENIRS_REGISTRATION_DAYS = False
+        assert with_days == [registered_users_as_of(d) for d in dates]
+        assert with_days[-1] == (4, 3)
+
+    def test_rebuild_registration_days(self):
+        UserFactory(date_joined=self.when(10, 12))
+        UserFactory(date_joined=self.when(10, 23), is_active=False)
+        UserFactory(date_joined=self.when(12, 1))
+        expected = self.days()
+
+        RegistrationDay.objects.all().delete()
+        RegistrationDay.objects.create(day=self.when(1).date(), joined=42)
+        assert rebuild_registration_days() == 2
+        assert self.days() == expected
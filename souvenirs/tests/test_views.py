@@ -0,0 +1,126 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime, timedelta
+import json
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+import pytest
+from souvenirs import reports
+from .factories import SouvenirFactory
+
+
+@pytest.mark.django_db
+class TestUsageView:
+
+    @pytest.fixture(autouse=True)
+    def setup(self, db, admin_client, settings, mocker):
+        settings.SOUVENIRS_EXCLUDE_PATHS = [r'^/souvenirs/']
+        self.client = admin_client
+        self.tzinfo = timezone.get_default_timezone()
+        for m in (1, 2, 2, 3):
+            SouvenirFactory(when=datetime(2017, m, 14, 12, tzinfo=self.tzinfo))
+        self.report = mocker.patch.object(
+            reports, 'customer_monthly_usage',
+            wraps=reports.customer_monthly_usage)
+
+    def get(self, report='monthly', **kwargs):
+        response = self.client.get(
+            reverse('souvenirs_usage', kwargs={'report': report}),
+            kwargs.pop('params', {}), **kwargs)
+        if hasattr(response, 'streaming_content'):
+            response.json_data = json.loads(
+                b''.join(response.streaming_content).decode('utf-8'))
+        return response
+
+    def test_closed_periods(self):
+        params = {'subscription_start': '2017-01-01', 'end': '2017-04-01'}
+        response = self.get(params=params)
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'application/json'
+        assert 'max-age=3600' in response['Cache-Control']
+        periods = response.json_data['periods']
+        assert [p['usage']['active_users'] for p in periods] == [1, 2, 1]
+        assert periods[0]['labels']['year_month'] == 'Y01 M01'
+        assert periods[0]['period']['start'].startswith('2017-01-01T00:00:00')
+        etag = response['ETag']
+        assert etag.startswith('"')
+
+        response = self.get(params=params, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+        assert response['ETag'] == etag
+        assert 'max-age=3600' in response['Cache-Control']
+        assert self.report.call_count == 1
+
+        # other parameters, other tag
+        response = self.get(params=dict(params, end='2017-03-01'),
+                            HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+        assert len(response.json_data['periods']) == 2
+
+    def test_etag_follows_data(self):
+        params = {'subscription_start': '2017-01-01', 'end': '2017-04-01'}
+        etag = self.get(params=params)['ETag']
+        assert self.get(params=params)['ETag'] == etag
+
+        # a backfilled souvenir in a closed period
+        s = SouvenirFactory(when=datetime(2017, 2, 20, 12, tzinfo=self.tzinfo))
+        response = self.get(params=params, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert [p['usage']['active_users']
+                for p in response.json_data['periods']] == [1, 3, 1]
+        etag = response['ETag']
+
+        # activated_users counts the users active now
+        s.user.is_active = False
+        s.user.save()
+        response = self.get(params=params, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+
+    def test_quoted_etags(self, mocker):
+        # parse_etags keeps the quotes since Django 1.11
+        params = {'subscription_start': '2017-01-01', 'end': '2017-04-01'}
+        etag = self.get(params=params)['ETag']
+        mocker.patch('souvenirs.views.parse_etags', return_value=[etag])
+        response = self.get(params=params, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304
+
+    def test_open_period(self):
+        response = self.get(params={
+            'subscription_start': '2017-01-01',
+            'end': (timezone.now() + timedelta(days=1)).isoformat()})
+        assert response.status_code == 200
+        assert not response.has_header('ETag')
+        assert 'max-age=60' in response['Cache-Control']
+
+        response = self.get(params={'subscription_start': '2017-01-01'})
+        assert not response.has_header('ETag')
+        assert 'max-age=60' in response['Cache-Control']
+        assert sum(p['usage']['active_users']
+                   for p in response.json_data['periods']) == 4
+
+    def test_reports(self):
+        response = self.get('calendar-monthly', params={
+            'start': '2017-01-10', 'end': '2017-03-01'})
+        periods = response.json_data['periods']
+        assert [p['labels']['calendar_year_month'] for p in periods] == [
+            '2017-01', '2017-02']
+        response = self.get('daily', params={
+            'subscription_start': '2017-02-14', 'end': '2017-02-16'})
+        assert [p['usage']['active_users']
+                for p in response.json_data['periods']] == [2, 0]
+
+    def test_bad_requests(self):
+        assert self.get('weekly', params={
+            'start': '2017-01-01'}).status_code == 404
+        assert self.get(params={'end': '2017-03-01'}).status_code == 400
+        assert self.get(params={'subscription_start': 'soon'}).status_code == 400
+        response = self.client.post(reverse('souvenirs_usage',
+                                            kwargs={'report': 'monthly'}))
+        assert response.status_code == 405
+
+    def test_staff_only(self, client):
+        response = client.get(reverse('souvenirs_usage',
+                                      kwargs={'report': 'monthly'}))
+        assert response.status_code == 302
@@ -0,0 +1,11 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.conf.urls import url
+from django.contrib.admin.views.decorators import staff_member_required
+from . import views
+
+
+urlpatterns = [
+    url(r'^usage/(?P<report>[\w-]+)/$', staff_member_required(views.usage),
+        name='souvenirs_usage'),
+]
@@ -1,7 +1,9 @@
 from __future__ import absolute_import, unicode_literals
 
 import calendar
-from datetime import datetime, timedelta
+from datetime import datetime, time, timedelta
+from django.conf import settings
+from django.utils import timezone
 
 
 def adjust_to_calendar_month(dt):
@@ -25,6 +27,27 @@ def adjust_to_subscription_start(dt, ss):
     return new_dt
 
 
+def local_date(dt):
+    """
+    Return the date of dt in the default timezone. Souvenirs counts days this
+    way regardless of the current timezone, which may vary per request.
+    """
+    if timezone.is_aware(dt):
+        dt = timezone.localtime(dt, timezone.get_default_timezone())
+    return dt.date()
+
+
+def local_day_start(day):
+    """
+    Return the datetime when day starts in the default timezone, the inverse
+    of local_date.
+    """
+    dt = datetime.combine(day, time())
+    if settings.USE_TZ:
+        dt = timezone.make_aware(dt, timezone.get_default_timezone())
+    return dt
+
+
 def iter_days(start, end):
     """
     Generate a sequence of tuples representing the span of a day
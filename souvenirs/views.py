@@ -0,0 +1,142 @@
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import json
+import dateutil.parser
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max
+from django.http import (Http404, HttpResponseBadRequest,
+                         HttpResponseNotModified, StreamingHttpResponse)
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.http import require_GET
+from . import reports
+from .control import _souvenir_querysets
+from .utils import adjust_to_calendar_month
+
+
+# seconds to cache a response with only closed periods. Their numbers can
+# still change (users are deactivated or deleted, souvenirs are backfilled),
+# so after this the response is revalidated with its ETag.
+CLOSED_MAX_AGE = 3600
+
+# seconds to cache a response including the open period
+OPEN_MAX_AGE = 60
+
+# report name in the URL -> (function in reports, whether it's counted from
+# a subscription_start)
+REPORTS = {
+    'monthly': ('customer_monthly_usage', True),
+    'daily': ('daily_usage', True),
+    'calendar-monthly': ('calendar_monthly_usage', False),
+}
+
+
+@require_GET
+def usage(request, report):
+    """
+    Stream a report as JSON, {"periods": [row, ...]} with rows of the same
+    form as the report generates. The query string has subscription_start
+    (for monthly and daily), start (required for calendar-monthly) and end.
+
+    When end is given and has passed, every period is closed, so the response
+    gets an ETag and a longer max-age, and a request with that ETag in
+    If-None-Match gets a 304 without running the report. The ETag includes a
+    version of the data, from a few aggregate queries, so that it changes
+    when the numbers might. Otherwise the response includes the open period
+    and only gets a short max-age.
+    """
+    try:
+        name, subscription = REPORTS[report]
+    except KeyError:
+        raise Http404("unknown report: {}".format(report))
+    try:
+        params = {k: _parse_date(request.GET.get(k))
+                  for k in ('subscription_start', 'start', 'end')}
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    first = 'subscription_start' if subscription else 'start'
+    if params[first] is None:
+        return HttpResponseBadRequest("{} is required".format(first))
+
+    closed = params['end'] is not None and params['end'] <= timezone.now()
+    etag = None
+    if closed:
+        start = (params['subscription_start'] if subscription else
+                 adjust_to_calendar_month(params['start']))
+        etag = _etag(report, params, _data_version(start, params['end']))
+    if etag and _etag_matches(etag, request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        if subscription:
+            rows = getattr(reports, name)(params['subscription_start'],
+                                          start=params['start'],
+                                          end=params['end'])
+        else:
+            rows = getattr(reports, name)(params['start'], end=params['end'])
+        response = StreamingHttpResponse(_stream(rows),
+                                         content_type='application/json')
+    if etag:
+        response['ETag'] = quote_etag(etag)
+    patch_cache_control(response, private=True,
+                        max_age=CLOSED_MAX_AGE if closed else OPEN_MAX_AGE)
+    return response
+
+
+def _parse_date(value):
+    if not value:
+        return None
+    try:
+        when = dateutil.parser.parse(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError("can't parse date: {}".format(value))
+    if when.tzinfo is None:
+        when = timezone.make_aware(when)
+    return when
+
+
+def _etag(report, params, version):
+    # the backend can change the numbers for the same periods
+    key = json.dumps([report, getattr(settings, 'SOUVENIRS_USAGE_BACKEND', None),
+                      sorted((k, v and v.isoformat()) for k, v in params.items()),
+                      version])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _etag_matches(etag, header):
+    # parse_etags returns the tags unquoted before Django 1.11, and quoted
+    # since, so compare them unquoted. Ours never need escaping.
+    return etag in [tag[1:-1] if len(tag) > 1 and tag[0] == tag[-1] == '"'
+                    else tag for tag in parse_etags(header)]
+
+
+def _data_version(start, end):
+    """
+    Return a list of numbers that change when the data of the reports between
+    start and end does: the count and last id of the souvenirs in each table
+    between start and end, and the count, active count and last id of the
+    users registered before end.
+    """
+    version = []
+    for souvenirs in _souvenir_querysets(None, None, start, end):
+        totals = (souvenirs.filter(when__gte=start, when__lt=end)
+                  .aggregate(count=Count('pk'), last=Max('pk')))
+        version += [totals['count'], totals['last']]
+    users = get_user_model()._default_manager.filter(date_joined__lt=end)
+    totals = users.aggregate(count=Count('pk'), last=Max('pk'))
+    version += [totals['count'], totals['last'],
+                users.filter(is_active=True).count()]
+    return version
+
+
+def _stream(rows):
+    yield '{"periods": ['
+    for i, row in enumerate(rows):
+        # a SOUVENIRS_USAGE_REPORTS_FUNCTION may generate plain dictionaries
+        if isinstance(row, reports.UsageRow):
+            row = row.as_dict()
+        yield (',' if i else '') + json.dumps(row, cls=DjangoJSONEncoder)
+    yield ']}'
@@ -54,7 +54,12 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+    },
+    # for testing SOUVENIRS_DATABASE and using=
+    'souvenirs': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'souvenirs.sqlite3'),
+    },
 }
 
 LANGUAGE_CODE = 'en-us'
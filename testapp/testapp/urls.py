@@ -3,4 +3,5 @@ from django.contrib import admin
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
+    url(r'^souvenirs/', include('souvenirs.urls')),
 ]